@@ -40,12 +40,20 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from collections import deque
-import random
+from collections import deque, defaultdict
+from contextlib import contextmanager
 import matplotlib.pyplot as plt
 from typing import Dict, List, Tuple, Optional
 import json
 import os
+import copy
+import warnings
+import time
+import multiprocessing as mp
+import queue
+import shutil
+import tempfile
+import threading
 
 # Check GPU availability
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -140,10 +148,85 @@ CONFIG = {
     # Gợi ý: 50000-200000
     "buffer_size": 100000,
     
+    # 🔧 [CUSTOMIZABLE] Prioritized Experience Replay (Schaul et al., 2016)
+    # Lấy mẫu transition theo |TD error| thay vì đều - tập trung vào giờ cao
+    # điểm / pin gần cạn. Gợi ý: alpha 0.4-0.7, beta_start 0.4-0.6
+    "prioritized_replay": False,
+    "per_alpha": 0.6,          # Mức ưu tiên (0 = uniform)
+    "per_beta_start": 0.4,     # Importance-sampling correction ban đầu
+    "per_beta_steps": 10000,   # Số update để beta tăng tuyến tính lên 1.0
+    "per_eps": 1e-6,           # Priority tối thiểu, tránh transition bị bỏ quên
+    
+    # 🔧 [CUSTOMIZABLE] Replay storage (uniform replay)
+    # "numpy": mảng NumPy trên CPU, batch chuyển sang device mỗi update (mặc định)
+    # "device": toàn bộ buffer là tensor trên device training (GPU), sample
+    #           không qua host. Gợi ý: "device" khi chạy cuda
+    "replay_storage": "numpy",
+    "replay_stage_chunk": 256,  # Số transitions gom ở staging (pinned) trước khi chép lên device
+    
+    # 🔧 [CUSTOMIZABLE] N-step returns - bootstrap sau n bước thay vì 1
+    # Thưởng giờ cao điểm buổi tối truyền về quyết định sạc buổi sáng nhanh hơn.
+    # Gợi ý: 1 (DQN gốc), 3, 6
+    "n_step": 1,
+    
+    # 🔧 [CUSTOMIZABLE] Training schedule - Replay ratio = updates_per_train / train_every
+    # Cứ train_every env-steps thì chạy updates_per_train bước gradient liên tiếp,
+    # bắt đầu sau warmup_steps env-steps. Gợi ý: train_every 1-8, updates_per_train 1-4
+    "train_every": 1,
+    "updates_per_train": 1,
+    "warmup_steps": 0,
+    
+    # 🔧 [CUSTOMIZABLE] Distributed actor-learner (Ape-X style, một máy Linux)
+    # K actor processes thu thập song song vào shared-memory replay buffer,
+    # một learner chạy update() liên tục. 0 = train() tuần tự như cũ.
+    # Gợi ý: num_actors = số CPU cores - 1
+    "num_actors": 0,
+    "actor_epsilon_base": 0.4,     # Actor i: ε_i = base^(1 + alpha * i / (K-1))
+    "actor_epsilon_alpha": 7.0,
+    "actor_sync_every": 400,       # Env-steps giữa hai lần actor kéo q_network mới
+    "actor_push_chunk": 64,        # Transitions gom ở actor trước mỗi lần ghi vào buffer
+    "learner_publish_every": 100,  # Updates giữa hai lần learner công bố weights
+    
     # 🔧 [CUSTOMIZABLE] Target network update frequency
     # Gợi ý: 500-2000 steps
     "target_update_freq": 1000,
     
+    # 🔧 [CUSTOMIZABLE] Target network update mode
+    # "hard": copy toàn bộ weights mỗi target_update_freq steps (DQN gốc)
+    # "polyak": mỗi step θ' ← (1-τ)θ' + τθ, Q-target thay đổi mượt
+    # Gợi ý: tau 0.001-0.01
+    "target_update": "hard",
+    "tau": 0.005,
+    
+    # 🔧 [CUSTOMIZABLE] Fused forward trong update()
+    # True: q_network(states) và q_network(next_states) gộp thành một forward
+    # trên batch nối [states; next_states] (ít lần gọi hơn, backward lớn hơn).
+    # Chạy benchmark_fused_update để chọn trên máy của bạn
+    "fused_forward": False,
+    
+    # 🔧 [CUSTOMIZABLE] NumPy actor - chọn action bằng bản sao NumPy của q_network
+    # (không qua torch dispatch), đồng bộ lại mỗi actor_refresh_every updates.
+    # Lưu ý: bản sao không có Dropout (inference)
+    "numpy_actor": False,
+    "actor_refresh_every": 10,
+    
+    # 🔧 [CUSTOMIZABLE] Compile mode cho forward của các network (acting + update)
+    # "none": eager (mặc định) | "torch_compile": torch.compile (inductor) |
+    # "torchscript": torch.jit.script. Không khả dụng thì tự quay về eager.
+    # torch_compile tốn thời gian khởi động; graph cache lưu ở compile_cache_dir
+    # để các lần chạy sau không phải compile lại. Xem benchmark_compile
+    "compile_mode": "none",
+    "compile_cache_dir": "compile_cache",
+    
+    # 🔧 [CUSTOMIZABLE] Export policy cho CPU/edge sau training (export_policy)
+    # "fp32" | "fp16" | "dynamic_int8" (weights int8) | "static_int8" (weights +
+    # activations int8, hiệu chỉnh trên export_calibration_states states)
+    # Kiểm tra action agreement với model float trên export_validation_states states
+    "export_quantization": "dynamic_int8",
+    "export_path": "policy_export.pt",
+    "export_calibration_states": 2048,
+    "export_validation_states": 100_000,
+    
     # =========================================================================
     # 📊 TRAINING PARAMETERS - Tham số huấn luyện
     # =========================================================================
@@ -155,12 +238,39 @@ CONFIG = {
     # Steps per episode (= hours per day)
     "max_steps_per_episode": 24,
     
-    # Checkpoint save frequency
+    # Checkpoint save frequency (episodes) - checkpoint định kỳ, luôn được ghi
     "save_freq": 100,
     
+    # 🔧 [CUSTOMIZABLE] Checkpoint writer - ghi ở background thread
+    # Giữ keep_last checkpoint mới nhất + keep_best checkpoint reward cao nhất
+    # trong checkpoint_dir. Checkpoint "best reward" cách nhau ít nhất
+    # checkpoint_min_interval giây (reward 1 episode rất nhiễu - đầu training
+    # gần như episode nào cũng là "best"); best bị throttle không tính là best,
+    # nên best_model.pt luôn khớp "Best reward" được báo cáo
+    "checkpoint_dir": "checkpoints",
+    "checkpoint_keep_last": 3,
+    "checkpoint_keep_best": 3,
+    "checkpoint_min_interval": 10.0,
+    
+    # 🔧 [CUSTOMIZABLE] Run state để resume - train(..., resume_from=run_state_dir)
+    # Mỗi save_freq episodes ghi toàn bộ trạng thái training (networks,
+    # optimizer, replay buffer, các luồng RNG, history) vào run_state_dir
+    "run_state_dir": "run_state",
+    
     # Logging frequency
     "log_freq": 10,
     
+    # 🔧 [CUSTOMIZABLE] Streaming metrics - bộ nhớ cố định dù chạy rất dài
+    # metrics_window: số giá trị gần nhất giữ cho mỗi metric
+    # metrics_max_points: số điểm (bucket) tối đa để plot; khi đầy, gộp từng cặp
+    # metrics_ema_alpha: làm mượt EMA (0.1 ≈ MA20)
+    # metrics_path: file .npz các aggregate, ghi mỗi metrics_flush_every episodes
+    "metrics_window": 100,
+    "metrics_max_points": 500,
+    "metrics_ema_alpha": 0.1,
+    "metrics_path": "training_metrics.npz",
+    "metrics_flush_every": 50,
+    
     # ⚠️ [REQUIRED CHANGE] Random seed - MỖI SINH VIÊN PHẢI KHÁC!
     # Gợi ý: 42, 123, 456, 789, 999, 2024, 7777
     "seed": 42,
@@ -239,6 +349,25 @@ Action Space (5 discrete):
 ================================================================================
 """
 
+def make_seed_sequence(seed) -> np.random.SeedSequence:
+    """
+    Chuẩn hóa seed thành np.random.SeedSequence (gốc của một cây seed).
+    
+    Mỗi env/agent/evaluator sở hữu np.random.Generator riêng, được spawn từ
+    cây SeedSequence này -> không dùng global np.random/random, các luồng
+    (worker, env) độc lập và kết quả bit-identical với cùng root seed.
+    
+    Args:
+        seed: int, None (entropy ngẫu nhiên) hoặc SeedSequence
+        
+    Returns:
+        SeedSequence mới (bản sao nếu truyền vào SeedSequence, để spawn lại từ đầu)
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key)
+    return np.random.SeedSequence(seed)
+
+
 class MicrogridEnv:
     """
     Microgrid Energy Management Environment
@@ -251,14 +380,20 @@ class MicrogridEnv:
     - Giá điện lưới biến đổi theo giờ
     """
     
-    def __init__(self, config: Dict):
+    def __init__(self, config: Dict, seed=None, record_history: bool = True):
         """
         Khởi tạo môi trường với cấu hình.
         
         Args:
             config: Dictionary chứa tất cả tham số cấu hình
+            seed: int hoặc SeedSequence - gốc luồng ngẫu nhiên riêng của env
+            record_history: Ghi episode_history từng giờ (tắt khi training
+                            cho nhanh, bật cho demo/plot_episode_analysis)
         """
         self.config = config
+        self.seed_seq = make_seed_sequence(seed)
+        self.rng = np.random.default_rng(self.seed_seq)
+        self.record_history = record_history
         
         # 🔋 Battery parameters - Tham số pin
         self.battery_capacity = config["battery_capacity"]  # kWh
@@ -296,19 +431,50 @@ class MicrogridEnv:
         # State tracking
         self.reset()
     
-    def reset(self, seed: Optional[int] = None) -> np.ndarray:
+    # Các cột của exogenous_trace - Điều kiện ngoại sinh theo giờ
+    TRACE_COLUMNS = ("demand", "solar", "wind", "price")
+    
+    # Các cột của episode_history - Structured array, mỗi giờ một record
+    HISTORY_DTYPE = np.dtype([
+        ("hour", np.int32), ("demand", np.float64), ("solar", np.float64),
+        ("wind", np.float64), ("price", np.float64), ("action", np.int32),
+        ("renewable_used", np.float64), ("grid_purchased", np.float64),
+        ("battery_level", np.float64), ("reward", np.float64),
+    ])
+    
+    def reset(self, seed: Optional[int] = None,
+              trace: Optional[np.ndarray] = None) -> np.ndarray:
         """
         Reset environment to initial state.
         Đặt lại môi trường về trạng thái ban đầu.
         
+        Điều kiện cả ngày (demand, solar, wind, price) được lấy mẫu một lần
+        vào self.exogenous_trace; _get_obs và step chỉ đọc từ trace này nên
+        agent được tính tiền đúng theo những gì nó quan sát.
+        
+        Env giữ một Generator (self.rng, tạo từ self.seed_seq) suốt đời: mỗi
+        episode lấy tiếp noise của ngày mới từ luồng này, không spawn luồng con
+        riêng cho từng episode (tạo Generator mỗi lần reset làm VectorMicrogridEnv
+        chậm ~4x). Episode vẫn tái lập được: cùng seed -> cùng chuỗi ngày; muốn
+        một ngày cụ thể thì reset(seed=...) hoặc reset(trace=...).
+        
         Args:
-            seed: Random seed for reproducibility
+            seed: int hoặc SeedSequence - đặt lại gốc luồng ngẫu nhiên của env
+            trace: Trace có sẵn shape (hours_per_episode, 4) để phát lại
+                   một ngày đã biết (mặc định: lấy mẫu mới)
             
         Returns:
             Initial observation vector (8D)
         """
         if seed is not None:
-            np.random.seed(seed)
+            self.seed_seq = make_seed_sequence(seed)
+            self.rng = np.random.default_rng(self.seed_seq)
+        
+        if trace is None:
+            noise = np.empty((len(self.TRACE_COLUMNS), self.hours_per_episode))
+            self._draw_noise(self.rng, noise)
+            trace = self._sample_trace(noise)
+        self.exogenous_trace = np.asarray(trace, dtype=np.float32)
         
         # 🔧 [CUSTOMIZABLE] Initial battery level
         # Gợi ý: Thay đổi mức pin ban đầu (0.3-0.7 của capacity)
@@ -321,10 +487,21 @@ class MicrogridEnv:
         self.total_renewable_used = 0.0
         self.total_grid_cost = 0.0
         self.total_unmet = 0.0
-        self.episode_history = []
+        
+        # History cấp phát sẵn cả ngày, step ghi theo index giờ
+        num_rows = self.hours_per_episode if self.record_history else 0
+        self._history = np.zeros(num_rows, dtype=self.HISTORY_DTYPE)
         
         return self._get_obs()
     
+    @property
+    def episode_history(self) -> np.ndarray:
+        """
+        Các giờ đã chạy của episode hiện tại (rỗng nếu record_history=False).
+        Đọc theo cột: env.episode_history["battery_level"].
+        """
+        return self._history[:self.current_hour]
+    
     def _get_obs(self) -> np.ndarray:
         """
         Generate normalized observation vector.
@@ -343,10 +520,7 @@ class MicrogridEnv:
         Returns:
             Normalized observation array (8D)
         """
-        demand = self._get_demand(self.current_hour)
-        solar = self._get_solar(self.current_hour)
-        wind = self._get_wind(self.current_hour)
-        price = self._get_price(self.current_hour)
+        demand, solar, wind, price = self._get_exogenous()
         
         # Normalize all features to [0, 1]
         obs = np.array([
@@ -362,7 +536,46 @@ class MicrogridEnv:
         
         return np.clip(obs, 0.0, 1.0)
     
-    def _get_demand(self, hour: int) -> float:
+    @staticmethod
+    def _draw_noise(rng: np.random.Generator, out: np.ndarray):
+        """
+        Draw one day of unit noise into out, shape (4, hours_per_episode).
+        Lấy noise chuẩn của một ngày: hàng 0 ~ N(0,1) cho demand, hàng 1-3 ~ U[0,1)
+        cho solar/wind/price (cùng chuỗi giá trị như rng.normal rồi 3 lần rng.uniform).
+        """
+        rng.standard_normal(out=out[0])
+        rng.random(out=out[1:])
+    
+    def _sample_trace(self, noise: np.ndarray) -> np.ndarray:
+        """
+        Sample a whole day of exogenous conditions in one vectorized call.
+        Tính điều kiện ngoại sinh cả ngày từ noise đã lấy (_draw_noise).
+        
+        Args:
+            noise: shape (4, hours_per_episode) hoặc (num_traces, 4, hours_per_episode)
+            
+        Returns:
+            float32 array (hours_per_episode, 4) hoặc (num_traces, hours_per_episode, 4),
+            cột theo TRACE_COLUMNS
+        """
+        hours = np.arange(self.hours_per_episode)
+        
+        return np.stack([
+            self._get_demand(hours, noise[..., 0, :]),
+            self._get_solar(hours, noise[..., 1, :]),
+            self._get_wind(hours, noise[..., 2, :]),
+            self._get_price(hours, noise[..., 3, :]),
+        ], axis=-1).astype(np.float32)
+    
+    def _get_exogenous(self) -> List[float]:
+        """
+        Current-hour (demand, solar, wind, price) read from exogenous_trace.
+        Đọc điều kiện giờ hiện tại từ trace (giờ hours_per_episode = 0h,
+        chỉ xuất hiện ở observation cuối episode).
+        """
+        return self.exogenous_trace[self.current_hour % self.hours_per_episode].tolist()
+    
+    def _get_demand(self, hour, z):
         """
         Generate stochastic demand with morning and evening peaks.
         Tạo nhu cầu ngẫu nhiên với đỉnh sáng và tối.
@@ -373,10 +586,11 @@ class MicrogridEnv:
         - Cường độ peak (0.3 và 0.4)
         
         Args:
-            hour: Current hour (0-23)
+            hour: Current hour (0-23), int hoặc mảng giờ (xem _sample_trace)
+            z: Noise N(0,1), broadcast với hour
             
         Returns:
-            Demand in kW
+            Demand in kW (shape broadcast của hour và z)
         """
         # 🔧 [CUSTOMIZABLE] Peak hours - Thay đổi giờ cao điểm
         morning_peak_hour = 8  # Gợi ý: 7-9
@@ -387,11 +601,11 @@ class MicrogridEnv:
         
         # 🔧 [CUSTOMIZABLE] Peak intensity - Thay đổi cường độ peak
         base = self.base_demand * (0.5 + 0.3 * morning_peak + 0.4 * evening_peak)
-        noise = np.random.normal(0, self.demand_std * 0.3)
+        noise = self.demand_std * 0.3 * z
         
-        return max(0, base + noise)
+        return np.maximum(0, base + noise)
     
-    def _get_solar(self, hour: int) -> float:
+    def _get_solar(self, hour, u):
         """
         Generate solar power based on time of day.
         Tạo sản lượng điện mặt trời theo thời gian trong ngày.
@@ -401,23 +615,28 @@ class MicrogridEnv:
         - Biến động thời tiết (0.8-1.2)
         
         Args:
-            hour: Current hour (0-23)
+            hour: Current hour (0-23), int hoặc mảng giờ (xem _sample_trace)
+            u: Noise U[0,1), broadcast với hour
             
         Returns:
-            Solar power in kW
+            Solar power in kW (shape broadcast của hour và u)
         """
         # 🔧 [CUSTOMIZABLE] Sunrise/sunset hours
         sunrise = 6  # Gợi ý: 5-7
         sunset = 18  # Gợi ý: 17-19
         
-        if sunrise <= hour <= sunset:
-            base = self.max_solar * np.sin(np.pi * (hour - sunrise) / (sunset - sunrise))
-            # 🔧 [CUSTOMIZABLE] Weather variability
-            noise = np.random.uniform(0.8, 1.2)  # Gợi ý: 0.7-1.3
-            return max(0, base * noise)
-        return 0.0
+        daylight = (sunrise <= hour) & (hour <= sunset)
+        base = np.where(
+            daylight,
+            self.max_solar * np.sin(np.pi * (hour - sunrise) / (sunset - sunrise)),
+            0.0,
+        )
+        # 🔧 [CUSTOMIZABLE] Weather variability
+        noise = 0.8 + (1.2 - 0.8) * u  # Gợi ý: 0.7-1.3
+        
+        return np.maximum(0, base * noise)
     
-    def _get_wind(self, hour: int) -> float:
+    def _get_wind(self, hour, u):
         """
         Generate stochastic wind power.
         Tạo sản lượng điện gió ngẫu nhiên.
@@ -428,10 +647,11 @@ class MicrogridEnv:
         - Noise range (0.5-1.5)
         
         Args:
-            hour: Current hour (0-23)
+            hour: Current hour (0-23), int hoặc mảng giờ (xem _sample_trace)
+            u: Noise U[0,1), broadcast với hour
             
         Returns:
-            Wind power in kW
+            Wind power in kW (shape broadcast của hour và u)
         """
         # 🔧 [CUSTOMIZABLE] Wind pattern
         base_level = 0.5  # Gợi ý: 0.3-0.6
@@ -439,11 +659,11 @@ class MicrogridEnv:
         variation = self.max_wind * (1 - base_level) * np.sin(np.pi * hour / 12)
         
         # 🔧 [CUSTOMIZABLE] Wind variability
-        noise = np.random.uniform(0.5, 1.5)  # Gợi ý: 0.4-1.6
+        noise = 0.5 + (1.5 - 0.5) * u  # Gợi ý: 0.4-1.6
         
-        return max(0, (base + variation) * noise)
+        return np.maximum(0, (base + variation) * noise)
     
-    def _get_price(self, hour: int) -> float:
+    def _get_price(self, hour, u):
         """
         Generate time-varying grid electricity price.
         Tạo giá điện lưới biến đổi theo thời gian.
@@ -454,21 +674,23 @@ class MicrogridEnv:
         - Price variation (0.9-1.1)
         
         Args:
-            hour: Current hour (0-23)
+            hour: Current hour (0-23), int hoặc mảng giờ (xem _sample_trace)
+            u: Noise U[0,1), broadcast với hour
             
         Returns:
-            Price in $/kWh
+            Price in $/kWh (shape broadcast của hour và u)
         """
         # 🔧 [CUSTOMIZABLE] Peak/off-peak hours
-        if 7 <= hour <= 9 or 18 <= hour <= 21:  # Peak hours
-            base = self.grid_price_max
-        elif 22 <= hour or hour <= 6:  # Off-peak
-            base = self.grid_price_min
-        else:  # Mid-peak
-            base = (self.grid_price_min + self.grid_price_max) / 2
+        is_peak = ((7 <= hour) & (hour <= 9)) | ((18 <= hour) & (hour <= 21))
+        is_off_peak = (22 <= hour) | (hour <= 6)
+        base = np.select(
+            [is_peak, is_off_peak],
+            [self.grid_price_max, self.grid_price_min],
+            (self.grid_price_min + self.grid_price_max) / 2,  # Mid-peak
+        )
         
         # 🔧 [CUSTOMIZABLE] Price variability
-        noise = np.random.uniform(0.9, 1.1)  # Gợi ý: 0.85-1.15
+        noise = 0.9 + (1.1 - 0.9) * u  # Gợi ý: 0.85-1.15
         
         return base * noise
     
@@ -510,10 +732,7 @@ class MicrogridEnv:
         Returns:
             (next_state, reward, done, info)
         """
-        demand = self._get_demand(self.current_hour)
-        solar = self._get_solar(self.current_hour)
-        wind = self._get_wind(self.current_hour)
-        price = self._get_price(self.current_hour)
+        demand, solar, wind, price = self._get_exogenous()
         renewable = solar + wind
         
         # Initialize energy flows
@@ -587,18 +806,11 @@ class MicrogridEnv:
         self.total_unmet += unmet_demand
         
         # Store history
-        self.episode_history.append({
-            "hour": self.current_hour,
-            "demand": demand,
-            "solar": solar,
-            "wind": wind,
-            "price": price,
-            "action": action,
-            "renewable_used": renewable_used,
-            "grid_purchased": grid_purchased,
-            "battery_level": self.battery_level,
-            "reward": reward,
-        })
+        if self.record_history:
+            self._history[self.current_hour] = (
+                self.current_hour, demand, solar, wind, price, action,
+                renewable_used, grid_purchased, self.battery_level, reward,
+            )
         
         # Advance time
         self.current_hour += 1
@@ -616,7 +828,252 @@ class MicrogridEnv:
         
         return self._get_obs(), reward, done, info
 
-print("✅ MicrogridEnv class defined!")
+
+class VectorMicrogridEnv(MicrogridEnv):
+    """
+    Batched Microgrid Environment - N microgrids stepped in one NumPy call.
+    Môi trường vector: mô phỏng song song N microgrid bằng phép toán mảng.
+
+    - battery_level, current_hour, prev_action và các tổng tích lũy là mảng shape (N,)
+    - exogenous_trace shape (N, hours_per_episode, 4): mỗi env một ngày riêng
+    - Dispatch của cả 5 actions tính bằng masked array arithmetic (không if/elif)
+    - Env nào kết thúc sẽ tự động reset; observation cuối nằm trong info["terminal_obs"]
+
+    Công thức dispatch/reward/termination giống hệt MicrogridEnv.step cho từng env.
+    Env thứ i giữ Generator riêng từ luồng seed con thứ i của root seed, nên trùng
+    khớp bit-for-bit với MicrogridEnv(config, seed=SeedSequence(seed).spawn(num_envs)[i])
+    (reset lại sau mỗi episode).
+    """
+
+    # Mã termination_code trong info -> lý do (giống termination_reason của MicrogridEnv)
+    TERMINATION_REASONS = ("", "end_of_day", "battery_critical_low",
+                           "battery_critical_high", "max_unmet_exceeded")
+
+    def __init__(self, config: Dict, num_envs: int, seed=None):
+        """
+        Khởi tạo N môi trường song song.
+
+        Args:
+            config: Dictionary chứa tất cả tham số cấu hình
+            num_envs: Số microgrid chạy song song (N)
+            seed: int hoặc SeedSequence - root seed, mỗi env một luồng con
+        """
+        self.num_envs = num_envs
+        self.env_rngs = None
+        super().__init__(config, seed=seed, record_history=False)
+
+    def reset(self, seed=None) -> np.ndarray:
+        """
+        Reset all N environments.
+        Đặt lại toàn bộ N môi trường.
+
+        Args:
+            seed: int hoặc SeedSequence - đặt lại root seed
+
+        Returns:
+            Initial observations, shape (N, 8)
+        """
+        if seed is not None:
+            self.seed_seq = make_seed_sequence(seed)
+            self.env_rngs = None
+        if self.env_rngs is None:  # Mỗi env một Generator dùng suốt đời (như MicrogridEnv.rng)
+            self.env_rngs = [np.random.default_rng(s) for s in self.seed_seq.spawn(self.num_envs)]
+
+        n = self.num_envs
+        self._env_index = np.arange(n)
+        self.exogenous_trace = self._sample_env_traces(self._env_index)  # (N, hours_per_episode, 4)
+        self.battery_level = np.full(n, self.battery_capacity * 0.5)
+        self.current_hour = np.zeros(n, dtype=np.int64)
+        self.prev_action = np.zeros(n, dtype=np.int64)
+
+        self.total_demand = np.zeros(n)
+        self.total_renewable_used = np.zeros(n)
+        self.total_grid_cost = np.zeros(n)
+        self.total_unmet = np.zeros(n)
+
+        return self._get_obs()
+
+    def _reset_envs(self, mask: np.ndarray):
+        """Reset trạng thái của các env được chọn bởi mask (auto-reset)."""
+        self.exogenous_trace[mask] = self._sample_env_traces(np.flatnonzero(mask))
+        self.battery_level[mask] = self.battery_capacity * 0.5
+        self.current_hour[mask] = 0
+        self.prev_action[mask] = 0
+        self.total_demand[mask] = 0.0
+        self.total_renewable_used[mask] = 0.0
+        self.total_grid_cost[mask] = 0.0
+        self.total_unmet[mask] = 0.0
+
+    def _sample_env_traces(self, env_ids: np.ndarray) -> np.ndarray:
+        """
+        Lấy mẫu trace episode mới cho các env được chọn: noise cả ngày của mỗi env
+        lấy từ Generator riêng của env đó, phần còn lại tính vectorized.
+
+        Returns:
+            float32 array (len(env_ids), hours_per_episode, 4)
+        """
+        noise = np.empty((len(env_ids), len(self.TRACE_COLUMNS), self.hours_per_episode))
+        for row, i in zip(noise, env_ids):
+            self._draw_noise(self.env_rngs[i], row)
+        return self._sample_trace(noise)
+
+    def _get_obs(self, mask=slice(None)) -> np.ndarray:
+        """
+        Generate normalized observations for the selected envs.
+        Tạo observation đã chuẩn hóa cho các env được chọn.
+
+        Args:
+            mask: Boolean mask / slice chọn env (mặc định: tất cả)
+
+        Returns:
+            Normalized observation array, shape (k, 8)
+        """
+        hour = self.current_hour[mask]
+        demand, solar, wind, price = self._get_exogenous(mask)
+
+        obs = np.stack([
+            self.battery_level[mask] / self.battery_capacity,
+            demand / (self.base_demand * 2),
+            solar / self.max_solar,
+            wind / self.max_wind,
+            (price - self.grid_price_min) / (self.grid_price_max - self.grid_price_min),
+            (np.sin(2 * np.pi * hour / 24) + 1) / 2,
+            (np.cos(2 * np.pi * hour / 24) + 1) / 2,
+            self.prev_action[mask] / 4.0,
+        ], axis=1).astype(np.float32)
+
+        return np.clip(obs, 0.0, 1.0)
+
+    def _get_exogenous(self, mask=slice(None)) -> np.ndarray:
+        """
+        Current-hour conditions of the selected envs, read from exogenous_trace.
+        
+        Returns:
+            float64 array (4, k): demand, solar, wind, price
+        """
+        hour = self.current_hour[mask] % self.hours_per_episode
+        return self.exogenous_trace[self._env_index[mask], hour].astype(np.float64).T
+
+    def _check_termination(self) -> np.ndarray:
+        """
+        Vectorized termination check.
+        Kiểm tra điều kiện kết thúc cho cả N env (cùng thứ tự ưu tiên như MicrogridEnv).
+
+        Returns:
+            termination_code array (0 = chưa kết thúc), xem TERMINATION_REASONS
+        """
+        battery_ratio = self.battery_level / self.battery_capacity
+        has_demand = self.total_demand > 0
+        unmet_ratio = np.divide(self.total_unmet, self.total_demand,
+                                out=np.zeros(self.num_envs), where=has_demand)
+
+        return np.select(
+            [
+                self.current_hour >= self.hours_per_episode,
+                battery_ratio < self.battery_critical_low,
+                battery_ratio > self.battery_critical_high,
+                has_demand & (unmet_ratio > self.max_unmet_ratio),
+            ],
+            [1, 2, 3, 4],
+            0,
+        )
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict]:
+        """
+        Execute one time step for all N environments.
+        Thực hiện một bước thời gian (1 giờ) cho cả N môi trường.
+
+        Args:
+            actions: Integer actions (0-4), shape (N,)
+
+        Returns:
+            (next_states (N, 8), rewards (N,), dones (N,), info)
+        """
+        actions = np.asarray(actions)
+        hour = self.current_hour
+
+        demand, solar, wind, price = self._get_exogenous()
+        renewable = solar + wind
+
+        # Action masks - Mặt nạ cho từng hành động
+        is_discharge = actions == 0
+        is_charge = actions == 1
+        is_grid = actions == 2
+        is_renew_grid = actions == 4
+        uses_renewable = is_charge | (actions == 3) | is_renew_grid
+        uses_battery = is_discharge | (actions == 3)
+
+        # Renewable first (actions 1, 3, 4), then battery (actions 0, 3)
+        renewable_used = np.where(uses_renewable, np.minimum(renewable, demand), 0.0)
+        remaining = demand - renewable_used
+        battery_discharge = np.where(
+            uses_battery,
+            np.minimum(np.minimum(self.battery_level, self.max_discharge), remaining),
+            0.0,
+        )
+        remaining = remaining - battery_discharge * self.battery_efficiency
+
+        # Unmet demand (actions 0, 1, 3) and grid purchase (actions 2, 4)
+        unmet_demand = np.where((uses_battery | is_charge) & (remaining > 0), remaining, 0.0)
+        grid_purchased = np.where(
+            is_grid, demand, np.where(is_renew_grid & (remaining > 0), remaining, 0.0)
+        )
+
+        # Charge excess renewable into battery (action 1)
+        excess = renewable - renewable_used
+        battery_charge = np.where(
+            is_charge & (excess > 0),
+            np.minimum(np.minimum(excess, self.max_charge),
+                       self.battery_capacity - self.battery_level),
+            0.0,
+        )
+        self.battery_level = (self.battery_level - battery_discharge
+                              + battery_charge * self.battery_efficiency)
+
+        # Calculate reward - Tính phần thưởng
+        normalized_price = (price - self.grid_price_min) / (self.grid_price_max - self.grid_price_min)
+        is_peak = (18 <= hour) & (hour <= 21)
+
+        rewards = (
+            self.r_renewable * (renewable_used / self.base_demand) +
+            self.r_grid * (grid_purchased / self.base_demand) * normalized_price +
+            self.r_unmet * (unmet_demand / self.base_demand) +
+            self.r_wear * ((battery_charge + battery_discharge) / self.max_charge)
+        )
+        rewards = np.where(is_peak & (grid_purchased == 0), rewards + self.r_bonus, rewards)
+
+        # Update tracking
+        self.total_demand += demand
+        self.total_renewable_used += renewable_used
+        self.total_grid_cost += grid_purchased * price
+        self.total_unmet += unmet_demand
+
+        # Advance time
+        self.current_hour = hour + 1
+        self.prev_action = actions.astype(np.int64)
+
+        # Check termination
+        termination_code = self._check_termination()
+        dones = termination_code > 0
+
+        info = {
+            "total_cost": self.total_grid_cost.copy(),
+            "renewable_ratio": self.total_renewable_used / np.maximum(1, self.total_demand),
+            "unmet_ratio": self.total_unmet / np.maximum(1, self.total_demand),
+            "termination_code": termination_code,
+        }
+
+        next_obs = self._get_obs()
+
+        # Auto-reset finished envs - Tự động reset env đã kết thúc
+        if dones.any():
+            info["terminal_obs"] = next_obs.copy()
+            self._reset_envs(dones)
+            next_obs[dones] = self._get_obs(dones)
+
+        return next_obs, rewards, dones, info
+
+print("✅ MicrogridEnv & VectorMicrogridEnv classes defined!")
 
 #@title 4️⃣ Neural Network & Replay Buffer
 """
@@ -686,94 +1143,1035 @@ class QNetwork(nn.Module):
         return self.network(x)
 
 
+class _CompiledForward:
+    """
+    Forward qua torch.compile, không đổi cấu hình toàn cục của process:
+    - nếu compile lỗi khi gọi (vd. thiếu C++ compiler) thì cảnh báo và chuyển hẳn
+      sang eager cho network này (thay cho torch._dynamo.config.suppress_errors)
+    - graph cache của inductor ghi vào cache_dir riêng của network: compile chạy
+      lazy (lần gọi đầu / recompile) nên TORCHINDUCTOR_CACHE_DIR chỉ được đặt
+      trong lúc gọi rồi trả lại như cũ
+    """
+    
+    def __init__(self, network: nn.Module, compiled, cache_dir: Optional[str] = None):
+        self.network = network
+        self.compiled = compiled
+        self.cache_dir = cache_dir
+    
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.compiled is None:
+            return self.network(x)
+        if self.cache_dir is not None:
+            previous = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.cache_dir
+        try:
+            return self.compiled(x)
+        except Exception as e:
+            out = self.network(x)  # Lỗi không phải do compile vẫn raise từ eager
+            print(f"⚠️ torch.compile failed ({type(e).__name__}); using eager")
+            self.compiled = None
+            return out
+        finally:
+            if self.cache_dir is not None:
+                if previous is None:
+                    os.environ.pop("TORCHINDUCTOR_CACHE_DIR", None)
+                else:
+                    os.environ["TORCHINDUCTOR_CACHE_DIR"] = previous
+    
+    def train(self, mode: bool = True):
+        self.network.train(mode)
+        return self
+    
+    def eval(self):
+        return self.train(False)
+
+
+def compile_network(network: nn.Module, mode: str = "none", cache_dir: Optional[str] = None):
+    """
+    Compile forward của network (dùng chung parameters với network gốc).
+    Trả về callable thay cho network(x); quay về eager nếu không compile được.
+    
+    Args:
+        network: Module cần compile
+        mode: "none" | "torch_compile" | "torchscript"
+        cache_dir: Thư mục graph cache của torch.compile (inductor) cho network này
+        
+    Returns:
+        ScriptModule / _CompiledForward (có train()/eval()), hoặc chính network khi eager
+    """
+    if mode not in ("none", "torch_compile", "torchscript"):
+        raise ValueError(f"compile_mode must be 'none', 'torch_compile' or 'torchscript', got {mode!r}")
+    if mode == "none":
+        return network
+    try:
+        if mode == "torchscript":
+            return torch.jit.script(network)
+        # Graph cache trên đĩa: lần chạy sau dùng lại kernel đã compile. fx_graph_cache
+        # chỉ áp dụng cho lần compile này (options), không đổi config toàn cục
+        compiled = torch.compile(network, dynamic=True, options={"fx_graph_cache": True})
+        return _CompiledForward(network, compiled, None if cache_dir is None else os.path.abspath(cache_dir))
+    except Exception as e:
+        print(f"⚠️ compile_mode={mode!r} unavailable ({type(e).__name__}: {e}); using eager")
+        return network
+
+EXPORT_QUANTIZATIONS = ("fp32", "fp16", "dynamic_int8", "static_int8")
+
+
+def strip_for_inference(network: nn.Module) -> nn.Module:
+    """
+    Bản sao CPU, eval mode của network; module chỉ dùng khi train
+    (nn.Dropout) được thay bằng nn.Identity.
+    """
+    network = copy.deepcopy(network).cpu().eval()
+    for module in list(network.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+    return network
+
+
+class _Float16Policy(nn.Module):
+    """Bọc model fp16: nhận/trả float32 như các bản export khác."""
+    
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model.half()
+    
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model(x.half()).float()
+
+
+def export_policy(network: nn.Module, path: str, quantization: str = "dynamic_int8",
+                  calibration_states: Optional[np.ndarray] = None):
+    """
+    Export network thành TorchScript cho inference CPU (không cần code Python
+    của model khi load: torch.jit.load(path)).
+    
+    Args:
+        network: QNetwork đã train
+        path: File output (ghi atomic)
+        quantization: Một trong EXPORT_QUANTIZATIONS
+        calibration_states: States hiệu chỉnh, bắt buộc với "static_int8"
+        
+    Returns:
+        Module TorchScript đã export (float32 in -> float32 Q-values out),
+        kèm metadata "policy.json" (kind/state_dim/action_dim/quantization)
+    """
+    if quantization not in EXPORT_QUANTIZATIONS:
+        raise ValueError(f"quantization must be one of {EXPORT_QUANTIZATIONS}, got {quantization!r}")
+    if quantization == "static_int8" and calibration_states is None:
+        raise ValueError("static_int8 export requires calibration_states")
+    model = strip_for_inference(network)
+    state_dim = next(m for m in model.modules() if isinstance(m, nn.Linear)).in_features
+    example = torch.zeros(1, state_dim)
+    
+    # torch.ao.quantization đã deprecated (chuyển sang torchao) nhưng vẫn là API có sẵn trong torch
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if quantization == "fp16":
+            model = _Float16Policy(model)
+        elif quantization == "dynamic_int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        elif quantization == "static_int8":
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+            qconfig = get_default_qconfig_mapping(torch.backends.quantized.engine)
+            model = prepare_fx(model, qconfig, example_inputs=(example,))
+            with torch.no_grad():
+                for batch in np.array_split(calibration_states, max(1, len(calibration_states) // 1024)):
+                    model(torch.from_numpy(np.ascontiguousarray(batch, dtype=np.float32)))
+            model = convert_fx(model)
+        with torch.no_grad():
+            exported = torch.jit.freeze(torch.jit.trace(model, example).eval())
+    
+    # Metadata cho các runtime ngoài notebook (vd. microgrid_policy_server.py)
+    metadata = {"kind": "q_values", "state_dim": state_dim, "action_dim": int(exported(example).shape[1]),
+                "quantization": quantization}
+    tmp_path = path + ".tmp"
+    torch.jit.save(exported, tmp_path, _extra_files={"policy.json": json.dumps(metadata)})
+    os.replace(tmp_path, path)
+    return exported
+
+
+def action_agreement(reference: nn.Module, exported, states: np.ndarray,
+                     batch_size: int = 8192) -> Dict[str, float]:
+    """
+    So sánh greedy action của model export với model float (eval mode, không Dropout).
+    
+    Returns:
+        {"agreement": tỷ lệ action trùng, "max_abs_q_diff": sai lệch Q lớn nhất}
+    """
+    reference = strip_for_inference(reference)
+    matches, max_diff = 0, 0.0
+    with torch.no_grad():
+        for start in range(0, len(states), batch_size):
+            batch = torch.from_numpy(np.ascontiguousarray(states[start:start + batch_size]))
+            q_ref, q_exp = reference(batch), exported(batch)
+            matches += int((q_ref.argmax(dim=1) == q_exp.argmax(dim=1)).sum())
+            max_diff = max(max_diff, float((q_ref - q_exp).abs().max()))
+    return {"agreement": matches / len(states), "max_abs_q_diff": max_diff}
+
+
 class ReplayBuffer:
     """
     Experience replay buffer for DQN training.
     Bộ đệm phát lại kinh nghiệm cho huấn luyện DQN.
     
     Giúp phá vỡ correlation giữa các mẫu liên tiếp.
+    
+    Ring buffer trên các mảng NumPy cấp phát sẵn (capacity hàng): push ghi
+    đè transition cũ nhất, sample gather theo index vectorized rồi bọc bằng
+    torch.from_numpy (không copy thêm).
     """
     
-    def __init__(self, capacity: int):
+    def __init__(self, capacity: int, state_dim: int = 8,
+                 rng: Optional[np.random.Generator] = None):
         """
         Khởi tạo buffer.
         
         Args:
             capacity: Maximum number of transitions to store
+            state_dim: Kích thước observation (8)
+            rng: Generator dùng để lấy mẫu (mặc định: Generator mới)
         """
-        self.buffer = deque(maxlen=capacity)
+        self.capacity = capacity
+        self.states = np.zeros((capacity, state_dim), dtype=np.float32)
+        self.actions = np.zeros(capacity, dtype=np.int64)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros((capacity, state_dim), dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.float32)
+        self.ptr = 0  # Vị trí ghi tiếp theo
+        self.size = 0
+        self.rng = rng if rng is not None else np.random.default_rng()
     
     def push(self, state, action, reward, next_state, done):
         """Thêm transition vào buffer."""
-        self.buffer.append((state, action, reward, next_state, done))
+        i = self.ptr
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.dones[i] = done
+        self.ptr = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+    
+    def push_batch(self, states, actions, rewards, next_states, dones):
+        """
+        Thêm B transitions một lần (cho collector vectorized, vd. VectorMicrogridEnv).
+        
+        Args:
+            states, next_states: shape (B, state_dim)
+            actions, rewards, dones: shape (B,)
+        """
+        n = len(actions)
+        if n > self.capacity:  # Chỉ giữ capacity transitions mới nhất
+            keep = slice(n - self.capacity, None)
+            states, actions, rewards = states[keep], actions[keep], rewards[keep]
+            next_states, dones = next_states[keep], dones[keep]
+            self.ptr = (self.ptr + n - self.capacity) % self.capacity
+            n = self.capacity
+        idx = (self.ptr + np.arange(n)) % self.capacity
+        self.states[idx] = states
+        self.actions[idx] = actions
+        self.rewards[idx] = rewards
+        self.next_states[idx] = next_states
+        self.dones[idx] = dones
+        self.ptr = (self.ptr + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
     
     def sample(self, batch_size: int):
         """
         Sample random batch from buffer.
-        Lấy mẫu ngẫu nhiên từ buffer.
+        Lấy mẫu ngẫu nhiên (có hoàn lại) từ buffer.
         
         Args:
             batch_size: Number of samples
             
         Returns:
-            Tuple of (states, actions, rewards, next_states, dones)
+            Tuple of CPU tensors (states, actions, rewards, next_states, dones)
         """
-        batch = random.sample(self.buffer, batch_size)
-        states, actions, rewards, next_states, dones = zip(*batch)
+        indices = self.rng.integers(self.size, size=batch_size)
+        return self._gather(indices)
+    
+    ARRAYS = ("states", "actions", "rewards", "next_states", "dones")
+    
+    def save(self, directory: str) -> Dict:
+        """
+        Ghi size hàng đầu của các mảng thành directory/replay_<tên>.npy.
         
+        Returns:
+            State nhỏ (ptr, size, trạng thái rng, JSON được) để truyền cho load()
+        """
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f"replay_{name}.npy"), getattr(self, name)[:self.size])
+        return {"ptr": self.ptr, "size": self.size, "rng": self.rng.bit_generator.state}
+    
+    def load(self, directory: str, state: Dict):
+        """
+        Khôi phục từ save(): mở các .npy bằng memory map rồi chép vào mảng
+        cấp phát sẵn (vài ms cho 100k+ transitions).
+        """
+        for name in self.ARRAYS:
+            saved = np.load(os.path.join(directory, f"replay_{name}.npy"), mmap_mode="r")
+            getattr(self, name)[:len(saved)] = saved
+        self.ptr = state["ptr"]
+        self.size = state["size"]
+        self.rng.bit_generator.state = state["rng"]
+    
+    def _gather(self, indices: np.ndarray):
+        """Gather các hàng indices thành CPU tensors (torch.from_numpy, không copy thêm)."""
         return (
-            torch.FloatTensor(np.array(states)),
-            torch.LongTensor(actions),
-            torch.FloatTensor(rewards),
-            torch.FloatTensor(np.array(next_states)),
-            torch.FloatTensor(dones),
+            torch.from_numpy(self.states[indices]),
+            torch.from_numpy(self.actions[indices]),
+            torch.from_numpy(self.rewards[indices]),
+            torch.from_numpy(self.next_states[indices]),
+            torch.from_numpy(self.dones[indices]),
         )
     
     def __len__(self):
         """Return current buffer size."""
-        return len(self.buffer)
-
-print("✅ QNetwork and ReplayBuffer defined!")
+        return self.size
 
-#@title 5️⃣ DQN Agent (with Double DQN)
-"""
-================================================================================
-🤖 DOUBLE DQN AGENT - Agent sử dụng thuật toán Double DQN
-================================================================================
 
-Cải tiến so với vanilla DQN:
-- Separate target network: Mạng target riêng để ổn định Q-values
-- Double DQN: Giảm overestimation bias
-- Epsilon-greedy exploration: Khám phá với epsilon decay
+class SumTree:
+    """
+    Array-backed sum-tree cho Prioritized Replay.
+    Cây tổng lưu trên một mảng: node i có con 2i và 2i+1, root là 1,
+    lá j nằm ở tree[leaf_offset + j]. Lấy mẫu và cập nhật đều O(log n),
+    và cả hai được vectorized theo batch (một vòng lặp qua các tầng).
+    """
+    
+    def __init__(self, capacity: int):
+        """
+        Args:
+            capacity: Số lá (làm tròn lên lũy thừa 2 để mọi lá cùng độ sâu)
+        """
+        self.depth = max(1, (capacity - 1).bit_length())
+        self.leaf_offset = 1 << self.depth
+        self.tree = np.zeros(2 * self.leaf_offset, dtype=np.float64)
+    
+    @property
+    def total(self) -> float:
+        """Tổng tất cả priorities."""
+        return self.tree[1]
+    
+    def get(self, leaves: np.ndarray) -> np.ndarray:
+        """Priority hiện tại của các lá."""
+        return self.tree[self.leaf_offset + leaves]
+    
+    def set(self, leaf: int, priority: float):
+        """Ghi priority của một lá rồi cập nhật các node cha."""
+        node = self.leaf_offset + leaf
+        self.tree[node] = priority
+        node //= 2
+        while node >= 1:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node //= 2
+    
+    def update(self, leaves: np.ndarray, priorities: np.ndarray):
+        """Ghi priorities cho cả batch lá, cập nhật các node cha theo từng tầng."""
+        nodes = self.leaf_offset + np.asarray(leaves)
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+    
+    def find(self, values: np.ndarray) -> np.ndarray:
+        """
+        Với mỗi giá trị v trong [0, total), tìm lá có prefix-sum chứa v.
+        
+        Returns:
+            Leaf indices, shape giống values
+        """
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            go_right = values >= left_sum
+            values -= np.where(go_right, left_sum, 0.0)
+            nodes = left + go_right
+        return nodes - self.leaf_offset
 
-Reference paper:
-- DQN: Mnih et al., 2015 "Human-level control through deep RL"
-- Double DQN: Van Hasselt et al., 2016 "Deep RL with Double Q-learning"
-================================================================================
-"""
 
-class DQNAgent:
+class PrioritizedReplayBuffer(ReplayBuffer):
     """
-    Double DQN Agent for Microgrid Optimization.
-    Agent Double DQN cho tối ưu hóa Microgrid.
+    Prioritized Experience Replay (proportional variant).
+    Bộ đệm phát lại ưu tiên: P(i) ∝ (|δ_i| + eps)^alpha.
+    
+    Dùng chung các mảng ring buffer của ReplayBuffer; priority lưu trong
+    SumTree. Transition mới nhận priority lớn nhất từng thấy để chắc chắn
+    được học ít nhất một lần.
     """
     
-    def __init__(self, config: Dict, device: torch.device):
+    def __init__(self, capacity: int, state_dim: int = 8, alpha: float = 0.6,
+                 eps: float = 1e-6, rng: Optional[np.random.Generator] = None):
         """
-        Khởi tạo agent.
+        Khởi tạo buffer.
         
         Args:
-            config: Configuration dictionary
-            device: torch.device (cuda/cpu)
+            capacity: Maximum number of transitions to store
+            state_dim: Kích thước observation (8)
+            alpha: Mức ưu tiên (0 = uniform)
+            eps: Priority tối thiểu cộng vào |TD error|
+            rng: Generator dùng để lấy mẫu (mặc định: Generator mới)
+        """
+        super().__init__(capacity, state_dim, rng=rng)
+        self.alpha = alpha
+        self.eps = eps
+        self.max_priority = 1.0  # Trước khi mũ alpha
+        self.tree = SumTree(capacity)
+    
+    def save(self, directory: str) -> Dict:
+        """Như ReplayBuffer.save, thêm mảng sum-tree và max_priority."""
+        state = super().save(directory)
+        np.save(os.path.join(directory, "replay_priorities.npy"), self.tree.tree)
+        state["max_priority"] = self.max_priority
+        return state
+    
+    def load(self, directory: str, state: Dict):
+        """Khôi phục từ save()."""
+        super().load(directory, state)
+        self.tree.tree[:] = np.load(os.path.join(directory, "replay_priorities.npy"), mmap_mode="r")
+        self.max_priority = state["max_priority"]
+    
+    def push(self, state, action, reward, next_state, done):
+        """Thêm transition với priority lớn nhất hiện có."""
+        self.tree.set(self.ptr, self.max_priority ** self.alpha)
+        super().push(state, action, reward, next_state, done)
+    
+    def push_batch(self, states, actions, rewards, next_states, dones):
+        """Thêm B transitions một lần, tất cả với priority lớn nhất hiện có."""
+        super().push_batch(states, actions, rewards, next_states, dones)
+        n = min(len(actions), self.capacity)
+        written = (self.ptr - n + np.arange(n)) % self.capacity
+        self.tree.update(written, np.full(n, self.max_priority ** self.alpha))
+    
+    def sample(self, batch_size: int, beta: float = 0.4):
+        """
+        Sample batch theo priority (stratified: mỗi mẫu một đoạn total/batch_size).
+        
+        Args:
+            batch_size: Number of samples
+            beta: Mức importance-sampling correction (1.0 = hiệu chỉnh đầy đủ)
+            
+        Returns:
+            Tuple (states, actions, rewards, next_states, dones, weights, indices);
+            weights là tensor IS-weights đã chuẩn hóa theo max, indices dùng cho
+            update_priorities
+        """
+        segment = self.tree.total / batch_size
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        indices = np.minimum(self.tree.find(values), self.size - 1)
+        
+        probs = self.tree.get(indices) / self.tree.total
+        weights = (self.size * probs) ** (-beta)
+        weights /= weights.max()
+        
+        return (*self._gather(indices), torch.from_numpy(weights.astype(np.float32)), indices)
+    
+    def update_priorities(self, indices: np.ndarray, td_errors: np.ndarray):
+        """
+        Cập nhật priorities của batch vừa học từ |TD error| (vectorized).
+        
+        Args:
+            indices: Indices trả về bởi sample
+            td_errors: |TD error| tương ứng, shape (batch_size,)
+        """
+        priorities = np.abs(td_errors) + self.eps
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(indices, priorities ** self.alpha)
+
+
+class DeviceReplayBuffer:
+    """
+    Replay buffer nằm hẳn trên device training (thường là GPU).
+    Bộ đệm phát lại lưu toàn bộ dưới dạng tensor cấp phát sẵn trên device.
+    
+    push ghi vào vùng staging trên host (pinned memory khi dùng cuda), cứ đủ
+    chunk_size transitions thì chép một lần lên device. sample chỉ gồm một
+    torch.randint + index gather trên device, không có round-trip về host.
+    Transitions còn nằm ở staging chưa được lấy mẫu (len() không tính chúng).
+    """
+    
+    def __init__(self, capacity: int, state_dim: int, device: torch.device,
+                 chunk_size: int = 256, generator: Optional[torch.Generator] = None):
+        """
+        Khởi tạo buffer.
+        
+        Args:
+            capacity: Maximum number of transitions to store
+            state_dim: Kích thước observation (8)
+            device: Device chứa buffer
+            chunk_size: Số transitions staging trước mỗi lần chép lên device
+            generator: torch.Generator trên device dùng để lấy mẫu
+        """
+        self.capacity = capacity
+        self.device = device
+        self.states = torch.zeros((capacity, state_dim), dtype=torch.float32, device=device)
+        self.actions = torch.zeros(capacity, dtype=torch.int64, device=device)
+        self.rewards = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.next_states = torch.zeros((capacity, state_dim), dtype=torch.float32, device=device)
+        self.dones = torch.zeros(capacity, dtype=torch.float32, device=device)
+        self.ptr = 0  # Vị trí ghi tiếp theo trên device
+        self.size = 0
+        self.generator = generator
+        
+        # Staging trên host; ghi qua các view NumPy dùng chung bộ nhớ
+        pin = device.type == "cuda"
+        self.chunk_size = chunk_size
+        self._stage = [
+            torch.zeros((chunk_size, state_dim), dtype=torch.float32, pin_memory=pin),
+            torch.zeros(chunk_size, dtype=torch.int64, pin_memory=pin),
+            torch.zeros(chunk_size, dtype=torch.float32, pin_memory=pin),
+            torch.zeros((chunk_size, state_dim), dtype=torch.float32, pin_memory=pin),
+            torch.zeros(chunk_size, dtype=torch.float32, pin_memory=pin),
+        ]
+        self._stage_views = [t.numpy() for t in self._stage]
+        self._stage_count = 0
+        # Copy non_blocking lần trước phải xong trước khi ghi đè staging
+        self._copy_done = torch.cuda.Event() if pin else None
+    
+    def push(self, state, action, reward, next_state, done):
+        """Thêm transition vào staging; tự chép lên device khi đủ chunk."""
+        if self._stage_count == 0 and self._copy_done is not None:
+            self._copy_done.synchronize()
+        i = self._stage_count
+        for view, value in zip(self._stage_views, (state, action, reward, next_state, done)):
+            view[i] = value
+        self._stage_count += 1
+        if self._stage_count == self.chunk_size:
+            self.flush()
+    
+    def push_batch(self, states, actions, rewards, next_states, dones):
+        """Thêm B transitions một lần, chép thẳng lên device (bỏ qua staging)."""
+        self.flush()
+        columns = [torch.as_tensor(np.asarray(c)) for c in (states, actions, rewards, next_states, dones)]
+        n = len(columns[1])
+        if n > self.capacity:  # Chỉ giữ capacity transitions mới nhất
+            columns = [c[n - self.capacity:] for c in columns]
+            self.ptr = (self.ptr + n - self.capacity) % self.capacity
+            n = self.capacity
+        self._write(columns, n)
+    
+    def flush(self):
+        """Chép các transitions đang ở staging lên device."""
+        n = self._stage_count
+        if n == 0:
+            return
+        self._write([t[:n] for t in self._stage], n)
+        if self._copy_done is not None:
+            self._copy_done.record()
+        self._stage_count = 0
+    
+    def _write(self, columns, n: int):
+        """Ghi n hàng vào vị trí ptr (vòng lại đầu buffer khi tràn)."""
+        idx = (self.ptr + torch.arange(n, device=self.device)) % self.capacity
+        for storage, column in zip((self.states, self.actions, self.rewards, self.next_states, self.dones),
+                                   columns):
+            storage[idx] = column.to(self.device, dtype=storage.dtype, non_blocking=True)
+        self.ptr = (self.ptr + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+    
+    def sample(self, batch_size: int):
+        """
+        Sample random batch (có hoàn lại) ngay trên device.
+        
+        Args:
+            batch_size: Number of samples
+            
+        Returns:
+            Tuple of device tensors (states, actions, rewards, next_states, dones)
+        """
+        indices = torch.randint(self.size, (batch_size,), device=self.device, generator=self.generator)
+        return (
+            self.states[indices],
+            self.actions[indices],
+            self.rewards[indices],
+            self.next_states[indices],
+            self.dones[indices],
+        )
+    
+    def save(self, directory: str) -> Dict:
+        """
+        Ghi dữ liệu trên device và phần staging chưa flush (không flush, để
+        chuỗi lấy mẫu sau khi load giống hệt khi chạy liên tục).
+        """
+        for name, storage in zip(ReplayBuffer.ARRAYS, (self.states, self.actions, self.rewards,
+                                                        self.next_states, self.dones)):
+            np.save(os.path.join(directory, f"replay_{name}.npy"), storage[:self.size].cpu().numpy())
+        for name, view in zip(ReplayBuffer.ARRAYS, self._stage_views):
+            np.save(os.path.join(directory, f"replay_stage_{name}.npy"), view[:self._stage_count])
+        generator = self.generator.get_state().tolist() if self.generator is not None else None
+        return {"ptr": self.ptr, "size": self.size, "stage_count": self._stage_count,
+                "generator": generator}
+    
+    def load(self, directory: str, state: Dict):
+        """Khôi phục từ save()."""
+        for name, storage in zip(ReplayBuffer.ARRAYS, (self.states, self.actions, self.rewards,
+                                                        self.next_states, self.dones)):
+            saved = np.load(os.path.join(directory, f"replay_{name}.npy"), mmap_mode="r")
+            storage[:len(saved)] = torch.from_numpy(np.array(saved)).to(self.device)
+        for name, view in zip(ReplayBuffer.ARRAYS, self._stage_views):
+            saved = np.load(os.path.join(directory, f"replay_stage_{name}.npy"), mmap_mode="r")
+            view[:len(saved)] = saved
+        self.ptr = state["ptr"]
+        self.size = state["size"]
+        self._stage_count = state["stage_count"]
+        if state["generator"] is not None:
+            self.generator.set_state(torch.tensor(state["generator"], dtype=torch.uint8))
+    
+    def __len__(self):
+        """Số transitions đã nằm trên device (có thể lấy mẫu)."""
+        return self.size
+
+
+class NStepCollector:
+    """
+    Gom transitions 1 bước thành transitions n bước trước khi vào replay buffer.
+    Bộ gom n-step: mỗi env giữ một cửa sổ trượt n transitions gần nhất.
+    
+    Transition trả ra: (s_t, a_t, R_t, s_{t+n}, done) với
+    R_t = r_t + γ r_{t+1} + ... + γ^{n-1} r_{t+n-1}. Khi episode kết thúc
+    (hết ngày hoặc dừng sớm do _check_termination) cửa sổ được xả hết với
+    done=True và R cắt tại bước cuối, nên target chỉ cần bootstrap γ^n khi
+    done=False.
+    """
+    
+    def __init__(self, n_step: int, gamma: float, num_envs: int = 1):
+        """
+        Args:
+            n_step: Số bước n (1 = transition gốc)
+            gamma: Discount factor
+            num_envs: Số env ghi vào (mỗi env một cửa sổ, theo env_id)
+        """
+        self.n_step = n_step
+        self.discounts = gamma ** np.arange(n_step)
+        self.windows = [deque(maxlen=n_step) for _ in range(num_envs)]
+    
+    def push(self, state, action, reward, next_state, done, env_id: int = 0) -> List[Tuple]:
+        """
+        Thêm transition 1 bước của env env_id.
+        
+        Returns:
+            Các transitions n bước đã đủ dữ liệu (rỗng, một, hoặc cả cửa sổ khi done)
+        """
+        window = self.windows[env_id]
+        window.append((state, action, reward))
+        if done:
+            ready = [self._n_step_transition(window, start, next_state, True)
+                     for start in range(len(window))]
+            window.clear()
+            return ready
+        if len(window) == self.n_step:
+            return [self._n_step_transition(window, 0, next_state, False)]
+        return []
+    
+    def _n_step_transition(self, window, start: int, next_state, done: bool) -> Tuple:
+        """Transition từ window[start] tới hết cửa sổ, return đã discount."""
+        state, action, _ = window[start]
+        rewards = [window[i][2] for i in range(start, len(window))]
+        n_step_return = float(np.dot(self.discounts[:len(rewards)], rewards))
+        return state, action, n_step_return, next_state, done
+    
+    def reset(self, env_id: int = 0):
+        """Bỏ cửa sổ dở dang (episode bị cắt ngang, không kết thúc bằng done)."""
+        self.windows[env_id].clear()
+
+
+class NumpyQNetwork:
+    """
+    NumPy-only mirror of QNetwork for action selection.
+    Bản sao trọng số QNetwork bằng NumPy để chọn action không qua torch.
+    
+    Với MLP nhỏ (8→256→256→128→5) chi phí dispatch của torch cho một state
+    lớn hơn phần tính toán; bản sao này chỉ gồm vài phép matmul NumPy.
+    Dropout bị bỏ qua (inference). Gọi load_from để đồng bộ lại trọng số.
+    """
+    
+    def __init__(self, q_network: QNetwork):
+        linears = [m for m in q_network.modules() if isinstance(m, nn.Linear)]
+        self.weights = [np.empty((m.in_features, m.out_features), dtype=np.float32) for m in linears]
+        self.biases = [np.empty(m.out_features, dtype=np.float32) for m in linears]
+        self.load_from(q_network)
+    
+    def load_from(self, q_network: QNetwork):
+        """Chép trọng số hiện tại của q_network vào các mảng đã cấp phát."""
+        linears = [m for m in q_network.modules() if isinstance(m, nn.Linear)]
+        for weight, bias, linear in zip(self.weights, self.biases, linears):
+            np.copyto(weight, linear.weight.detach().cpu().numpy().T)
+            np.copyto(bias, linear.bias.detach().cpu().numpy())
+    
+    def __call__(self, states: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            states: shape (N, state_dim) float32
+            
+        Returns:
+            Q-values shape (N, action_dim)
+        """
+        h = states
+        last = len(self.weights) - 1
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            h = h @ weight + bias
+            if i < last:
+                np.maximum(h, 0.0, out=h)  # ReLU
+        return h
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer nằm trên shared memory cho training actor-learner.
+    Bộ đệm phát lại dùng chung giữa các process (multiprocessing, fork).
+    
+    Các mảng và ptr/size là RawArray/RawValue tạo trước khi fork, nên mọi
+    actor ghi trực tiếp vào cùng bộ nhớ; ghi được tuần tự hóa bằng một lock,
+    learner sample không cần lock (có thể đọc trúng hàng đang bị ghi đè - chấp
+    nhận được với replay).
+    """
+    
+    def __init__(self, capacity: int, state_dim: int = 8, ctx=None,
+                 rng: Optional[np.random.Generator] = None):
+        """
+        Khởi tạo buffer.
+        
+        Args:
+            capacity: Maximum number of transitions to store
+            state_dim: Kích thước observation (8)
+            ctx: multiprocessing context (mặc định: fork)
+            rng: Generator dùng để lấy mẫu ở learner (mặc định: Generator mới)
+        """
+        ctx = ctx if ctx is not None else mp.get_context("fork")
+        
+        def shared(shape, typecode, dtype):
+            raw = ctx.RawArray(typecode, int(np.prod(shape)))
+            return np.frombuffer(raw, dtype=dtype).reshape(shape)
+        
+        self.capacity = capacity
+        self.states = shared((capacity, state_dim), "f", np.float32)
+        self.actions = shared((capacity,), "q", np.int64)
+        self.rewards = shared((capacity,), "f", np.float32)
+        self.next_states = shared((capacity, state_dim), "f", np.float32)
+        self.dones = shared((capacity,), "f", np.float32)
+        self._ptr = ctx.RawValue("q", 0)
+        self._size = ctx.RawValue("q", 0)
+        self.lock = ctx.Lock()
+        self.rng = rng if rng is not None else np.random.default_rng()
+    
+    @property
+    def ptr(self) -> int:
+        return self._ptr.value
+    
+    @ptr.setter
+    def ptr(self, value: int):
+        self._ptr.value = value
+    
+    @property
+    def size(self) -> int:
+        return self._size.value
+    
+    @size.setter
+    def size(self, value: int):
+        self._size.value = value
+    
+    def push(self, state, action, reward, next_state, done):
+        """Thêm transition (giữ lock trong lúc ghi)."""
+        with self.lock:
+            super().push(state, action, reward, next_state, done)
+    
+    def push_batch(self, states, actions, rewards, next_states, dones):
+        """Thêm B transitions một lần (giữ lock trong lúc ghi)."""
+        with self.lock:
+            super().push_batch(states, actions, rewards, next_states, dones)
+
+print("✅ QNetwork, export_policy, NumpyQNetwork, ReplayBuffer, PrioritizedReplayBuffer, "
+      "DeviceReplayBuffer, NStepCollector and SharedReplayBuffer defined!")
+
+#@title 5️⃣ DQN Agent (with Double DQN)
+"""
+================================================================================
+🤖 DOUBLE DQN AGENT - Agent sử dụng thuật toán Double DQN
+================================================================================
+
+Cải tiến so với vanilla DQN:
+- Separate target network: Mạng target riêng để ổn định Q-values
+- Double DQN: Giảm overestimation bias
+- Epsilon-greedy exploration: Khám phá với epsilon decay
+
+Reference paper:
+- DQN: Mnih et al., 2015 "Human-level control through deep RL"
+- Double DQN: Van Hasselt et al., 2016 "Deep RL with Double Q-learning"
+================================================================================
+"""
+
+class StreamingStats:
+    """
+    Thống kê streaming của một metric với bộ nhớ cố định: count, mean và
+    variance (Welford), min, max, EMA, cùng cửa sổ vòng window giá trị gần nhất.
+    """
+    
+    def __init__(self, window: int = 100, ema_alpha: float = 0.1):
+        """
+        Args:
+            window: Số giá trị gần nhất giữ lại (recent())
+            ema_alpha: Hệ số EMA (0.1 ≈ moving average ~20 giá trị)
+        """
+        self.ema_alpha = ema_alpha
+        self.values = np.zeros(window)
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.ema = float("nan")
+    
+    def add(self, value: float):
+        """Cập nhật mọi thống kê với một giá trị mới, O(1)."""
+        value = float(value)
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.ema = value if self.count == 1 else self.ema + self.ema_alpha * (value - self.ema)
+    
+    @property
+    def variance(self) -> float:
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+    
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.variance))
+    
+    def recent(self, n: Optional[int] = None) -> np.ndarray:
+        """n giá trị gần nhất (tối đa window), theo thứ tự cũ -> mới."""
+        n = min(n if n is not None else len(self.values), len(self.values), self.count)
+        idx = (self.count - n + np.arange(n)) % len(self.values)
+        return self.values[idx]
+    
+    def state_dict(self) -> Dict:
+        """State JSON được (dùng cho run state)."""
+        return {"values": self.values.tolist(), "count": self.count, "mean": self.mean,
+                "m2": self._m2, "min": self.min, "max": self.max, "ema": self.ema}
+    
+    def load_state_dict(self, state: Dict):
+        self.values[:] = state["values"]
+        self.count, self.mean, self._m2 = state["count"], state["mean"], state["m2"]
+        self.min, self.max, self.ema = state["min"], state["max"], state["ema"]
+
+
+class MetricsLogger:
+    """
+    Metrics theo record (mỗi episode một record) với bộ nhớ cố định.
+    
+    - Mỗi metric một StreamingStats (cửa sổ gần nhất + mean/var/min/max/EMA).
+    - Chuỗi aggregate đã downsample cho plot: tối đa max_points bucket, mỗi
+      bucket giữ sum/count/min/max/EMA của bucket_size record liên tiếp. Khi
+      đủ max_points bucket thì gộp từng cặp (bucket_size nhân đôi), nên bộ
+      nhớ không đổi dù chạy hàng triệu record.
+    - flush() ghi aggregates ra path (.npz, atomic); tự gọi mỗi flush_every record.
+    
+    Dùng: metrics.log(reward=r, cost=c); metrics["reward"].recent(10);
+    metrics.aggregates("reward")["mean"]
+    """
+    
+    def __init__(self, names: List[str], window: int = 100, ema_alpha: float = 0.1,
+                 max_points: int = 500, path: Optional[str] = None, flush_every: int = 100):
+        """
+        Args:
+            names: Tên các metric
+            window: Kích thước cửa sổ vòng của mỗi StreamingStats
+            ema_alpha: Hệ số EMA
+            max_points: Số bucket aggregate tối đa (số chẵn)
+            path: File .npz để flush() (None: không ghi đĩa)
+            flush_every: Flush sau mỗi flush_every record
+        """
+        if max_points < 2 or max_points % 2:
+            raise ValueError(f"max_points must be an even number >= 2, got {max_points}")
+        self.names = list(names)
+        self._index = {name: j for j, name in enumerate(self.names)}
+        self.stats = {name: StreamingStats(window, ema_alpha) for name in self.names}
+        self.max_points = max_points
+        self.path = path
+        self.flush_every = flush_every
+        self.num_records = 0
+        self.bucket_size = 1
+        self._num_buckets = 0  # Số bucket đã đóng; bucket đang mở ở hàng _num_buckets
+        self._open_records = 0
+        shape = (max_points, len(self.names))
+        self._sum = np.zeros(shape)
+        self._count = np.zeros(shape, dtype=np.int64)
+        self._min = np.full(shape, np.inf)
+        self._max = np.full(shape, -np.inf)
+        self._ema = np.full(shape, np.nan)
+        self._end = np.zeros(max_points, dtype=np.int64)  # Số record tính tới cuối bucket
+    
+    def __getitem__(self, name: str) -> StreamingStats:
+        return self.stats[name]
+    
+    def log(self, **values: float):
+        """Ghi một record; metric không có mặt trong record thì bỏ qua."""
+        b = self._num_buckets
+        for name, value in values.items():
+            j = self._index[name]
+            value = float(value)
+            self.stats[name].add(value)
+            self._sum[b, j] += value
+            self._count[b, j] += 1
+            self._min[b, j] = min(self._min[b, j], value)
+            self._max[b, j] = max(self._max[b, j], value)
+            self._ema[b, j] = self.stats[name].ema
+        self.num_records += 1
+        self._end[b] = self.num_records
+        self._open_records += 1
+        if self._open_records == self.bucket_size:
+            self._num_buckets += 1
+            self._open_records = 0
+            if self._num_buckets == self.max_points:
+                self._merge_pairs()
+        if self.path is not None and self.num_records % self.flush_every == 0:
+            self.flush()
+    
+    def _merge_pairs(self):
+        """Gộp bucket 2k và 2k+1 thành bucket k, nhân đôi bucket_size."""
+        half = self.max_points // 2
+        even, odd = slice(0, None, 2), slice(1, None, 2)
+        self._sum[:half] = self._sum[even] + self._sum[odd]
+        later_logged = self._count[odd] > 0
+        self._count[:half] = self._count[even] + self._count[odd]
+        self._min[:half] = np.minimum(self._min[even], self._min[odd])
+        self._max[:half] = np.maximum(self._max[even], self._max[odd])
+        self._ema[:half] = np.where(later_logged, self._ema[odd], self._ema[even])
+        self._end[:half] = self._end[odd]
+        self._sum[half:], self._count[half:] = 0.0, 0
+        self._min[half:], self._max[half:], self._ema[half:] = np.inf, -np.inf, np.nan
+        self._num_buckets = half
+        self.bucket_size *= 2
+    
+    def aggregates(self, name: str) -> Dict[str, np.ndarray]:
+        """
+        Chuỗi đã downsample của một metric (kể cả bucket đang mở).
+        
+        Returns:
+            {"step": record cuối mỗi bucket, "mean", "min", "max", "ema"}
+            (bỏ các bucket không có giá trị của metric)
+        """
+        j = self._index[name]
+        rows = self._num_buckets + (self._open_records > 0)
+        count = self._count[:rows, j]
+        logged = count > 0
+        return {
+            "step": self._end[:rows][logged],
+            "mean": self._sum[:rows, j][logged] / count[logged],
+            "min": self._min[:rows, j][logged],
+            "max": self._max[:rows, j][logged],
+            "ema": self._ema[:rows, j][logged],
+        }
+    
+    def flush(self):
+        """Ghi aggregates + thống kê toàn run ra self.path (file tạm rồi os.replace)."""
+        arrays = {"num_records": np.array(self.num_records)}
+        for name in self.names:
+            for key, value in self.aggregates(name).items():
+                arrays[f"{name}/{key}"] = value
+            stats = self.stats[name]
+            arrays[f"{name}/summary"] = np.array([stats.count, stats.mean, stats.std,
+                                                  stats.min, stats.max, stats.ema])
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+    
+    def state_dict(self) -> Dict:
+        """State JSON được (dùng cho run state)."""
+        return {
+            "stats": {name: stats.state_dict() for name, stats in self.stats.items()},
+            "num_records": self.num_records, "bucket_size": self.bucket_size,
+            "num_buckets": self._num_buckets, "open_records": self._open_records,
+            "sum": self._sum.tolist(), "count": self._count.tolist(), "min": self._min.tolist(),
+            "max": self._max.tolist(), "ema": self._ema.tolist(), "end": self._end.tolist(),
+        }
+    
+    def load_state_dict(self, state: Dict):
+        for name, stats in self.stats.items():
+            stats.load_state_dict(state["stats"][name])
+        self.num_records, self.bucket_size = state["num_records"], state["bucket_size"]
+        self._num_buckets, self._open_records = state["num_buckets"], state["open_records"]
+        for key in ("sum", "count", "min", "max", "ema", "end"):
+            getattr(self, f"_{key}")[:] = state[key]
+
+
+class PhaseTimer:
+    """
+    Cộng dồn wall-clock theo từng pha (act, env, store, sample, learn, ...).
+    Dùng: with timer("env"): env.step(action)
+    """
+    
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+    
+    @contextmanager
+    def __call__(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[phase] += time.perf_counter() - start
+            self.counts[phase] += 1
+    
+    def summary(self) -> str:
+        """Một dòng: thời gian và tỷ lệ mỗi pha."""
+        total = sum(self.seconds.values()) or 1.0
+        return " | ".join(f"{phase} {sec:.1f}s ({sec / total * 100:.0f}%)"
+                          for phase, sec in self.seconds.items())
+
+
+def _atomic_torch_save(obj, path: str):
+    """torch.save vào file tạm cùng thư mục rồi os.replace (atomic trên cùng filesystem)."""
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class DQNAgent:
+    """
+    Double DQN Agent for Microgrid Optimization.
+    Agent Double DQN cho tối ưu hóa Microgrid.
+    """
+    
+    def __init__(self, config: Dict, device: torch.device, seed=None):
+        """
+        Khởi tạo agent.
+        
+        Args:
+            config: Configuration dictionary
+            device: torch.device (cuda/cpu)
+            seed: int hoặc SeedSequence - gốc luồng ngẫu nhiên riêng của agent
+                  (khởi tạo trọng số, epsilon-greedy, lấy mẫu replay)
         """
         self.config = config
         self.device = device
         
+        # Random streams - Luồng ngẫu nhiên riêng, không dùng global random/np.random
+        self.seed_seq = make_seed_sequence(seed)
+        init_seq, action_seq, replay_seq = self.seed_seq.spawn(3)
+        self.rng = np.random.default_rng(action_seq)
+        
         self.state_dim = config["state_dim"]
         self.action_dim = config["action_dim"]
         self.gamma = config["gamma"]
+        self.n_step = config["n_step"]
+        self.bootstrap_discount = self.gamma ** self.n_step  # γ^n cho target n-step
         self.batch_size = config["batch_size"]
         self.target_update_freq = config["target_update_freq"]
+        self.target_update = config["target_update"]
+        self.tau = config["tau"]
+        self.fused_forward = config["fused_forward"]
+        if self.target_update not in ("hard", "polyak"):
+            raise ValueError(f"target_update must be 'hard' or 'polyak', got {self.target_update!r}")
         
         # Epsilon parameters - Tham số epsilon cho exploration
         self.epsilon = config["epsilon_start"]
@@ -781,20 +2179,35 @@ class DQNAgent:
         self.epsilon_decay = config["epsilon_decay"]
         
         # Networks - Mạng neural
-        self.q_network = QNetwork(
-            self.state_dim, 
-            self.action_dim, 
-            config["hidden_dims"]
-        ).to(device)
-        
-        self.target_network = QNetwork(
-            self.state_dim, 
-            self.action_dim, 
-            config["hidden_dims"]
-        ).to(device)
+        # Khởi tạo trọng số trong fork_rng để không động vào global torch RNG
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(int(init_seq.generate_state(1)[0]))
+            self.q_network = QNetwork(
+                self.state_dim, 
+                self.action_dim, 
+                config["hidden_dims"]
+            ).to(device)
+            
+            self.target_network = QNetwork(
+                self.state_dim, 
+                self.action_dim, 
+                config["hidden_dims"]
+            ).to(device)
         
         # Copy weights to target network
         self.target_network.load_state_dict(self.q_network.state_dict())
+        # Danh sách tham số cố định cho polyak update (không tạo dict mỗi step)
+        self._online_params = list(self.q_network.parameters())
+        self._target_params = list(self.target_network.parameters())
+        
+        # Forward đã compile (CONFIG["compile_mode"]) cho acting và update
+        self.q_forward = compile_network(self.q_network, config["compile_mode"], config["compile_cache_dir"])
+        self.target_forward = compile_network(self.target_network, config["compile_mode"],
+                                              config["compile_cache_dir"])
+        
+        # NumPy actor (tùy chọn) - bản sao q_network dùng để chọn action
+        self.actor_refresh_every = config["actor_refresh_every"]
+        self.actor_mirror = NumpyQNetwork(self.q_network) if config["numpy_actor"] else None
         
         # 🔧 [CUSTOMIZABLE] Optimizer
         # Gợi ý thay đổi: SGD, RMSprop, AdamW
@@ -804,11 +2217,37 @@ class DQNAgent:
         )
         
         # Replay buffer
-        self.replay_buffer = ReplayBuffer(config["buffer_size"])
+        # Replay buffer: uniform hoặc prioritized (CONFIG["prioritized_replay"]),
+        # uniform lưu trên CPU (NumPy) hoặc device (CONFIG["replay_storage"])
+        self.prioritized = config["prioritized_replay"]
+        if config["replay_storage"] not in ("numpy", "device"):
+            raise ValueError(f"replay_storage must be 'numpy' or 'device', got {config['replay_storage']!r}")
+        if self.prioritized and config["replay_storage"] != "numpy":
+            raise ValueError("prioritized_replay requires replay_storage='numpy'")
+        if self.prioritized:
+            self.replay_buffer = PrioritizedReplayBuffer(
+                config["buffer_size"], self.state_dim,
+                alpha=config["per_alpha"], eps=config["per_eps"],
+                rng=np.random.default_rng(replay_seq),
+            )
+            self.per_beta_start = config["per_beta_start"]
+            self.per_beta_steps = config["per_beta_steps"]
+        elif config["replay_storage"] == "device":
+            replay_generator = torch.Generator(device=device)
+            replay_generator.manual_seed(int(replay_seq.generate_state(1)[0]))
+            self.replay_buffer = DeviceReplayBuffer(
+                config["buffer_size"], self.state_dim, device,
+                chunk_size=config["replay_stage_chunk"], generator=replay_generator,
+            )
+        else:
+            self.replay_buffer = ReplayBuffer(config["buffer_size"], self.state_dim,
+                                              rng=np.random.default_rng(replay_seq))
+        self.n_step_collector = NStepCollector(self.n_step, self.gamma)
         
         # Training tracking
         self.training_step = 0
-        self.losses = []
+        self.loss_stats = StreamingStats(config["metrics_window"], config["metrics_ema_alpha"])
+        self.timer = PhaseTimer()  # Thời gian sample/learn (+ các pha train() ghi vào)
     
     def select_action(self, state: np.ndarray, training: bool = True) -> int:
         """
@@ -822,53 +2261,149 @@ class DQNAgent:
         Returns:
             Selected action (0-4)
         """
-        if training and random.random() < self.epsilon:
-            return random.randint(0, self.action_dim - 1)
+        if training and self.rng.random() < self.epsilon:
+            return int(self.rng.integers(self.action_dim))
         
-        state_tensor = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-        with torch.no_grad():
-            q_values = self.q_network(state_tensor)
-            return q_values.argmax(dim=1).item()
+        return int(self._greedy_actions(np.asarray(state, dtype=np.float32)[None])[0])
+    
+    def act(self, states: np.ndarray, training: bool = True) -> np.ndarray:
+        """
+        Batched epsilon-greedy action selection.
+        Chọn action cho N env cùng lúc (một forward, epsilon vectorized).
+        
+        Args:
+            states: Observations shape (N, state_dim)
+            training: Whether in training mode (use exploration)
+            
+        Returns:
+            Actions shape (N,) int64
+        """
+        states = np.asarray(states, dtype=np.float32)
+        actions = self._greedy_actions(states)
+        if training:
+            explore = self.rng.random(len(states)) < self.epsilon
+            actions[explore] = self.rng.integers(self.action_dim, size=int(explore.sum()))
+        return actions
+    
+    def _greedy_actions(self, states: np.ndarray) -> np.ndarray:
+        """argmax Q cho batch states (qua NumPy mirror nếu bật numpy_actor)."""
+        if self.actor_mirror is not None:
+            return self.actor_mirror(states).argmax(axis=1)
+        with torch.no_grad(), self._eval_mode():
+            q_values = self.q_forward(torch.from_numpy(states).to(self.device))
+            return q_values.argmax(dim=1).cpu().numpy()
+    
+    @contextmanager
+    def _eval_mode(self):
+        """
+        Tắt Dropout khi chọn action (inference), bật lại cho update().
+        Module TorchScript có cờ training riêng nên q_forward được chuyển cùng.
+        """
+        modules = [self.q_network] + ([self.q_forward] if self.q_forward is not self.q_network else [])
+        was_training = self.q_network.training
+        for module in modules:
+            module.eval()
+        try:
+            yield
+        finally:
+            if was_training:
+                for module in modules:
+                    module.train()
     
     def store_transition(self, state, action, reward, next_state, done):
         """
         Store transition in replay buffer.
-        Lưu transition vào replay buffer.
+        Lưu transition vào replay buffer (qua NStepCollector khi n_step > 1).
         """
-        self.replay_buffer.push(state, action, reward, next_state, float(done))
+        for transition in self.n_step_collector.push(state, action, reward, next_state, done):
+            self.replay_buffer.push(*transition[:4], float(transition[4]))
     
-    def update(self) -> Optional[float]:
+    def begin_episode(self):
+        """
+        Gọi đầu mỗi episode training: bỏ cửa sổ n-step dở dang nếu episode
+        trước bị cắt ở max_steps_per_episode mà chưa done.
         """
-        Perform one gradient update step.
-        Thực hiện một bước cập nhật gradient.
+        self.n_step_collector.reset()
+    
+    def update(self, num_updates: int = 1) -> Optional[float]:
+        """
+        Perform gradient update steps.
+        Thực hiện num_updates bước cập nhật gradient liên tiếp.
+        
+        Minibatches của cả num_updates bước được lấy trong một lần sample
+        (một lần rút index vectorized) rồi chia xen kẽ, sau đó học liền nhau.
+        
+        Args:
+            num_updates: Số bước gradient (updates_per_train)
         
         Returns:
-            Loss value or None if buffer too small
+            Mean loss value or None if buffer too small
         """
         if len(self.replay_buffer) < self.batch_size:
             return None
         
-        # Sample batch
-        states, actions, rewards, next_states, dones = self.replay_buffer.sample(self.batch_size)
-        states = states.to(self.device)
-        actions = actions.to(self.device)
-        rewards = rewards.to(self.device)
-        next_states = next_states.to(self.device)
-        dones = dones.to(self.device)
+        # Sample batch (DeviceReplayBuffer trả về tensor đã ở trên device: .to() không copy)
+        with self.timer("sample"):
+            if self.prioritized:
+                # Beta tăng tuyến tính từ per_beta_start lên 1.0
+                beta = min(1.0, self.per_beta_start + (1.0 - self.per_beta_start)
+                           * self.training_step / self.per_beta_steps)
+                *batch, indices = self.replay_buffer.sample(self.batch_size * num_updates, beta)
+            else:
+                batch = self.replay_buffer.sample(self.batch_size * num_updates)
+            batch = [t.to(self.device) for t in batch]
+        
+        losses = []
+        with self.timer("learn"):
+            for i in range(num_updates):
+                # Minibatch i = các hàng i, i+k, i+2k... (xen kẽ để PER stratified vẫn phủ đều)
+                minibatch = [t[i::num_updates] for t in batch]
+                if self.prioritized:
+                    losses.append(self._learn(*minibatch, indices=indices[i::num_updates]))
+                else:
+                    losses.append(self._learn(*minibatch))
+        
+        loss_value = float(np.mean(losses))
+        self.loss_stats.add(loss_value)
+        return loss_value
+    
+    def _learn(self, states, actions, rewards, next_states, dones,
+               weights=None, indices=None) -> float:
+        """
+        Một bước gradient Double DQN trên một minibatch đã ở trên device.
         
-        # Current Q values
-        current_q = self.q_network(states).gather(1, actions.unsqueeze(1)).squeeze(1)
+        Returns:
+            Loss value
+        """
+        # Current Q values (fused: một forward online cho cả states và next_states)
+        if self.fused_forward:
+            all_q = self.q_forward(torch.cat([states, next_states]))
+            current_q, online_next_q = all_q.split(len(states))
+            online_next_q = online_next_q.detach()
+        else:
+            current_q = self.q_forward(states)
+        current_q = current_q.gather(1, actions.unsqueeze(1)).squeeze(1)
         
         # Double DQN: use online network to select action, target network to evaluate
         # Double DQN: dùng mạng online chọn action, mạng target đánh giá
         with torch.no_grad():
-            next_actions = self.q_network(next_states).argmax(dim=1, keepdim=True)
-            next_q = self.target_network(next_states).gather(1, next_actions).squeeze(1)
-            target_q = rewards + self.gamma * next_q * (1 - dones)
+            if not self.fused_forward:
+                online_next_q = self.q_forward(next_states)
+            next_actions = online_next_q.argmax(dim=1, keepdim=True)
+            next_q = self.target_forward(next_states).gather(1, next_actions).squeeze(1)
+            # N-step: rewards đã là return n bước, bootstrap bằng γ^n
+            target_q = rewards + self.bootstrap_discount * next_q * (1 - dones)
         
         # 🔧 [CUSTOMIZABLE] Loss function
         # Gợi ý thay đổi: MSELoss, SmoothL1Loss (Huber)
-        loss = nn.SmoothL1Loss()(current_q, target_q)
+        if self.prioritized:
+            # Importance-sampling weights bù cho phân phối lấy mẫu lệch
+            elementwise_loss = nn.SmoothL1Loss(reduction="none")(current_q, target_q)
+            loss = (weights * elementwise_loss).mean()
+            td_errors = (target_q - current_q).detach().abs().cpu().numpy()
+            self.replay_buffer.update_priorities(indices, td_errors)
+        else:
+            loss = nn.SmoothL1Loss()(current_q, target_q)
         
         self.optimizer.zero_grad()
         loss.backward()
@@ -878,14 +2413,26 @@ class DQNAgent:
         torch.nn.utils.clip_grad_norm_(self.q_network.parameters(), max_norm=10.0)
         self.optimizer.step()
         
-        # Update target network periodically
+        # Update target network (polyak mỗi step, hoặc hard định kỳ)
         self.training_step += 1
-        if self.training_step % self.target_update_freq == 0:
+        if self.target_update == "polyak":
+            self.soft_update_target()
+        elif self.training_step % self.target_update_freq == 0:
             self.target_network.load_state_dict(self.q_network.state_dict())
         
-        loss_value = loss.item()
-        self.losses.append(loss_value)
-        return loss_value
+        # Đồng bộ NumPy actor
+        if self.actor_mirror is not None and self.training_step % self.actor_refresh_every == 0:
+            self.actor_mirror.load_from(self.q_network)
+        
+        return loss.item()
+    
+    @torch.no_grad()
+    def soft_update_target(self):
+        """
+        Polyak update θ' ← (1-τ)θ' + τθ cho mọi tham số trong một lệnh
+        multi-tensor in-place (torch._foreach_lerp_), không cấp phát state dict.
+        """
+        torch._foreach_lerp_(self._target_params, self._online_params, self.tau)
     
     def decay_epsilon(self):
         """
@@ -894,32 +2441,71 @@ class DQNAgent:
         """
         self.epsilon = max(self.epsilon_end, self.epsilon * self.epsilon_decay)
     
-    def save(self, path: str):
+    def state_dict(self) -> Dict:
         """
-        Save model weights.
-        Lưu trọng số model.
+        Checkpoint state (tensors là tham chiếu tới state đang train, không copy).
+        Trạng thái checkpoint; dùng bởi save() và CheckpointWriter.
         """
-        torch.save({
+        return {
             "q_network": self.q_network.state_dict(),
             "target_network": self.target_network.state_dict(),
             "optimizer": self.optimizer.state_dict(),
             "epsilon": self.epsilon,
             "training_step": self.training_step,
-        }, path)
+        }
+    
+    def save(self, path: str):
+        """
+        Save model weights.
+        Lưu trọng số model.
+        """
+        _atomic_torch_save(self.state_dict(), path)
     
     def load(self, path: str):
         """
         Load model weights.
         Tải trọng số model.
         """
-        checkpoint = torch.load(path, map_location=self.device)
+        self.load_state_dict(torch.load(path, map_location=self.device))
+    
+    def load_state_dict(self, checkpoint: Dict):
+        """
+        Khôi phục từ state_dict().
+        """
         self.q_network.load_state_dict(checkpoint["q_network"])
         self.target_network.load_state_dict(checkpoint["target_network"])
         self.optimizer.load_state_dict(checkpoint["optimizer"])
         self.epsilon = checkpoint["epsilon"]
         self.training_step = checkpoint["training_step"]
+        if self.actor_mirror is not None:
+            self.actor_mirror.load_from(self.q_network)
+
+
+def sample_policy_states(config: Dict, num_states: int, agent: Optional[DQNAgent] = None,
+                         epsilon: float = 0.2, seed: int = 0) -> np.ndarray:
+    """
+    Lấy mẫu states thực tế (dùng để hiệu chỉnh / kiểm tra export) bằng
+    VectorMicrogridEnv: action của agent (epsilon-greedy) hoặc ngẫu nhiên.
+    
+    Returns:
+        float32 array shape (num_states, state_dim)
+    """
+    num_envs = min(1024, num_states)
+    env = VectorMicrogridEnv(config, num_envs, seed=seed)
+    rng = np.random.default_rng(seed)
+    states = np.empty((num_states, config["state_dim"]), dtype=np.float32)
+    obs = env.reset()
+    for start in range(0, num_states, num_envs):
+        n = min(num_envs, num_states - start)
+        states[start:start + n] = obs[:n]
+        actions = rng.integers(config["action_dim"], size=num_envs)
+        if agent is not None:
+            greedy = agent.act(obs.astype(np.float32), training=False)
+            actions = np.where(rng.random(num_envs) < epsilon, actions, greedy)
+        obs, _, _, _ = env.step(actions)
+    return states
 
-print("✅ DQNAgent class defined!")
+print("✅ DQNAgent class & sample_policy_states defined!")
 
 #@title 6️⃣ Training Function
 """
@@ -934,7 +2520,258 @@ Implements the main training procedure with:
 ================================================================================
 """
 
-def train(config: Dict, device: torch.device) -> Dict[str, List]:
+class TrainScheduler:
+    """
+    Lịch cập nhật: sau warmup_steps env-steps, cứ train_every env-steps thì
+    chạy updates_per_train bước gradient (replay ratio = updates_per_train / train_every).
+    """
+    
+    def __init__(self, config: Dict):
+        self.train_every = config["train_every"]
+        self.updates_per_train = config["updates_per_train"]
+        self.warmup_steps = config["warmup_steps"]
+        self.env_steps = 0
+    
+    def step(self) -> int:
+        """Ghi nhận một env-step, trả về số bước gradient cần chạy ngay (0 nếu chưa tới lượt)."""
+        self.env_steps += 1
+        if self.env_steps <= self.warmup_steps or self.env_steps % self.train_every:
+            return 0
+        return self.updates_per_train
+
+
+def _clone_tensors(obj):
+    """Bản sao của state lồng nhau (dict/list/tuple), mọi tensor được clone."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {key: _clone_tensors(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_clone_tensors(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    """
+    Ghi checkpoint ở background thread.
+    
+    submit() chỉ clone tensors (copy-on-snapshot, ngay trên device) rồi đưa
+    vào queue; thread ghi torch.save vào file tạm rồi os.replace (atomic, không
+    bao giờ để lại checkpoint ghi dở). Giữ keep_last checkpoint mới nhất và
+    keep_best checkpoint có score cao nhất, xóa phần còn lại. Checkpoint
+    không force cách nhau ít nhất min_interval giây. Score được ghi kèm trong
+    file ("score") để restore() dựng lại danh sách retention khi resume.
+    """
+    
+    def __init__(self, directory: str, keep_last: int = 3, keep_best: int = 3,
+                 min_interval: float = 0.0, best_path: Optional[str] = None):
+        """
+        Args:
+            directory: Thư mục chứa checkpoint
+            keep_last: Số checkpoint mới nhất giữ lại
+            keep_best: Số checkpoint score cao nhất giữ lại
+            min_interval: Khoảng cách tối thiểu (giây) giữa hai lần submit không force
+            best_path: Nếu có, luôn chứa bản sao checkpoint có score cao nhất
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.min_interval = min_interval
+        self.best_path = best_path
+        self.best_score = float("-inf")
+        self.written = []  # [(path, score)] theo thứ tự ghi, chỉ các file còn giữ
+        
+        # Thống kê: stall = thời gian training loop bị chặn trong submit()
+        self.stall_seconds = 0.0
+        self.write_seconds = 0.0
+        self.num_written = 0
+        self.num_throttled = 0
+        
+        self._last_submit = float("-inf")
+        self._error = None
+        self._queue = queue.Queue(maxsize=2)  # Đầy -> submit() chờ (giới hạn bộ nhớ snapshot)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def submit(self, agent, tag: str, score: Optional[float] = None, force: bool = False) -> bool:
+        """
+        Snapshot agent.state_dict() và xếp lịch ghi vào directory/<tag>.pt.
+        
+        Returns:
+            False nếu bị throttle (chưa đủ min_interval kể từ lần submit trước)
+        """
+        if self._error is not None:
+            raise RuntimeError("checkpoint writer failed") from self._error
+        start = time.perf_counter()
+        if not force and start - self._last_submit < self.min_interval:
+            self.num_throttled += 1
+            return False
+        self._last_submit = start
+        snapshot = _clone_tensors(agent.state_dict())
+        snapshot["score"] = score
+        self._queue.put((tag, score, snapshot))
+        self.stall_seconds += time.perf_counter() - start
+        return True
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                try:
+                    start = time.perf_counter()
+                    self._write(*item)
+                    self.write_seconds += time.perf_counter() - start
+                    self.num_written += 1
+                except Exception as e:  # Báo lại ở submit()/close()
+                    self._error = e
+    
+    def _write(self, tag: str, score: Optional[float], snapshot: Dict):
+        path = os.path.join(self.directory, f"{tag}.pt")
+        _atomic_torch_save(snapshot, path)
+        self.written = [(p, s) for p, s in self.written if p != path] + [(path, score)]
+        
+        if score is not None and score > self.best_score:
+            self.best_score = score
+            if self.best_path is not None:
+                tmp_path = self.best_path + ".tmp"
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, self.best_path)
+        
+        # Retention: keep_last mới nhất ∪ keep_best score cao nhất
+        keep = {p for p, _ in self.written[-self.keep_last:]} if self.keep_last > 0 else set()
+        scored = sorted((w for w in self.written if w[1] is not None), key=lambda w: w[1], reverse=True)
+        keep.update(p for p, _ in scored[:self.keep_best])
+        for p, _ in self.written:
+            if p not in keep:
+                os.remove(p)
+        self.written = [w for w in self.written if w[0] in keep]
+    
+    def restore(self):
+        """
+        Dựng lại written từ các checkpoint đã có trong directory (khi resume),
+        để keep_last/keep_best tiếp tục xóa cả các file ghi trước khi bị ngắt.
+        Gọi trước submit() đầu tiên. Tag zero-padded nên thứ tự tên = thứ tự ghi.
+        """
+        written = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".pt"):
+                path = os.path.join(self.directory, name)
+                score = torch.load(path, map_location="cpu").get("score")
+                written.append((path, score))
+        self.written = written
+    
+    def close(self):
+        """Chờ ghi xong mọi checkpoint đang chờ rồi dừng thread."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError("checkpoint writer failed") from self._error
+    
+    def summary(self) -> str:
+        return (f"{self.num_written} written, {self.num_throttled} throttled | "
+                f"loop stall {self.stall_seconds:.2f}s | background write {self.write_seconds:.2f}s")
+
+
+def make_training_metrics(config: Dict) -> MetricsLogger:
+    """MetricsLogger theo episode của train()/train_distributed() (đọc bởi plot_results)."""
+    return MetricsLogger(["reward", "cost", "renewable_ratio", "epsilon", "loss"],
+                         window=config["metrics_window"], ema_alpha=config["metrics_ema_alpha"],
+                         max_points=config["metrics_max_points"], path=config["metrics_path"],
+                         flush_every=config["metrics_flush_every"])
+
+
+def save_run_state(directory: str, episode: int, agent, env: MicrogridEnv,
+                   scheduler: TrainScheduler, metrics: MetricsLogger, best_reward: float):
+    """
+    Ghi snapshot để train() tiếp tục y hệt (bit-identical) sau khi bị ngắt.
+    
+    directory/episode_<N>/ gồm agent.pt (networks, optimizer, global torch RNG
+    của dropout), replay_*.npy (đọc lại bằng memory map) và state.json (RNG
+    của agent/replay/env, scheduler, metrics). Snapshot
+    được ghi vào thư mục tạm rồi os.replace; file LATEST (cũng thay atomic)
+    trỏ tới snapshot mới nhất, các snapshot cũ bị xóa.
+    
+    Args:
+        directory: Thư mục run state (CONFIG["run_state_dir"])
+        episode: Số episode đã xong
+        agent, env, scheduler: Đối tượng đang train
+        metrics: MetricsLogger của train()
+        best_reward: Reward episode tốt nhất đã ghi checkpoint
+    """
+    name = f"episode_{episode:05d}"
+    snapshot_dir = os.path.join(directory, name)
+    tmp_dir = snapshot_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    
+    checkpoint = {"agent": agent.state_dict(), "torch_rng": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        checkpoint["cuda_rng"] = torch.cuda.get_rng_state_all()
+    torch.save(checkpoint, os.path.join(tmp_dir, "agent.pt"))
+    if agent.actor_mirror is not None:  # Mirror chỉ đồng bộ mỗi actor_refresh_every updates
+        np.savez(os.path.join(tmp_dir, "actor_mirror.npz"),
+                 *agent.actor_mirror.weights, *agent.actor_mirror.biases)
+    state = {
+        "episode": episode,
+        "best_reward": best_reward,
+        "metrics": metrics.state_dict(),
+        "agent_rng": agent.rng.bit_generator.state,
+        "loss_stats": agent.loss_stats.state_dict(),
+        "replay": agent.replay_buffer.save(tmp_dir),
+        "env_rng": env.rng.bit_generator.state,
+        "scheduler_env_steps": scheduler.env_steps,
+    }
+    with open(os.path.join(tmp_dir, "state.json"), "w") as f:
+        json.dump(state, f, default=float)
+    
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(tmp_dir, snapshot_dir)
+    with open(os.path.join(directory, "LATEST.tmp"), "w") as f:
+        f.write(name)
+    os.replace(os.path.join(directory, "LATEST.tmp"), os.path.join(directory, "LATEST"))
+    for entry in os.listdir(directory):
+        if entry.startswith("episode_") and entry != name:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def load_run_state(directory: str, agent, env: MicrogridEnv, scheduler: TrainScheduler,
+                   metrics: MetricsLogger):
+    """
+    Khôi phục snapshot mới nhất của save_run_state() vào agent/env/scheduler/
+    metrics vừa tạo bằng cùng config.
+    
+    Returns:
+        (episode đã xong, best_reward)
+    """
+    with open(os.path.join(directory, "LATEST")) as f:
+        snapshot_dir = os.path.join(directory, f.read().strip())
+    with open(os.path.join(snapshot_dir, "state.json")) as f:
+        state = json.load(f)
+    
+    checkpoint = torch.load(os.path.join(snapshot_dir, "agent.pt"), map_location=agent.device)
+    agent.load_state_dict(checkpoint["agent"])
+    torch.set_rng_state(checkpoint["torch_rng"].cpu())
+    if "cuda_rng" in checkpoint and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in checkpoint["cuda_rng"]])
+    if agent.actor_mirror is not None:
+        arrays = np.load(os.path.join(snapshot_dir, "actor_mirror.npz"))
+        for i, target in enumerate(agent.actor_mirror.weights + agent.actor_mirror.biases):
+            np.copyto(target, arrays[f"arr_{i}"])
+    agent.rng.bit_generator.state = state["agent_rng"]
+    agent.loss_stats.load_state_dict(state["loss_stats"])
+    metrics.load_state_dict(state["metrics"])
+    agent.replay_buffer.load(snapshot_dir, state["replay"])
+    
+    # Env: episode tiếp theo lấy tiếp noise từ đúng vị trí trong luồng của env
+    env.rng.bit_generator.state = state["env_rng"]
+    scheduler.env_steps = state["scheduler_env_steps"]
+    return state["episode"], state["best_reward"]
+
+
+def train(config: Dict, device: torch.device, resume_from: Optional[str] = None) -> Dict[str, List]:
     """
     Train the DQN agent.
     Huấn luyện agent DQN.
@@ -942,53 +2779,68 @@ def train(config: Dict, device: torch.device) -> Dict[str, List]:
     Args:
         config: Configuration dictionary
         device: torch.device
+        resume_from: Thư mục run state (save_run_state) để tiếp tục training;
+                     kết quả giống hệt một lần chạy không bị ngắt
         
     Returns:
-        Training history dictionary
+        Training history: {"metrics": MetricsLogger, "phase_seconds": {...}}
     """
     
     print("=" * 60)
     print("🚀 STARTING TRAINING")
     print("=" * 60)
     
-    # Set random seeds for reproducibility
-    seed = config["seed"]
-    random.seed(seed)
-    np.random.seed(seed)
-    torch.manual_seed(seed)
+    # Seed tree for reproducibility - Cây seed: mỗi thành phần một luồng riêng
+    root_seq = np.random.SeedSequence(config["seed"])
+    env_seq, agent_seq, dropout_seq = root_seq.spawn(3)
+    # Dropout masks dùng global torch RNG (mỗi process một bản)
+    torch.manual_seed(int(dropout_seq.generate_state(1)[0]))
     
     # Initialize environment and agent
-    env = MicrogridEnv(config)
-    agent = DQNAgent(config, device)
-    
-    # Training history
-    history = {
-        "rewards": [],
-        "costs": [],
-        "renewable_ratios": [],
-        "epsilons": [],
-        "losses": [],
-    }
+    env = MicrogridEnv(config, seed=env_seq, record_history=False)
+    agent = DQNAgent(config, device, seed=agent_seq)
+    scheduler = TrainScheduler(config)
+    timer = agent.timer
+    checkpoints = CheckpointWriter(config["checkpoint_dir"], config["checkpoint_keep_last"],
+                                   config["checkpoint_keep_best"], config["checkpoint_min_interval"],
+                                   best_path="best_model.pt")
+    
+    # Training history - streaming metrics, bộ nhớ cố định
+    metrics = make_training_metrics(config)
+    history = {"metrics": metrics}
     
     best_reward = float("-inf")
+    start_episode = 0
+    if resume_from is not None:
+        start = time.perf_counter()
+        start_episode, best_reward = load_run_state(resume_from, agent, env, scheduler, metrics)
+        checkpoints.best_score = best_reward
+        checkpoints.restore()
+        print(f"⏩ Resumed from {resume_from} at episode {start_episode} "
+              f"({len(agent.replay_buffer):,} transitions, {time.perf_counter() - start:.2f}s)")
     
     # Training loop
-    for episode in range(config["num_episodes"]):
-        state = env.reset(seed=seed + episode)
+    for episode in range(start_episode, config["num_episodes"]):
+        state = env.reset()  # Episode mới: ngày mới lấy tiếp từ Generator của env
+        agent.begin_episode()
         episode_reward = 0
         episode_losses = []
         
         for step in range(config["max_steps_per_episode"]):
             # Select and execute action
-            action = agent.select_action(state, training=True)
-            next_state, reward, done, info = env.step(action)
-            
-            # Store and learn
-            agent.store_transition(state, action, reward, next_state, done)
-            loss = agent.update()
+            with timer("act"):
+                action = agent.select_action(state, training=True)
+            with timer("env"):
+                next_state, reward, done, info = env.step(action)
             
-            if loss is not None:
-                episode_losses.append(loss)
+            # Store and learn (theo TrainScheduler)
+            with timer("store"):
+                agent.store_transition(state, action, reward, next_state, done)
+            num_updates = scheduler.step()
+            if num_updates:
+                loss = agent.update(num_updates)
+                if loss is not None:
+                    episode_losses.append(loss)
             
             state = next_state
             episode_reward += reward
@@ -1000,17 +2852,27 @@ def train(config: Dict, device: torch.device) -> Dict[str, List]:
         agent.decay_epsilon()
         
         # Store history
-        history["rewards"].append(episode_reward)
-        history["costs"].append(info["total_cost"])
-        history["renewable_ratios"].append(info["renewable_ratio"])
-        history["epsilons"].append(agent.epsilon)
+        record = {"reward": episode_reward, "cost": info["total_cost"],
+                  "renewable_ratio": info["renewable_ratio"], "epsilon": agent.epsilon}
         if episode_losses:
-            history["losses"].append(np.mean(episode_losses))
+            record["loss"] = np.mean(episode_losses)
+        metrics.log(**record)
         
-        # Track best
-        if episode_reward > best_reward:
-            best_reward = episode_reward
-            agent.save("best_model.pt")
+        # Track best + checkpoint (background thread; định kỳ save_freq thì luôn ghi).
+        # best_reward chỉ tăng khi checkpoint được nhận (không bị throttle), để
+        # best_model.pt luôn khớp với best reward báo cáo
+        is_best = episode_reward > best_reward
+        periodic = (episode + 1) % config["save_freq"] == 0
+        if is_best or periodic:
+            with timer("checkpoint"):
+                accepted = checkpoints.submit(agent, f"episode_{episode + 1:05d}", score=episode_reward,
+                                              force=periodic)
+            if is_best and accepted:
+                best_reward = episode_reward
+        if periodic:
+            with timer("run_state"):
+                save_run_state(config["run_state_dir"], episode + 1, agent, env, scheduler,
+                               metrics, best_reward)
         
         # Logging
         if (episode + 1) % config["log_freq"] == 0:
@@ -1021,14 +2883,233 @@ def train(config: Dict, device: torch.device) -> Dict[str, List]:
                   f"ε: {agent.epsilon:.3f}")
     
     # Save final model
+    checkpoints.close()
     agent.save("final_model.pt")
+    if agent.actor_mirror is not None:  # Evaluation/export sau train phải thấy weights mới nhất
+        agent.actor_mirror.load_from(agent.q_network)
+    if metrics.path is not None:
+        metrics.flush()
     
     print("=" * 60)
     print(f"✅ Training complete! Best reward: {best_reward:.2f}")
+    print(f"⏱️ {timer.summary()}")
+    print(f"💾 Checkpoints: {checkpoints.summary()}")
     print("=" * 60)
+    history["phase_seconds"] = dict(timer.seconds)
     
     return history, agent, env
 
+
+def _actor_epsilons(config: Dict, num_actors: int) -> np.ndarray:
+    """Epsilon cố định của từng actor (Ape-X): từ base xuống base^(1 + alpha)."""
+    exponents = 1 + config["actor_epsilon_alpha"] * np.arange(num_actors) / max(1, num_actors - 1)
+    return config["actor_epsilon_base"] ** exponents
+
+
+def _run_actor(actor_id: int, config: Dict, seed_seq: np.random.SeedSequence, epsilon: float,
+               replay: SharedReplayBuffer, shared_weights: np.ndarray, weights_version,
+               weights_lock, env_steps, episode_queue, stop_event):
+    """
+    Vòng lặp của một actor process: chạy MicrogridEnv với epsilon riêng,
+    gom transitions (qua NStepCollector) rồi ghi theo chunk vào shared buffer,
+    định kỳ kéo q_network mới nhất từ learner.
+    """
+    torch.set_num_threads(1)  # Mỗi actor một core
+    env_seq, action_seq = seed_seq.spawn(2)
+    env = MicrogridEnv(config, seed=env_seq, record_history=False)
+    rng = np.random.default_rng(action_seq)
+    q_network = QNetwork(config["state_dim"], config["action_dim"], config["hidden_dims"])
+    q_network.eval()  # Chọn action không Dropout, như _greedy_actions / NumpyQNetwork
+    collector = NStepCollector(config["n_step"], config["gamma"])
+    local_version = -1
+    pending = []
+    steps = 0
+    
+    while not stop_event.is_set():
+        state = env.reset()
+        collector.reset()
+        episode_reward = 0.0
+        done = False
+        for _ in range(config["max_steps_per_episode"]):
+            # Kéo weights mới từ learner
+            if steps % config["actor_sync_every"] == 0 and weights_version.value != local_version:
+                with weights_lock:
+                    flat = torch.from_numpy(shared_weights.copy())
+                    local_version = weights_version.value
+                torch.nn.utils.vector_to_parameters(flat, q_network.parameters())
+            
+            if rng.random() < epsilon:
+                action = int(rng.integers(config["action_dim"]))
+            else:
+                with torch.no_grad():
+                    action = q_network(torch.FloatTensor(state).unsqueeze(0)).argmax(dim=1).item()
+            next_state, reward, done, info = env.step(action)
+            
+            pending.extend(collector.push(state, action, reward, next_state, done))
+            if len(pending) >= config["actor_push_chunk"]:
+                replay.push_batch(*[np.array(column) for column in zip(*pending)])
+                pending.clear()
+            
+            steps += 1
+            env_steps[actor_id] = steps
+            state = next_state
+            episode_reward += reward
+            if done or stop_event.is_set():
+                break
+        if done:
+            episode_queue.put((actor_id, episode_reward, info["total_cost"], info["renewable_ratio"]))
+    
+    if pending:
+        replay.push_batch(*[np.array(column) for column in zip(*pending)])
+    episode_queue.cancel_join_thread()  # Không chờ learner đọc hết queue khi thoát
+
+
+def train_distributed(config: Dict, device: torch.device, num_actors: Optional[int] = None,
+                      num_updates: Optional[int] = None, duration: Optional[float] = None,
+                      verbose: bool = True):
+    """
+    Train the DQN agent with K actor processes and one learner.
+    Huấn luyện DQN phân tán: K actor process thu thập, learner (process hiện
+    tại) chạy update() liên tục. Chỉ dùng multiprocessing (fork) + shared
+    memory trên một máy Linux.
+    
+    Args:
+        config: Configuration dictionary
+        device: torch.device của learner (actors chạy CPU)
+        num_actors: Số actor (mặc định: config["num_actors"])
+        num_updates: Số bước gradient (mặc định: num_episodes * max_steps_per_episode,
+                     bằng ngân sách của train() tuần tự)
+        duration: Giới hạn wall-clock (giây), tùy chọn
+        verbose: In log training
+        
+    Returns:
+        (history, agent, env) như train(); history["throughput"] chứa
+        env-steps/s và gradient-steps/s
+    """
+    if config["prioritized_replay"] or config["replay_storage"] != "numpy":
+        raise ValueError("train_distributed requires uniform replay with replay_storage='numpy'")
+    num_actors = num_actors if num_actors is not None else config["num_actors"]
+    if num_updates is None:
+        num_updates = config["num_episodes"] * config["max_steps_per_episode"]
+    ctx = mp.get_context("fork")
+    
+    if verbose:
+        print("=" * 60)
+        print(f"🚀 STARTING DISTRIBUTED TRAINING ({num_actors} actors + 1 learner)")
+        print("=" * 60)
+    
+    # Seed tree - actors, learner agent, dropout, env trả về cho evaluation
+    root_seq = np.random.SeedSequence(config["seed"])
+    actors_seq, agent_seq, dropout_seq, env_seq = root_seq.spawn(4)
+    torch.manual_seed(int(dropout_seq.generate_state(1)[0]))
+    
+    agent = DQNAgent(config, device, seed=agent_seq)
+    agent.replay_buffer = SharedReplayBuffer(config["buffer_size"], config["state_dim"],
+                                             ctx=ctx, rng=agent.replay_buffer.rng)
+    
+    # Shared weights: vector phẳng các tham số q_network + số phiên bản
+    num_params = sum(p.numel() for p in agent.q_network.parameters())
+    shared_weights = np.frombuffer(ctx.RawArray("f", num_params), dtype=np.float32)
+    weights_version = ctx.RawValue("q", 0)
+    weights_lock = ctx.Lock()
+    
+    def publish_weights():
+        flat = torch.nn.utils.parameters_to_vector(agent.q_network.parameters())
+        with weights_lock:
+            shared_weights[:] = flat.detach().cpu().numpy()
+            weights_version.value += 1
+    
+    publish_weights()
+    epsilons = _actor_epsilons(config, num_actors)
+    env_steps = ctx.RawArray("q", num_actors)
+    episode_queue = ctx.Queue()
+    stop_event = ctx.Event()
+    actors = [
+        ctx.Process(target=_run_actor, daemon=True, args=(
+            i, config, actor_seq, float(epsilons[i]), agent.replay_buffer, shared_weights,
+            weights_version, weights_lock, env_steps, episode_queue, stop_event))
+        for i, actor_seq in enumerate(actors_seq.spawn(num_actors))
+    ]
+    for actor in actors:
+        actor.start()
+    
+    metrics = make_training_metrics(config)
+    history = {"metrics": metrics}
+    best_reward = float("-inf")
+    checkpoints = CheckpointWriter(config["checkpoint_dir"], config["checkpoint_keep_last"],
+                                   config["checkpoint_keep_best"], config["checkpoint_min_interval"],
+                                   best_path="best_model.pt")
+    
+    def drain_episodes():
+        nonlocal best_reward
+        while True:
+            try:
+                actor_id, episode_reward, cost, renewable_ratio = episode_queue.get_nowait()
+            except queue.Empty:
+                return
+            record = {"reward": episode_reward, "cost": cost,
+                      "renewable_ratio": renewable_ratio, "epsilon": epsilons[actor_id]}
+            if agent.loss_stats.count:  # Loss của learner (EMA) lúc nhận episode
+                record["loss"] = agent.loss_stats.ema
+            metrics.log(**record)
+            if episode_reward > best_reward and checkpoints.submit(
+                    agent, f"episode_{metrics.num_records:05d}", score=episode_reward):
+                best_reward = episode_reward  # Chỉ khi được ghi: best_model.pt khớp best_reward
+            if verbose and metrics.num_records % config["log_freq"] == 0:
+                recent = metrics["reward"].recent(config["log_freq"])
+                print(f"Episode {metrics.num_records:5d} | "
+                      f"Avg Reward: {np.mean(recent):7.2f} | "
+                      f"Updates: {agent.training_step:6d} | "
+                      f"Env-steps: {sum(env_steps):8,d}")
+    
+    # Learner loop
+    start = time.perf_counter()
+    try:
+        while agent.training_step < num_updates:
+            if duration is not None and time.perf_counter() - start >= duration:
+                break
+            loss = agent.update()
+            if loss is None:  # Chờ actors lấp đủ một batch
+                time.sleep(0.01)
+            elif agent.training_step % config["learner_publish_every"] == 0:
+                publish_weights()
+            if agent.training_step % 50 == 0:
+                drain_episodes()
+    finally:
+        elapsed = time.perf_counter() - start
+        total_env_steps = sum(env_steps)
+        stop_event.set()
+        for actor in actors:
+            actor.join(timeout=10)
+            if actor.is_alive():
+                actor.terminate()
+        drain_episodes()
+        checkpoints.close()
+    
+    if metrics.path is not None:
+        metrics.flush()
+    history["throughput"] = {
+        "num_actors": num_actors,
+        "seconds": elapsed,
+        "env_steps": total_env_steps,
+        "gradient_steps": agent.training_step,
+        "env_steps_per_sec": total_env_steps / elapsed,
+        "gradient_steps_per_sec": agent.training_step / elapsed,
+    }
+    agent.save("final_model.pt")
+    if agent.actor_mirror is not None:  # Evaluation/export sau train phải thấy weights mới nhất
+        agent.actor_mirror.load_from(agent.q_network)
+    
+    if verbose:
+        print("=" * 60)
+        print(f"✅ Distributed training complete! Best reward: {best_reward:.2f}")
+        print(f"⚡ {history['throughput']['env_steps_per_sec']:,.0f} env-steps/s | "
+              f"{history['throughput']['gradient_steps_per_sec']:,.0f} gradient-steps/s")
+        print(f"💾 Checkpoints: {checkpoints.summary()}")
+        print("=" * 60)
+    
+    return history, agent, MicrogridEnv(config, seed=env_seq, record_history=False)
+
 #@title 7️⃣ Evaluation Functions
 """
 ================================================================================
@@ -1047,15 +3128,19 @@ def evaluate_agent(agent: DQNAgent, env: MicrogridEnv,
     """
     Evaluate trained agent.
     Đánh giá agent đã huấn luyện.
+    
+    Episode thứ ep dùng luồng con SeedSequence(seed).spawn(num_episodes)[ep],
+    nên mỗi episode có thể chạy độc lập (song song) mà vẫn cho kết quả y hệt.
     """
     
     rewards = []
     costs = []
     renewable_ratios = []
     unmet_ratios = []
+    episode_seqs = np.random.SeedSequence(seed).spawn(num_episodes)
     
     for ep in range(num_episodes):
-        state = env.reset(seed=seed + ep)
+        state = env.reset(seed=episode_seqs[ep])
         episode_reward = 0
         
         while True:
@@ -1084,19 +3169,23 @@ def evaluate_random(env: MicrogridEnv, num_episodes: int = 20, seed: int = 42) -
     """
     Evaluate random baseline.
     Đánh giá baseline ngẫu nhiên.
+    
+    Dùng cùng các episode như evaluate_agent (cùng seed) để so sánh công bằng.
     """
     
     rewards = []
     costs = []
     renewable_ratios = []
     unmet_ratios = []
+    episode_seqs = np.random.SeedSequence(seed).spawn(num_episodes + 1)
+    policy_rng = np.random.default_rng(episode_seqs[-1])
     
     for ep in range(num_episodes):
-        state = env.reset(seed=seed + ep)
+        state = env.reset(seed=episode_seqs[ep])
         episode_reward = 0
         
         while True:
-            action = random.randint(0, 4)
+            action = int(policy_rng.integers(5))
             next_state, reward, done, info = env.step(action)
             episode_reward += reward
             state = next_state
@@ -1117,22 +3206,34 @@ def evaluate_random(env: MicrogridEnv, num_episodes: int = 20, seed: int = 42) -
     }
 
 
+def _plot_aggregates(ax, metrics: MetricsLogger, name: str, color: str, smooth_color: str,
+                     scale: float = 1.0):
+    """
+    Vẽ chuỗi đã downsample của một metric: dải min-max mỗi bucket, mean
+    mỗi bucket (mờ) và EMA (đường làm mượt).
+    """
+    agg = metrics.aggregates(name)
+    label = "Raw" if metrics.bucket_size == 1 else f"Mean / {metrics.bucket_size} ep"
+    if metrics.bucket_size > 1:
+        ax.fill_between(agg["step"], agg["min"] * scale, agg["max"] * scale, color=color, alpha=0.15)
+    ax.plot(agg["step"], agg["mean"] * scale, color=color, alpha=0.4, label=label)
+    ax.plot(agg["step"], agg["ema"] * scale, color=smooth_color, linewidth=2, label="Smoothed (EMA)")
+
+
 def plot_results(history: Dict):
     """
     Generate training visualization plots.
-    Tạo biểu đồ trực quan hóa training.
+    Tạo biểu đồ trực quan hóa training từ các aggregate của
+    history["metrics"] (MetricsLogger), không cần chuỗi raw từng episode.
     """
+    metrics = history["metrics"]
     
     fig, axes = plt.subplots(2, 2, figsize=(14, 10))
     fig.suptitle("🔋 DQN Training Results for Microgrid Optimization", fontsize=14, fontweight='bold')
     
     # Reward curve
     ax = axes[0, 0]
-    rewards = history["rewards"]
-    ax.plot(rewards, alpha=0.4, label="Raw")
-    if len(rewards) >= 20:
-        smoothed = np.convolve(rewards, np.ones(20)/20, mode='valid')
-        ax.plot(range(19, len(rewards)), smoothed, linewidth=2, label="Smoothed (MA20)")
+    _plot_aggregates(ax, metrics, "reward", "tab:blue", "tab:orange")
     ax.axhline(y=0, color='gray', linestyle='--', alpha=0.5)
     ax.set_xlabel("Episode")
     ax.set_ylabel("Episode Reward")
@@ -1142,11 +3243,7 @@ def plot_results(history: Dict):
     
     # Cost curve
     ax = axes[0, 1]
-    costs = history["costs"]
-    ax.plot(costs, alpha=0.4, color='orange', label="Raw")
-    if len(costs) >= 20:
-        smoothed = np.convolve(costs, np.ones(20)/20, mode='valid')
-        ax.plot(range(19, len(costs)), smoothed, linewidth=2, color='red', label="Smoothed")
+    _plot_aggregates(ax, metrics, "cost", "orange", "red")
     ax.set_xlabel("Episode")
     ax.set_ylabel("Daily Grid Cost ($)")
     ax.set_title("Grid Electricity Cost")
@@ -1155,11 +3252,7 @@ def plot_results(history: Dict):
     
     # Renewable ratio
     ax = axes[1, 0]
-    ratios = [r * 100 for r in history["renewable_ratios"]]
-    ax.plot(ratios, alpha=0.4, color='green', label="Raw")
-    if len(ratios) >= 20:
-        smoothed = np.convolve(ratios, np.ones(20)/20, mode='valid')
-        ax.plot(range(19, len(ratios)), smoothed, linewidth=2, color='darkgreen', label="Smoothed")
+    _plot_aggregates(ax, metrics, "renewable_ratio", "green", "darkgreen", scale=100)
     ax.set_xlabel("Episode")
     ax.set_ylabel("Renewable Usage (%)")
     ax.set_title("Renewable Energy Utilization")
@@ -1168,7 +3261,8 @@ def plot_results(history: Dict):
     
     # Epsilon decay
     ax = axes[1, 1]
-    ax.plot(history["epsilons"], color='purple', linewidth=2)
+    epsilon = metrics.aggregates("epsilon")
+    ax.plot(epsilon["step"], epsilon["mean"], color='purple', linewidth=2)
     ax.set_xlabel("Episode")
     ax.set_ylabel("Epsilon (ε)")
     ax.set_title("Exploration Rate Decay")
@@ -1186,21 +3280,21 @@ def plot_episode_analysis(env: MicrogridEnv):
     Phân tích hành vi trong một episode.
     """
     
-    if not env.episode_history:
-        print("No episode history to plot!")
+    history = env.episode_history
+    if len(history) == 0:
+        print("No episode history to plot! (record_history=True?)")
         return
     
-    history = env.episode_history
-    hours = [h["hour"] for h in history]
+    hours = history["hour"]
     
     fig, axes = plt.subplots(2, 2, figsize=(14, 10))
     fig.suptitle("🔋 24-Hour Episode Analysis", fontsize=14, fontweight='bold')
     
     # Energy balance
     ax = axes[0, 0]
-    ax.bar(hours, [h["demand"] for h in history], alpha=0.5, label="Demand", color='red')
-    ax.bar(hours, [h["solar"] for h in history], alpha=0.7, label="Solar", color='gold')
-    ax.bar(hours, [h["wind"] for h in history], alpha=0.7, bottom=[h["solar"] for h in history], 
+    ax.bar(hours, history["demand"], alpha=0.5, label="Demand", color='red')
+    ax.bar(hours, history["solar"], alpha=0.7, label="Solar", color='gold')
+    ax.bar(hours, history["wind"], alpha=0.7, bottom=history["solar"], 
            label="Wind", color='skyblue')
     ax.set_xlabel("Hour")
     ax.set_ylabel("Power (kW)")
@@ -1210,7 +3304,7 @@ def plot_episode_analysis(env: MicrogridEnv):
     
     # Battery level
     ax = axes[0, 1]
-    ax.plot(hours, [h["battery_level"] for h in history], 'b-', linewidth=2, marker='o', markersize=4)
+    ax.plot(hours, history["battery_level"], 'b-', linewidth=2, marker='o', markersize=4)
     ax.axhline(y=100, color='gray', linestyle='--', alpha=0.5, label="Max Capacity")
     ax.set_xlabel("Hour")
     ax.set_ylabel("Battery Level (kWh)")
@@ -1222,10 +3316,8 @@ def plot_episode_analysis(env: MicrogridEnv):
     # Actions taken
     ax = axes[1, 0]
     action_names = ["Discharge", "Charge", "Grid", "Renew+Disch", "Renew+Grid"]
-    actions = [h["action"] for h in history]
     colors = ['red', 'green', 'orange', 'blue', 'purple']
-    for i, h in enumerate(history):
-        ax.bar(h["hour"], 1, bottom=0, color=colors[h["action"]], alpha=0.7)
+    ax.bar(hours, 1, bottom=0, color=np.array(colors)[history["action"]], alpha=0.7)
     ax.set_xlabel("Hour")
     ax.set_ylabel("Action")
     ax.set_title("Actions Taken by Agent")
@@ -1236,7 +3328,7 @@ def plot_episode_analysis(env: MicrogridEnv):
     
     # Cumulative reward
     ax = axes[1, 1]
-    cumulative = np.cumsum([h["reward"] for h in history])
+    cumulative = np.cumsum(history["reward"])
     ax.plot(hours, cumulative, 'g-', linewidth=2, marker='o', markersize=4)
     ax.fill_between(hours, cumulative, alpha=0.3, color='green')
     ax.set_xlabel("Hour")
@@ -1262,8 +3354,16 @@ Chạy cell này để huấn luyện và đánh giá agent DQN!
 ================================================================================
 """
 
-# Train the agent
-history, agent, env = train(CONFIG, device)
+# Tiếp tục từ run state đã lưu (CONFIG["run_state_dir"]) nếu có, vd. sau khi Colab ngắt kết nối
+RESUME_TRAINING = False  #@param {type:"boolean"}
+
+# Train the agent (tuần tự hoặc actor-learner nếu CONFIG["num_actors"] > 0)
+if CONFIG["num_actors"] > 0:
+    history, agent, env = train_distributed(CONFIG, device)
+else:
+    resume_from = CONFIG["run_state_dir"] if RESUME_TRAINING and os.path.exists(
+        os.path.join(CONFIG["run_state_dir"], "LATEST")) else None
+    history, agent, env = train(CONFIG, device, resume_from=resume_from)
 
 # Plot training results
 plot_results(history)
@@ -1287,11 +3387,25 @@ print(f"{'Renewable Usage (%)':<25} {agent_metrics['mean_renewable']*100:>14.1f}
 print(f"{'Unmet Demand (%)':<25} {agent_metrics['mean_unmet']*100:>14.1f}% {random_metrics['mean_unmet']*100:>14.1f}% "
       f"{(random_metrics['mean_unmet'] - agent_metrics['mean_unmet'])*100:>+10.1f}pp")
 
+# Export policy (quantized) cho inference trên CPU, kiểm tra với model float
+print("\n" + "=" * 60)
+print(f"📦 EXPORT POLICY ({CONFIG['export_quantization']})")
+print("=" * 60)
+calibration_states = sample_policy_states(CONFIG, CONFIG["export_calibration_states"], agent=agent, seed=1)
+validation_states = sample_policy_states(CONFIG, CONFIG["export_validation_states"], agent=agent, seed=2)
+exported_policy = export_policy(agent.q_network, CONFIG["export_path"], CONFIG["export_quantization"],
+                                calibration_states=calibration_states)
+export_check = action_agreement(agent.q_network, exported_policy, validation_states)
+print(f"   Action agreement vs float: {export_check['agreement'] * 100:.2f}% "
+      f"on {len(validation_states):,} states (max |ΔQ| {export_check['max_abs_q_diff']:.4f})")
+print(f"   Saved: {CONFIG['export_path']} ({os.path.getsize(CONFIG['export_path']) / 1024:.0f} KB)")
+
 # Run and analyze a demo episode
 print("\n" + "=" * 60)
 print("🎮 DEMO EPISODE")
 print("=" * 60)
 
+env.record_history = True  # Env training tắt history; bật lại cho demo & plot
 state = env.reset(seed=999)
 total_reward = 0
 
@@ -1326,6 +3440,733 @@ print("✅ ALL DONE!")
 print("=" * 60)
 print("\nFiles created:")
 print("  📁 best_model.pt - Best trained model weights")
+print(f"  📁 {CONFIG['checkpoint_dir']}/ - Last & best checkpoints (background writer)")
 print("  📁 final_model.pt - Final trained model weights")
+print(f"  📁 {CONFIG['export_path']} - Exported inference policy (TorchScript)")
 print("  📁 training_curves.png - Training visualization")
+print(f"  📁 {CONFIG['metrics_path']} - Downsampled training metrics")
 print("  📁 episode_analysis.png - 24-hour episode analysis")
+
+#@title 9️⃣ 🔬 Performance Benchmarks (Optional)
+"""
+================================================================================
+🔬 BENCHMARKS - Đo hiệu năng các thành phần
+================================================================================
+
+Đặt RUN_BENCHMARKS = True để chạy. Cell này chỉ cần các class/hàm ở cell 1-7,
+không cần chạy training (cell 8) trước.
+================================================================================
+"""
+
+RUN_BENCHMARKS = False  #@param {type:"boolean"}
+
+
+def benchmark_vector_env(config: Dict, num_envs_list=(1, 64, 1024, 4096),
+                         num_steps: int = 200, seed: int = 0) -> Dict[int, float]:
+    """
+    So sánh env-steps/sec giữa MicrogridEnv và VectorMicrogridEnv.
+    Đồng thời kiểm tra từng env của VectorMicrogridEnv khớp bit-for-bit với
+    MicrogridEnv dùng luồng seed con tương ứng và cùng chuỗi actions.
+    
+    Returns:
+        {num_envs: env-steps/sec}, key 0 = MicrogridEnv (scalar)
+    """
+    action_rng = np.random.default_rng(seed)
+    
+    # Parity check - Kiểm tra khớp kết quả
+    parity_envs = 4
+    actions = action_rng.integers(config["action_dim"], size=(num_steps * 5, parity_envs))
+    vector_env = VectorMicrogridEnv(config, num_envs=parity_envs, seed=seed)
+    vector_obs, vector_rewards = [vector_env.reset(seed=seed)], []
+    for step_actions in actions:
+        obs, reward, _, _ = vector_env.step(step_actions)
+        vector_obs.append(obs)
+        vector_rewards.append(reward)
+    for i, env_seq in enumerate(np.random.SeedSequence(seed).spawn(parity_envs)):
+        scalar_env = MicrogridEnv(config, seed=env_seq)
+        scalar_obs, scalar_rewards = [scalar_env.reset(seed=env_seq)], []
+        for action in actions[:, i]:
+            obs, reward, done, _ = scalar_env.step(int(action))
+            if done:
+                obs = scalar_env.reset()
+            scalar_obs.append(obs)
+            scalar_rewards.append(reward)
+        assert np.array_equal(scalar_obs, np.array(vector_obs)[:, i]), "VectorMicrogridEnv obs mismatch"
+        assert np.array_equal(scalar_rewards, np.array(vector_rewards)[:, i]), "VectorMicrogridEnv reward mismatch"
+    print(f"✅ VectorMicrogridEnv matches MicrogridEnv exactly (per-env seed streams, N={parity_envs})")
+    
+    actions = actions[:, 0]
+    results = {}
+    scalar_env.reset(seed=seed)
+    start = time.perf_counter()
+    for action in actions:
+        _, _, done, _ = scalar_env.step(int(action))
+        if done:
+            scalar_env.reset()
+    results[0] = len(actions) / (time.perf_counter() - start)
+    print(f"   {'MicrogridEnv':<26}: {results[0]:>12,.0f} env-steps/s")
+    
+    for num_envs in num_envs_list:
+        vector_env = VectorMicrogridEnv(config, num_envs=num_envs)
+        vector_env.reset(seed=seed)
+        batch_actions = action_rng.integers(config["action_dim"], size=(num_steps, num_envs))
+        start = time.perf_counter()
+        for step_actions in batch_actions:
+            vector_env.step(step_actions)
+        results[num_envs] = num_steps * num_envs / (time.perf_counter() - start)
+        label = f"VectorMicrogridEnv N={num_envs}"
+        print(f"   {label:<26}: {results[num_envs]:>12,.0f} env-steps/s")
+    
+    return results
+
+
+class _DequeReplayBuffer:
+    """Bản ReplayBuffer cũ (deque các tuple) - chỉ dùng làm mốc so sánh."""
+    
+    def __init__(self, capacity: int, rng: np.random.Generator):
+        self.buffer = deque(maxlen=capacity)
+        self.rng = rng
+    
+    def push(self, state, action, reward, next_state, done):
+        self.buffer.append((state, action, reward, next_state, done))
+    
+    def sample(self, batch_size: int):
+        indices = self.rng.choice(len(self.buffer), batch_size, replace=False)
+        batch = [self.buffer[i] for i in indices]
+        states, actions, rewards, next_states, dones = zip(*batch)
+        return (
+            torch.FloatTensor(np.array(states)),
+            torch.LongTensor(actions),
+            torch.FloatTensor(rewards),
+            torch.FloatTensor(np.array(next_states)),
+            torch.FloatTensor(dones),
+        )
+    
+    def __len__(self):
+        return len(self.buffer)
+
+
+def benchmark_replay_buffer(config: Dict, device: torch.device,
+                            batch_sizes=(64, 128, 256, 512, 1024),
+                            num_updates: int = 50, seed: int = 0) -> Dict[int, Tuple[float, float]]:
+    """
+    Đo độ trễ sample và sample + DQNAgent.update (ms) của ReplayBuffer cũ
+    (deque) và mới (ring buffer NumPy), cả hai chứa cùng buffer_size transitions.
+    
+    Returns:
+        {batch_size: (deque sample, numpy sample, deque update, numpy update)} ms
+    """
+    rng = np.random.default_rng(seed)
+    capacity = config["buffer_size"]
+    states = rng.random((capacity, config["state_dim"]), dtype=np.float32)
+    actions = rng.integers(config["action_dim"], size=capacity)
+    rewards = rng.normal(size=capacity).astype(np.float32)
+    next_states = rng.random((capacity, config["state_dim"]), dtype=np.float32)
+    dones = (rng.random(capacity) < 0.05).astype(np.float32)
+    
+    ring_buffer = ReplayBuffer(capacity, config["state_dim"], rng=np.random.default_rng(seed))
+    ring_buffer.push_batch(states, actions, rewards, next_states, dones)
+    deque_buffer = _DequeReplayBuffer(capacity, rng=np.random.default_rng(seed))
+    for transition in zip(states, actions.tolist(), rewards.tolist(), next_states, dones.tolist()):
+        deque_buffer.push(*transition)
+    
+    def per_call_ms(fn):
+        fn()  # Warm-up
+        start = time.perf_counter()
+        for _ in range(num_updates):
+            fn()
+        return (time.perf_counter() - start) / num_updates * 1000
+    
+    results = {}
+    for batch_size in batch_sizes:
+        sample_ms, update_ms = [], []
+        for buffer in (deque_buffer, ring_buffer):
+            agent = DQNAgent({**config, "batch_size": batch_size}, device, seed=seed)
+            agent.replay_buffer = buffer
+            sample_ms.append(per_call_ms(lambda: buffer.sample(batch_size)))
+            update_ms.append(per_call_ms(agent.update))
+        results[batch_size] = (*sample_ms, *update_ms)
+        label = f"batch_size={batch_size}"
+        print(f"   {label:<26}: sample deque {sample_ms[0]:>6.2f} / numpy {sample_ms[1]:>6.2f} ms "
+              f"({sample_ms[0] / sample_ms[1]:>4.1f}x) | sample+update deque {update_ms[0]:>6.2f} "
+              f"/ numpy {update_ms[1]:>6.2f} ms ({update_ms[0] / update_ms[1]:.1f}x)")
+    
+    return results
+
+
+def _episodes_to_target(config: Dict, device: torch.device, target_reward: float,
+                        max_episodes: int, eval_every: int, eval_episodes: int) -> Dict:
+    """
+    Train từ seed tree của config cho tới khi mean evaluation reward (greedy)
+    đạt target_reward. Thời gian evaluation không tính vào wall-clock.
+    
+    Returns:
+        {"episodes", "env_steps", "seconds", "eval_reward", "phase_seconds"};
+        episodes = None nếu không đạt target trong max_episodes
+    """
+    env_seq, agent_seq, dropout_seq = np.random.SeedSequence(config["seed"]).spawn(3)
+    torch.manual_seed(int(dropout_seq.generate_state(1)[0]))
+    env = MicrogridEnv(config, seed=env_seq, record_history=False)
+    eval_env = MicrogridEnv(config, record_history=False)
+    agent = DQNAgent(config, device, seed=agent_seq)
+    scheduler = TrainScheduler(config)
+    
+    result = {"episodes": None, "env_steps": 0, "seconds": 0.0, "eval_reward": float("-inf")}
+    start = time.perf_counter()
+    for episode in range(max_episodes):
+        state = env.reset()
+        agent.begin_episode()
+        for _ in range(config["max_steps_per_episode"]):
+            action = agent.select_action(state, training=True)
+            next_state, reward, done, _ = env.step(action)
+            agent.store_transition(state, action, reward, next_state, done)
+            num_updates = scheduler.step()
+            if num_updates:
+                agent.update(num_updates)
+            result["env_steps"] += 1
+            state = next_state
+            if done:
+                break
+        agent.decay_epsilon()
+        
+        if (episode + 1) % eval_every == 0:
+            eval_start = time.perf_counter()
+            metrics = evaluate_agent(agent, eval_env, num_episodes=eval_episodes)
+            start += time.perf_counter() - eval_start
+            result["eval_reward"] = metrics["mean_reward"]
+            if metrics["mean_reward"] >= target_reward:
+                result["episodes"] = episode + 1
+                break
+    result["seconds"] = time.perf_counter() - start
+    result["phase_seconds"] = dict(agent.timer.seconds)
+    return result
+
+
+def _print_target_result(label: str, result: Dict, max_episodes: int):
+    """In một dòng kết quả của _episodes_to_target."""
+    reached = (f"reached at episode {result['episodes']}" if result["episodes"]
+               else f"not reached in {max_episodes} episodes")
+    print(f"   {label:<26}: {reached} | {result['env_steps']:>6,} env-steps | "
+          f"{result['seconds']:>6.1f}s | eval reward {result['eval_reward']:.2f}")
+
+
+def benchmark_prioritized_replay(config: Dict, device: torch.device, target_reward: float = 5.5,
+                                 max_episodes: int = 500, eval_every: int = 10,
+                                 eval_episodes: int = 10) -> Dict[str, Dict]:
+    """
+    So sánh uniform vs prioritized replay: số env-steps và wall-clock để
+    mean evaluation reward (evaluate_agent, greedy) đạt target_reward.
+    Hai lượt dùng cùng seed tree nên chỉ khác nhau ở replay buffer.
+    
+    Returns:
+        {"uniform" | "prioritized": kết quả _episodes_to_target}
+    """
+    results = {}
+    for name, prioritized in (("uniform", False), ("prioritized", True)):
+        run_config = {**config, "prioritized_replay": prioritized}
+        results[name] = _episodes_to_target(run_config, device, target_reward,
+                                            max_episodes, eval_every, eval_episodes)
+        _print_target_result(name, results[name], max_episodes)
+    
+    return results
+
+
+def benchmark_n_step(config: Dict, device: torch.device, n_steps=(1, 3, 6),
+                     target_reward: float = 5.5, max_episodes: int = 500,
+                     eval_every: int = 10, eval_episodes: int = 10) -> Dict[int, Dict]:
+    """
+    So sánh n-step returns: số episodes / env-steps / wall-clock để mean
+    evaluation reward đạt target_reward, cùng seed tree cho mọi n.
+    
+    Returns:
+        {n: kết quả _episodes_to_target}
+    """
+    results = {}
+    for n in n_steps:
+        run_config = {**config, "n_step": n}
+        results[n] = _episodes_to_target(run_config, device, target_reward,
+                                         max_episodes, eval_every, eval_episodes)
+        _print_target_result(f"n_step={n}", results[n], max_episodes)
+    
+    return results
+
+
+def benchmark_replay_ratio(config: Dict, device: torch.device,
+                           schedules=((1, 1), (2, 1), (4, 1), (4, 2), (1, 2), (4, 4)),
+                           target_reward: float = 5.5, max_episodes: int = 500,
+                           eval_every: int = 10, eval_episodes: int = 10) -> Dict[Tuple[int, int], Dict]:
+    """
+    So sánh các lịch (train_every, updates_per_train): wall-clock để đạt
+    target_reward và thời gian sample/learn, để chọn replay ratio tốt nhất
+    trên CPU đang chạy.
+    
+    Returns:
+        {(train_every, updates_per_train): kết quả _episodes_to_target}
+    """
+    results = {}
+    for train_every, updates_per_train in schedules:
+        run_config = {**config, "train_every": train_every, "updates_per_train": updates_per_train}
+        result = _episodes_to_target(run_config, device, target_reward,
+                                     max_episodes, eval_every, eval_episodes)
+        results[(train_every, updates_per_train)] = result
+        _print_target_result(f"{updates_per_train} upd / {train_every} env-steps", result, max_episodes)
+        phases = result["phase_seconds"]
+        print(f"   {'':<26}  sample {phases.get('sample', 0.0):.2f}s | learn {phases.get('learn', 0.0):.2f}s")
+    
+    return results
+
+
+def benchmark_distributed(config: Dict, device: torch.device, actor_counts=(1, 2, 4, 8),
+                          seconds: float = 20.0) -> Dict[int, Dict]:
+    """
+    Throughput của train_distributed theo số actor: env-steps/s (tổng các
+    actor) và gradient-steps/s của learner, mỗi cấu hình chạy seconds giây.
+    
+    Returns:
+        {num_actors: history["throughput"]}
+    """
+    print(f"   (CPU cores: {os.cpu_count()})")
+    results = {}
+    for num_actors in actor_counts:
+        history, _, _ = train_distributed(config, device, num_actors=num_actors,
+                                          num_updates=10**9, duration=seconds, verbose=False)
+        results[num_actors] = history["throughput"]
+        label = f"{num_actors} actors + learner"
+        print(f"   {label:<26}: {results[num_actors]['env_steps_per_sec']:>10,.0f} env-steps/s | "
+              f"{results[num_actors]['gradient_steps_per_sec']:>8,.0f} gradient-steps/s")
+    
+    return results
+
+
+def benchmark_target_update(config: Dict, device: torch.device, num_iters: int = 1000,
+                            target_reward: float = 5.5, max_episodes: int = 500,
+                            eval_every: int = 10, eval_episodes: int = 10) -> Dict[str, Dict]:
+    """
+    So sánh target update "hard" và "polyak":
+    - Độ trễ một lần cập nhật target (µs): load_state_dict, polyak từng tham số,
+      polyak _foreach_lerp_
+    - Số episodes / wall-clock để evaluation reward đạt target_reward
+    
+    Returns:
+        {"latency_us": {...}, "hard": kết quả _episodes_to_target, "polyak": ...}
+    """
+    agent = DQNAgent({**config, "target_update": "polyak"}, device)
+    tau = agent.tau
+    
+    def per_call_us(fn):
+        fn()  # Warm-up
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / num_iters * 1e6
+    
+    @torch.no_grad()
+    def polyak_loop():
+        for target, online in zip(agent.target_network.parameters(), agent.q_network.parameters()):
+            target.mul_(1 - tau).add_(online, alpha=tau)
+    
+    latency = {
+        "hard (load_state_dict)": per_call_us(
+            lambda: agent.target_network.load_state_dict(agent.q_network.state_dict())),
+        "polyak (per-param loop)": per_call_us(polyak_loop),
+        "polyak (_foreach_lerp_)": per_call_us(agent.soft_update_target),
+    }
+    for label, us in latency.items():
+        print(f"   {label:<26}: {us:>8.1f} µs/update")
+    results = {"latency_us": latency}
+    
+    for mode in ("hard", "polyak"):
+        results[mode] = _episodes_to_target({**config, "target_update": mode}, device, target_reward,
+                                            max_episodes, eval_every, eval_episodes)
+        _print_target_result(f"target_update={mode}", results[mode], max_episodes)
+    
+    return results
+
+
+def benchmark_fused_update(config: Dict, device: torch.device,
+                           batch_sizes=(64, 128, 256, 512, 1024),
+                           num_updates: int = 50, seed: int = 0) -> Dict[int, Tuple[float, float]]:
+    """
+    Thông lượng DQNAgent.update (updates/s) với fused_forward False vs True.
+    Kiểm tra loss giống nhau: hai agent cùng seed, cùng replay, Dropout tắt
+    (mask dropout phụ thuộc thứ tự gọi nên chỉ so được khi p=0).
+    
+    Returns:
+        {batch_size: (separate updates/s, fused updates/s)}
+    """
+    rng = np.random.default_rng(seed)
+    capacity = 10 * max(batch_sizes)
+    transitions = (
+        rng.random((capacity, config["state_dim"]), dtype=np.float32),
+        rng.integers(config["action_dim"], size=capacity),
+        rng.normal(size=capacity).astype(np.float32),
+        rng.random((capacity, config["state_dim"]), dtype=np.float32),
+        (rng.random(capacity) < 0.05).astype(np.float32),
+    )
+    
+    def make_agent(batch_size, fused):
+        agent = DQNAgent({**config, "batch_size": batch_size, "fused_forward": fused}, device, seed=seed)
+        agent.replay_buffer.push_batch(*transitions)
+        return agent
+    
+    # Parity - Kiểm tra loss
+    agents = [make_agent(max(batch_sizes), fused) for fused in (False, True)]
+    for agent in agents:
+        for module in list(agent.q_network.modules()) + list(agent.target_network.modules()):
+            if isinstance(module, nn.Dropout):
+                module.p = 0.0
+    losses = [[agent.update() for _ in range(5)] for agent in agents]
+    assert np.allclose(losses[0], losses[1], rtol=1e-5, atol=1e-7), "fused_forward loss mismatch"
+    exact = "bit-identical" if losses[0] == losses[1] else "max diff %.1e" % np.max(np.abs(np.subtract(*losses)))
+    print(f"✅ fused_forward losses match separate forwards ({exact}, dropout off)")
+    
+    results = {}
+    for batch_size in batch_sizes:
+        rates = []
+        for fused in (False, True):
+            agent = make_agent(batch_size, fused)
+            agent.update()  # Warm-up
+            start = time.perf_counter()
+            for _ in range(num_updates):
+                agent.update()
+            rates.append(num_updates / (time.perf_counter() - start))
+        results[batch_size] = tuple(rates)
+        label = f"batch_size={batch_size}"
+        print(f"   {label:<26}: separate {rates[0]:>7.1f} | fused {rates[1]:>7.1f} updates/s "
+              f"({rates[1] / rates[0]:.2f}x)")
+    
+    return results
+
+
+def benchmark_act(config: Dict, device: torch.device, num_envs_list=(1, 64, 4096),
+                  num_iters: int = 200, seed: int = 0) -> Dict[int, Dict[str, float]]:
+    """
+    Độ trễ mỗi quyết định (µs/decision) khi chọn action cho N env:
+    select_action từng state, act() qua torch, act() qua NumPy mirror.
+    Greedy (training=False) để so sánh đúng phần forward.
+    
+    Returns:
+        {N: {"select_action", "act (torch)", "act (numpy)": µs/decision}}
+    """
+    agent = DQNAgent({**config, "numpy_actor": True}, device, seed=seed)
+    mirror = agent.actor_mirror
+    rng = np.random.default_rng(seed)
+    
+    # Parity: NumPy mirror == q_network (Dropout tắt khi so sánh)
+    agent.q_network.eval()
+    states = rng.random((256, config["state_dim"]), dtype=np.float32)
+    with torch.no_grad():
+        torch_q = agent.q_network(torch.from_numpy(states).to(device)).cpu().numpy()
+    assert np.allclose(mirror(states), torch_q, atol=1e-5), "NumpyQNetwork mismatch"
+    agent.q_network.train()
+    print("✅ NumpyQNetwork matches QNetwork (eval mode)")
+    
+    def per_decision_us(fn, num_envs):
+        batch = rng.random((num_envs, config["state_dim"]), dtype=np.float32)
+        iters = max(1, num_iters // max(1, num_envs // 64))
+        fn(batch)  # Warm-up
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn(batch)
+        return (time.perf_counter() - start) / (iters * num_envs) * 1e6
+    
+    def select_each(batch):
+        for state in batch:
+            agent.select_action(state, training=False)
+    
+    results = {}
+    for num_envs in num_envs_list:
+        timings = {}
+        agent.actor_mirror = None
+        timings["select_action"] = per_decision_us(select_each, num_envs)
+        timings["act (torch)"] = per_decision_us(lambda b: agent.act(b, training=False), num_envs)
+        agent.actor_mirror = mirror
+        timings["act (numpy)"] = per_decision_us(lambda b: agent.act(b, training=False), num_envs)
+        results[num_envs] = timings
+        label = f"N={num_envs}"
+        print(f"   {label:<26}: " + " | ".join(f"{k} {v:>7.2f}" for k, v in timings.items()) + " µs/decision")
+    
+    return results
+
+
+def benchmark_compile(config: Dict, device: torch.device,
+                      modes=("none", "torchscript", "torch_compile"),
+                      num_steps: int = 200, episode_counts=(500, 50000),
+                      seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """
+    Startup time vs steady-state throughput của từng compile_mode.
+    
+    - startup: tạo DQNAgent + lần gọi act/update đầu tiên (gồm compile)
+    - step: một select_action + một update (ms, steady state)
+    - Ước lượng tổng thời gian = startup + episodes × 24 × step cho từng
+      episode_counts, để biết khi nào compile đáng giá.
+    torch_compile chạy hai lần: lần đầu (cache trống nếu máy chưa compile
+    bao giờ) và lần hai sau torch._dynamo.reset() (dùng graph cache trên đĩa).
+    
+    Returns:
+        {mode: {"startup_s", "step_ms", ...}}
+    """
+    rng = np.random.default_rng(seed)
+    capacity = 10 * config["batch_size"]
+    transitions = (
+        rng.random((capacity, config["state_dim"]), dtype=np.float32),
+        rng.integers(config["action_dim"], size=capacity),
+        rng.normal(size=capacity).astype(np.float32),
+        rng.random((capacity, config["state_dim"]), dtype=np.float32),
+        np.zeros(capacity, dtype=np.float32),
+    )
+    state = transitions[0][0]
+    
+    runs = [(mode, mode) for mode in modes]
+    if "torch_compile" in modes:
+        runs.append(("torch_compile (cached)", "torch_compile"))
+    results = {}
+    for label, mode in runs:
+        if hasattr(torch, "_dynamo"):
+            torch._dynamo.reset()  # Bỏ graph trong bộ nhớ; chỉ còn cache trên đĩa
+        start = time.perf_counter()
+        agent = DQNAgent({**config, "compile_mode": mode}, device, seed=seed)
+        agent.replay_buffer.push_batch(*transitions)
+        agent.select_action(state, training=False)
+        agent.update()
+        startup = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for _ in range(num_steps):
+            agent.select_action(state, training=False)
+            agent.update()
+        step_ms = (time.perf_counter() - start) / num_steps * 1000
+        
+        result = {"startup_s": startup, "step_ms": step_ms}
+        for episodes in episode_counts:
+            steps = episodes * config["max_steps_per_episode"]
+            result[f"total_s_{episodes}"] = startup + steps * step_ms / 1000
+        results[label] = result
+        totals = " | ".join(f"{episodes:,} ep ≈ {result[f'total_s_{episodes}'] / 60:6.1f} min"
+                            for episodes in episode_counts)
+        print(f"   {label:<26}: startup {startup:>6.1f}s | {step_ms:>6.2f} ms/step | {totals}")
+    
+    return results
+
+
+def benchmark_checkpointing(config: Dict, device: torch.device, num_episodes: int = 50,
+                            seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """
+    Training loop giả lập: mỗi "episode" max_steps_per_episode lần update()
+    rồi một checkpoint (trường hợp xấu nhất: episode nào cũng là best).
+    So sánh agent.save() đồng bộ với CheckpointWriter (snapshot + enqueue,
+    ghi ở background thread). Ghi vào thư mục tạm, min_interval = 0.
+    
+    Returns:
+        {"sync"/"async": {"loop_s", "stall_ms"}} - stall_ms: ms bị chặn mỗi checkpoint
+    """
+    rng = np.random.default_rng(seed)
+    capacity = 10 * config["batch_size"]
+    transitions = (
+        rng.random((capacity, config["state_dim"]), dtype=np.float32),
+        rng.integers(config["action_dim"], size=capacity),
+        rng.normal(size=capacity).astype(np.float32),
+        rng.random((capacity, config["state_dim"]), dtype=np.float32),
+        np.zeros(capacity, dtype=np.float32),
+    )
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label in ("sync", "async"):
+            agent = DQNAgent(config, device, seed=seed)
+            agent.replay_buffer.push_batch(*transitions)
+            writer = CheckpointWriter(os.path.join(tmp_dir, label), keep_last=3, keep_best=3,
+                                      best_path=os.path.join(tmp_dir, f"{label}_best.pt"))
+            stall = 0.0
+            start = time.perf_counter()
+            for episode in range(num_episodes):
+                for _ in range(config["max_steps_per_episode"]):
+                    agent.update()
+                tag = f"episode_{episode:05d}"
+                if label == "sync":
+                    save_start = time.perf_counter()
+                    agent.save(os.path.join(writer.directory, f"{tag}.pt"))
+                    stall += time.perf_counter() - save_start
+                else:
+                    writer.submit(agent, tag, score=float(episode))
+            writer.close()
+            loop_s = time.perf_counter() - start
+            if label == "async":
+                stall = writer.stall_seconds
+                assert len(os.listdir(writer.directory)) <= 6
+            results[label] = {"loop_s": loop_s, "stall_ms": stall / num_episodes * 1000}
+            print(f"   {label:<26}: loop {loop_s:>6.2f}s | "
+                  f"{results[label]['stall_ms']:>6.2f} ms stall/checkpoint")
+    return results
+
+
+def benchmark_metrics(config: Dict, num_records_list=(10_000, 1_000_000), seed: int = 0
+                      ) -> Dict[int, Dict[str, float]]:
+    """
+    Ghi N record (5 metrics) vào list Python vs MetricsLogger, rồi chuẩn bị
+    dữ liệu plot (np.convolve MA20 trên list vs aggregates()).
+    
+    Returns:
+        {N: {"list_us", "logger_us" (µs/record), "list_mb", "logger_mb",
+             "list_plot_ms", "logger_plot_ms"}}
+    """
+    rng = np.random.default_rng(seed)
+    names = ["reward", "cost", "renewable_ratio", "epsilon", "loss"]
+    results = {}
+    for n in num_records_list:
+        values = rng.normal(size=(n, len(names))).tolist()
+        
+        start = time.perf_counter()
+        lists = {name: [] for name in names}
+        for row in values:
+            for name, value in zip(names, row):
+                lists[name].append(value)
+        list_us = (time.perf_counter() - start) / n * 1e6
+        list_mb = sum(len(v) * (8 + 24) for v in lists.values()) / 1e6  # Con trỏ + float object
+        start = time.perf_counter()
+        for name in names:
+            np.convolve(lists[name], np.ones(20) / 20, mode="valid")
+        list_plot_ms = (time.perf_counter() - start) * 1000
+        del lists
+        
+        metrics = MetricsLogger(names, config["metrics_window"], config["metrics_ema_alpha"],
+                                config["metrics_max_points"])
+        start = time.perf_counter()
+        for row in values:
+            metrics.log(**dict(zip(names, row)))
+        logger_us = (time.perf_counter() - start) / n * 1e6
+        logger_mb = sum(a.nbytes for a in (metrics._sum, metrics._count, metrics._min, metrics._max,
+                                           metrics._ema, metrics._end)) / 1e6
+        logger_mb += sum(stats.values.nbytes for stats in metrics.stats.values()) / 1e6
+        start = time.perf_counter()
+        for name in names:
+            metrics.aggregates(name)
+        logger_plot_ms = (time.perf_counter() - start) * 1000
+        
+        results[n] = {"list_us": list_us, "logger_us": logger_us, "list_mb": list_mb,
+                      "logger_mb": logger_mb, "list_plot_ms": list_plot_ms,
+                      "logger_plot_ms": logger_plot_ms}
+        label = f"N={n:,}"
+        print(f"   {label:<26}: lists {list_us:>5.2f} µs/rec, {list_mb:>7.1f} MB, plot {list_plot_ms:>7.1f} ms | "
+              f"MetricsLogger {logger_us:>5.2f} µs/rec, {logger_mb:>5.2f} MB, plot {logger_plot_ms:>5.2f} ms")
+    return results
+
+
+def benchmark_export(config: Dict, device: torch.device, agent: Optional[DQNAgent] = None,
+                     quantizations=EXPORT_QUANTIZATIONS, num_states: int = 100_000,
+                     num_iters: int = 500, seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """
+    Export q_network (agent đã train nếu truyền vào, ngược lại agent mới)
+    theo từng quantization: action agreement với model float trên num_states
+    states, kích thước file, latency batch 1 (µs) và batch 1024 (µs/state) trên CPU.
+    
+    Returns:
+        {quantization: {"agreement", "size_kb", "latency_us", "batch_us"}}
+    """
+    if agent is None:
+        agent = DQNAgent(config, device, seed=seed)
+    calibration = sample_policy_states(config, config["export_calibration_states"], agent=agent, seed=seed + 1)
+    states = sample_policy_states(config, num_states, agent=agent, seed=seed + 2)
+    single = torch.from_numpy(states[:1])
+    batch = torch.from_numpy(states[:1024])
+    
+    def per_call_us(model, x):
+        with torch.no_grad():
+            model(x)
+            start = time.perf_counter()
+            for _ in range(num_iters):
+                model(x)
+        return (time.perf_counter() - start) / num_iters * 1e6
+    
+    reference = strip_for_inference(agent.q_network)
+    label = "float eager (reference)"
+    print(f"   {label:<26}: {'':>21} | batch 1 {per_call_us(reference, single):>6.1f} µs | "
+          f"batch 1024 {per_call_us(reference, batch) / 1024:>5.2f} µs/state")
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for quantization in quantizations:
+            path = os.path.join(tmp_dir, f"policy_{quantization}.pt")
+            exported = export_policy(agent.q_network, path, quantization, calibration_states=calibration)
+            check = action_agreement(agent.q_network, exported, states)
+            results[quantization] = {
+                "agreement": check["agreement"],
+                "size_kb": os.path.getsize(path) / 1024,
+                "latency_us": per_call_us(exported, single),
+                "batch_us": per_call_us(exported, batch) / 1024,
+            }
+            r = results[quantization]
+            print(f"   {quantization:<26}: agree {r['agreement'] * 100:6.2f}% | {r['size_kb']:>5.0f} KB | "
+                  f"batch 1 {r['latency_us']:>6.1f} µs | batch 1024 {r['batch_us']:>5.2f} µs/state")
+    return results
+
+
+if RUN_BENCHMARKS:
+    print("=" * 60)
+    print("🔬 BENCHMARK: Vectorized environment")
+    print("=" * 60)
+    benchmark_vector_env(CONFIG)
+    
+    print("\n" + "=" * 60)
+    print(f"🔬 BENCHMARK: ReplayBuffer sample + update (buffer_size={CONFIG['buffer_size']:,})")
+    print("=" * 60)
+    benchmark_replay_buffer(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Uniform vs Prioritized replay (time to target reward)")
+    print("=" * 60)
+    benchmark_prioritized_replay(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: N-step returns (time to target reward)")
+    print("=" * 60)
+    benchmark_n_step(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Replay ratio (train_every / updates_per_train)")
+    print("=" * 60)
+    benchmark_replay_ratio(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Target network update (hard vs polyak)")
+    print("=" * 60)
+    benchmark_target_update(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Fused online forward in update()")
+    print("=" * 60)
+    benchmark_fused_update(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Per-decision latency (select_action vs batched act)")
+    print("=" * 60)
+    benchmark_act(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Compile mode - startup vs steady-state")
+    print("=" * 60)
+    benchmark_compile(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Checkpointing - training loop stall")
+    print("=" * 60)
+    benchmark_checkpointing(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Streaming metrics vs Python lists")
+    print("=" * 60)
+    benchmark_metrics(CONFIG)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Quantized policy export (CPU inference)")
+    print("=" * 60)
+    benchmark_export(CONFIG, device)
+    
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Distributed actor-learner throughput")
+    print("=" * 60)
+    benchmark_distributed(CONFIG, device)
@@ -41,10 +41,10 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.distributions import Categorical
 from collections import deque
-import random
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from typing import Dict, List, Tuple, Optional
-import json, os, time
+import copy, json, os, tempfile, time, warnings
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"🖥️ Using device: {device}")
@@ -89,14 +89,55 @@ CONFIG = {
     "entropy_coeff": 0.01,       # Entropy bonus
     "value_loss_coeff": 0.5,     # Value loss weight
     "max_grad_norm": 0.5,        # Gradient clipping
+    # 🔧 [CUSTOMIZABLE] Dừng các epoch còn lại của update khi approx KL của một mini-batch
+    # vượt 1.5 × target_kl (None = luôn chạy đủ ppo_epochs). Gợi ý: 0.01-0.05
+    "target_kl": None,
+    # 🔧 [CUSTOMIZABLE] Số mini-batch mỗi epoch: mini-batch size = rollout / num_minibatches,
+    # tự co giãn theo rollout_steps × num_envs (None = dùng mini_batch_size cố định)
+    "num_minibatches": None,
 
     # === TRAINING ===
     # ⚠️ [REQUIRED CHANGE]
     "num_episodes": 500,
     "max_steps_per_episode": 24,
-    "rollout_steps": 96,         # Steps before update (4 episodes)
+    "rollout_steps": 96,         # Steps per env before update (4 episodes)
+    # 🔧 [CUSTOMIZABLE] Số env chạy lockstep (VectorMicrogridEnv): mỗi bước một forward cho N action,
+    # mỗi update dùng rollout_steps × num_envs transitions. Gợi ý: 1-256, tăng mini_batch_size
+    # theo num_envs (vd. 32 × num_envs) để số gradient step mỗi update không đổi
+    "num_envs": 1,
+    # 🔧 [CUSTOMIZABLE] Pipeline: thread nền thu thập rollout kế tiếp (snapshot NumPy của policy,
+    # trễ tối đa 1 version, hiệu chỉnh qua old_log_probs) trong khi learner update rollout trước
+    "pipelined": False,
     "log_freq": 10,
 
+    # 🔧 [CUSTOMIZABLE] Streaming metrics (bộ nhớ cố định): cửa sổ gần nhất, số điểm plot tối đa,
+    # hệ số EMA (0.1 ≈ MA20), file .npz aggregate ghi mỗi metrics_flush_every episodes
+    "metrics_window": 100,
+    "metrics_max_points": 500,
+    "metrics_ema_alpha": 0.1,
+    "metrics_path": "evaluation_results/ppo_training_metrics.npz",
+    "metrics_flush_every": 50,
+
+    # 🔧 [CUSTOMIZABLE] NumPy actor: chọn action bằng bản sao NumPy của network
+    # (không qua torch dispatch), đồng bộ lại mỗi actor_refresh_every lần update()
+    "numpy_actor": False,
+    "actor_refresh_every": 1,
+
+    # 🔧 [CUSTOMIZABLE] Compile forward của ActorCritic (acting + update):
+    # "none" (eager) | "torch_compile" | "torchscript"; lỗi -> tự quay về eager.
+    # Graph cache của torch_compile lưu ở compile_cache_dir
+    "compile_mode": "none",
+    "compile_cache_dir": "compile_cache",
+
+    # 🔧 [CUSTOMIZABLE] Export policy head (actor) cho CPU/edge: "fp32" | "fp16" | "dynamic_int8" | "static_int8"
+    # static_int8 hiệu chỉnh trên export_calibration_states states; action agreement kiểm tra trên export_validation_states
+    "export_quantization": "dynamic_int8",
+    "export_path": "evaluation_results/ppo_policy_export.pt",
+    # state_dict của ActorCritic (chuyển sang runtime NumPy: python microgrid_runtime.py convert ...)
+    "model_path": "evaluation_results/ppo_actor_critic.pt",
+    "export_calibration_states": 2048,
+    "export_validation_states": 100_000,
+
     # ⚠️ [REQUIRED CHANGE] Random seed
     "seed": 42,
 
@@ -127,11 +168,28 @@ State Space (8D): [battery, demand, solar, wind, price, hour_sin, hour_cos, prev
 Action Space (5): Discharge | Charge_Renewable | Buy_Grid | Renew+Discharge | Renew+Grid
 """
 
+def make_seed_sequence(seed):
+    """int / None / SeedSequence -> SeedSequence mới (gốc cây seed; mỗi env/agent một Generator riêng)."""
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key)
+    return np.random.SeedSequence(seed)
+
+
 class MicrogridEnv:
     """Microgrid Energy Management Environment (identical to DQN version)."""
 
-    def __init__(self, config: Dict):
+    HISTORY_DTYPE = np.dtype([
+        ("hour", np.int32), ("demand", np.float64), ("solar", np.float64),
+        ("wind", np.float64), ("price", np.float64), ("action", np.int32),
+        ("renewable_used", np.float64), ("grid_purchased", np.float64),
+        ("battery_level", np.float64), ("reward", np.float64),
+    ])
+
+    def __init__(self, config: Dict, seed=None, record_history=True):
         self.config = config
+        self.seed_seq = make_seed_sequence(seed)
+        self.rng = np.random.default_rng(self.seed_seq)
+        self.record_history = record_history  # False khi training: bỏ ghi episode_history
         self.battery_capacity = config["battery_capacity"]
         self.battery_efficiency = config["battery_efficiency"]
         self.max_charge = config["max_charge_rate"]
@@ -153,9 +211,18 @@ class MicrogridEnv:
         self.max_unmet_ratio = config.get("max_unmet_ratio", 0.20)
         self.reset()
 
-    def reset(self, seed=None):
+    def reset(self, seed=None, trace=None):
+        """Reset; cả ngày demand/solar/wind/price được lấy mẫu một lần vào exogenous_trace.
+        Env giữ một Generator (self.rng, từ self.seed_seq) suốt đời: episode lấy tiếp từ luồng này, không spawn
+        luồng con mỗi episode (nhanh hơn cho VectorMicrogridEnv); seed: int hoặc SeedSequence đặt lại luồng."""
         if seed is not None:
-            np.random.seed(seed)
+            self.seed_seq = make_seed_sequence(seed)
+            self.rng = np.random.default_rng(self.seed_seq)
+        if trace is None:
+            noise = np.empty((4, self.hours_per_episode))
+            self._draw_noise(self.rng, noise)
+            trace = self._sample_trace(noise)
+        self.exogenous_trace = np.asarray(trace, dtype=np.float32)
         self.battery_level = self.battery_capacity * 0.5
         self.current_hour = 0
         self.prev_action = 0
@@ -163,14 +230,16 @@ class MicrogridEnv:
         self.total_renewable_used = 0.0
         self.total_grid_cost = 0.0
         self.total_unmet = 0.0
-        self.episode_history = []
+        self._history = np.zeros(self.hours_per_episode if self.record_history else 0, dtype=self.HISTORY_DTYPE)
         return self._get_obs()
 
+    @property
+    def episode_history(self):
+        """Structured array các giờ đã chạy, đọc theo cột: episode_history["reward"]."""
+        return self._history[:self.current_hour]
+
     def _get_obs(self):
-        d = self._get_demand(self.current_hour)
-        s = self._get_solar(self.current_hour)
-        w = self._get_wind(self.current_hour)
-        p = self._get_price(self.current_hour)
+        d, s, w, p = self._get_exogenous()
         obs = np.array([
             self.battery_level / self.battery_capacity,
             d / (self.base_demand * 2),
@@ -183,37 +252,50 @@ class MicrogridEnv:
         ], dtype=np.float32)
         return np.clip(obs, 0.0, 1.0)
 
-    def _get_demand(self, hour):
+    @staticmethod
+    def _draw_noise(rng, out):
+        """Noise một ngày vào out (4, hours_per_episode): hàng 0 ~ N(0,1) (demand), hàng 1-3 ~ U[0,1)."""
+        rng.standard_normal(out=out[0])
+        rng.random(out=out[1:])
+
+    def _sample_trace(self, noise):
+        """(hours_per_episode, 4) float32 [demand, solar, wind, price] từ noise (4, H) của _draw_noise;
+        noise (k, 4, H) -> k ngày cùng lúc, shape (k, H, 4)."""
+        hours = np.arange(self.hours_per_episode)
+        return np.stack([self._get_demand(hours, noise[..., 0, :]), self._get_solar(hours, noise[..., 1, :]),
+                         self._get_wind(hours, noise[..., 2, :]), self._get_price(hours, noise[..., 3, :])],
+                        axis=-1).astype(np.float32)
+
+    def _get_exogenous(self):
+        # Giờ hours_per_episode = 0h (chỉ xuất hiện ở observation cuối episode)
+        return self.exogenous_trace[self.current_hour % self.hours_per_episode].tolist()
+
+    # _get_* nhận hour là int hoặc mảng giờ và noise chuẩn z ~ N(0,1) / u ~ U[0,1) (xem _draw_noise)
+    def _get_demand(self, hour, z):
         mp = np.exp(-((hour - 8) ** 2) / 8)
         ep = np.exp(-((hour - 19) ** 2) / 8)
         base = self.base_demand * (0.5 + 0.3 * mp + 0.4 * ep)
-        return max(0, base + np.random.normal(0, self.demand_std * 0.3))
+        return np.maximum(0, base + self.demand_std * 0.3 * z)
 
-    def _get_solar(self, hour):
-        if 6 <= hour <= 18:
-            base = self.max_solar * np.sin(np.pi * (hour - 6) / 12)
-            return max(0, base * np.random.uniform(0.8, 1.2))
-        return 0.0
+    def _get_solar(self, hour, u):
+        base = np.where((6 <= hour) & (hour <= 18), self.max_solar * np.sin(np.pi * (hour - 6) / 12), 0.0)
+        return np.maximum(0, base * (0.8 + (1.2 - 0.8) * u))
 
-    def _get_wind(self, hour):
+    def _get_wind(self, hour, u):
         base = self.max_wind * 0.5
         var = self.max_wind * 0.5 * np.sin(np.pi * hour / 12)
-        return max(0, (base + var) * np.random.uniform(0.5, 1.5))
+        return np.maximum(0, (base + var) * (0.5 + (1.5 - 0.5) * u))
 
-    def _get_price(self, hour):
-        if 7 <= hour <= 9 or 18 <= hour <= 21:
-            base = self.grid_price_max
-        elif 22 <= hour or hour <= 6:
-            base = self.grid_price_min
-        else:
-            base = (self.grid_price_min + self.grid_price_max) / 2
-        return base * np.random.uniform(0.9, 1.1)
+    def _get_price(self, hour, u):
+        base = np.select(
+            [((7 <= hour) & (hour <= 9)) | ((18 <= hour) & (hour <= 21)), (22 <= hour) | (hour <= 6)],
+            [self.grid_price_max, self.grid_price_min],
+            (self.grid_price_min + self.grid_price_max) / 2,
+        )
+        return base * (0.9 + (1.1 - 0.9) * u)
 
     def step(self, action):
-        demand = self._get_demand(self.current_hour)
-        solar = self._get_solar(self.current_hour)
-        wind = self._get_wind(self.current_hour)
-        price = self._get_price(self.current_hour)
+        demand, solar, wind, price = self._get_exogenous()
         renewable = solar + wind
 
         renewable_used = grid_purchased = battery_charge = battery_discharge = unmet_demand = 0.0
@@ -266,12 +348,11 @@ class MicrogridEnv:
         self.total_renewable_used += renewable_used
         self.total_grid_cost += grid_purchased * price
         self.total_unmet += unmet_demand
-        self.episode_history.append({
-            "hour": self.current_hour, "demand": demand, "solar": solar,
-            "wind": wind, "price": price, "action": action,
-            "renewable_used": renewable_used, "grid_purchased": grid_purchased,
-            "battery_level": self.battery_level, "reward": reward,
-        })
+        if self.record_history:
+            self._history[self.current_hour] = (
+                self.current_hour, demand, solar, wind, price, action,
+                renewable_used, grid_purchased, self.battery_level, reward,
+            )
 
         self.current_hour += 1
         self.prev_action = action
@@ -289,7 +370,133 @@ class MicrogridEnv:
         }
         return self._get_obs(), reward, done, info
 
-print("✅ MicrogridEnv defined!")
+
+class VectorMicrogridEnv(MicrogridEnv):
+    """
+    N microgrids stepped in one NumPy call (masked dispatch, auto-reset).
+    Trạng thái là mảng shape (N,), exogenous_trace shape (N, hours_per_episode, 4);
+    env i giữ Generator riêng, giống hệt MicrogridEnv(config, seed=SeedSequence(seed).spawn(N)[i]).
+    Observation cuối của env vừa kết thúc nằm trong info["terminal_obs"].
+    """
+
+    def __init__(self, config: Dict, num_envs: int, seed=None):
+        self.num_envs = num_envs
+        self.env_rngs = None
+        super().__init__(config, seed=seed, record_history=False)
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.seed_seq = make_seed_sequence(seed)
+            self.env_rngs = None
+        if self.env_rngs is None:  # Mỗi env một Generator dùng suốt đời (như MicrogridEnv.rng)
+            self.env_rngs = [np.random.default_rng(s) for s in self.seed_seq.spawn(self.num_envs)]
+        n = self.num_envs
+        self._env_index = np.arange(n)
+        self.exogenous_trace = self._sample_env_traces(self._env_index)
+        self.battery_level = np.full(n, self.battery_capacity * 0.5)
+        self.current_hour = np.zeros(n, dtype=np.int64)
+        self.prev_action = np.zeros(n, dtype=np.int64)
+        self.total_demand = np.zeros(n)
+        self.total_renewable_used = np.zeros(n)
+        self.total_grid_cost = np.zeros(n)
+        self.total_unmet = np.zeros(n)
+        return self._get_obs()
+
+    def _sample_env_traces(self, env_ids):
+        noise = np.empty((len(env_ids), 4, self.hours_per_episode))
+        for row, i in zip(noise, env_ids):
+            self._draw_noise(self.env_rngs[i], row)
+        return self._sample_trace(noise)
+
+    def _reset_envs(self, mask):
+        self.exogenous_trace[mask] = self._sample_env_traces(np.flatnonzero(mask))
+        self.battery_level[mask] = self.battery_capacity * 0.5
+        self.current_hour[mask] = 0
+        self.prev_action[mask] = 0
+        for total in (self.total_demand, self.total_renewable_used, self.total_grid_cost, self.total_unmet):
+            total[mask] = 0.0
+
+    def _get_obs(self, mask=slice(None)):
+        hour = self.current_hour[mask]
+        d, s, w, p = self._get_exogenous(mask)
+        obs = np.stack([
+            self.battery_level[mask] / self.battery_capacity,
+            d / (self.base_demand * 2),
+            s / self.max_solar,
+            w / self.max_wind,
+            (p - self.grid_price_min) / (self.grid_price_max - self.grid_price_min),
+            (np.sin(2 * np.pi * hour / 24) + 1) / 2,
+            (np.cos(2 * np.pi * hour / 24) + 1) / 2,
+            self.prev_action[mask] / 4.0,
+        ], axis=1).astype(np.float32)
+        return np.clip(obs, 0.0, 1.0)
+
+    def _get_exogenous(self, mask=slice(None)):
+        hour = self.current_hour[mask] % self.hours_per_episode
+        return self.exogenous_trace[self._env_index[mask], hour].astype(np.float64).T
+
+    def step(self, actions):
+        actions = np.asarray(actions)
+        hour = self.current_hour
+        demand, solar, wind, price = self._get_exogenous()
+        renewable = solar + wind
+
+        # Masked dispatch: renewable first (1, 3, 4), then battery (0, 3)
+        uses_renewable = (actions == 1) | (actions == 3) | (actions == 4)
+        uses_battery = (actions == 0) | (actions == 3)
+        renewable_used = np.where(uses_renewable, np.minimum(renewable, demand), 0.0)
+        remaining = demand - renewable_used
+        battery_discharge = np.where(
+            uses_battery, np.minimum(np.minimum(self.battery_level, self.max_discharge), remaining), 0.0)
+        remaining = remaining - battery_discharge * self.battery_efficiency
+        unmet_demand = np.where((uses_battery | (actions == 1)) & (remaining > 0), remaining, 0.0)
+        grid_purchased = np.where(
+            actions == 2, demand, np.where((actions == 4) & (remaining > 0), remaining, 0.0))
+        excess = renewable - renewable_used
+        battery_charge = np.where(
+            (actions == 1) & (excess > 0),
+            np.minimum(np.minimum(excess, self.max_charge), self.battery_capacity - self.battery_level), 0.0)
+        self.battery_level = self.battery_level - battery_discharge + battery_charge * self.battery_efficiency
+
+        # Reward
+        norm_price = (price - self.grid_price_min) / (self.grid_price_max - self.grid_price_min)
+        is_peak = (18 <= hour) & (hour <= 21)
+        rewards = (
+            self.r_renewable * (renewable_used / self.base_demand)
+            + self.r_grid * (grid_purchased / self.base_demand) * norm_price
+            + self.r_unmet * (unmet_demand / self.base_demand)
+            + self.r_wear * ((battery_charge + battery_discharge) / self.max_charge)
+        )
+        rewards = np.where(is_peak & (grid_purchased == 0), rewards + self.r_bonus, rewards)
+
+        self.total_demand += demand
+        self.total_renewable_used += renewable_used
+        self.total_grid_cost += grid_purchased * price
+        self.total_unmet += unmet_demand
+
+        self.current_hour = hour + 1
+        self.prev_action = actions.astype(np.int64)
+
+        has_demand = self.total_demand > 0
+        unmet_ratio = np.divide(self.total_unmet, self.total_demand,
+                                out=np.zeros(self.num_envs), where=has_demand)
+        dones = ((self.current_hour >= self.hours_per_episode)
+                 | (self.battery_level / self.battery_capacity < self.battery_critical_low)
+                 | (has_demand & (unmet_ratio > self.max_unmet_ratio)))
+
+        info = {
+            "total_cost": self.total_grid_cost.copy(),
+            "renewable_ratio": self.total_renewable_used / np.maximum(1, self.total_demand),
+            "unmet_ratio": self.total_unmet / np.maximum(1, self.total_demand),
+        }
+        next_obs = self._get_obs()
+        if dones.any():
+            info["terminal_obs"] = next_obs.copy()
+            self._reset_envs(dones)
+            next_obs[dones] = self._get_obs(dones)
+        return next_obs, rewards, dones, info
+
+print("✅ MicrogridEnv & VectorMicrogridEnv defined!")
 
 #@title 4️⃣ Actor-Critic Network
 """
@@ -305,11 +512,27 @@ Critic: Output giá trị trạng thái → V(s)
 ================================================================================
 """
 
+def policy_outputs(logits, actions=None, generator=None):
+    """
+    Đường fused từ logits (không tạo Categorical): log-softmax một lần cho log-prob và entropy;
+    actions=None -> sample bằng Gumbel-max, argmax(logits + Gumbel) ~ softmax(logits).
+    Trả về (actions, log_probs, entropy), mỗi tensor shape (N,).
+    """
+    log_p = torch.log_softmax(logits, dim=-1)
+    if actions is None:
+        # -log(E), E ~ Exponential(1) là nhiễu Gumbel(0, 1)
+        noise = torch.empty_like(logits).exponential_(generator=generator)
+        actions = (logits - noise.log()).argmax(dim=-1)
+    log_probs = log_p.gather(-1, actions.unsqueeze(-1)).squeeze(-1)
+    entropy = -(log_p.exp() * log_p).sum(dim=-1)
+    return actions, log_probs, entropy
+
+
 class ActorCritic(nn.Module):
     """
     Actor-Critic Network cho PPO.
 
-    Actor head: Outputs action probabilities (softmax)
+    Actor head: Outputs action logits (softmax/log-softmax lấy ở policy_outputs)
     Critic head: Outputs state value scalar
 
     🔧 [CUSTOMIZABLE] Có thể thay đổi:
@@ -329,10 +552,10 @@ class ActorCritic(nn.Module):
             prev_dim = h
         self.shared = nn.Sequential(*shared_layers)
 
-        # Actor head - Đầu ra chính sách (policy)
+        # Actor head - Đầu ra chính sách (policy) dạng logits; giữ Sequential để
+        # state_dict vẫn là "actor.0.*" như checkpoint cũ (Softmax không có tham số)
         self.actor = nn.Sequential(
             nn.Linear(prev_dim, action_dim),
-            nn.Softmax(dim=-1)
         )
 
         # Critic head - Đầu ra giá trị (value)
@@ -348,26 +571,173 @@ class ActorCritic(nn.Module):
                 nn.init.constant_(m.bias, 0)
 
     def forward(self, x):
+        """x (N, state_dim) -> logits (N, action_dim), value (N, 1)."""
         features = self.shared(x)
         return self.actor(features), self.critic(features)
 
-    def get_action(self, state):
-        """Sample action từ policy distribution."""
+    def act(self, states, generator=None):
+        """Fused batched: (actions, log_probs, entropy, values) trong một lần gọi."""
+        logits, values = self.forward(states)
+        actions, log_probs, entropy = policy_outputs(logits, generator=generator)
+        return actions, log_probs, entropy, values.squeeze(-1)
+
+    def get_action(self, state, generator=None):
+        """Sample action từ policy distribution (generator: torch.Generator riêng của agent)."""
         state_t = torch.FloatTensor(state).unsqueeze(0).to(next(self.parameters()).device)
-        probs, value = self.forward(state_t)
-        dist = Categorical(probs)
-        action = dist.sample()
-        return action.item(), dist.log_prob(action).item(), value.item()
+        action, log_prob, _, value = self.act(state_t, generator)
+        return action.item(), log_prob.item(), value.item()
 
     def evaluate(self, states, actions):
         """Evaluate actions cho PPO update."""
-        probs, values = self.forward(states)
-        dist = Categorical(probs)
-        log_probs = dist.log_prob(actions)
-        entropy = dist.entropy()
+        logits, values = self.forward(states)
+        _, log_probs, entropy = policy_outputs(logits, actions)
         return log_probs, values.squeeze(-1), entropy
 
-print("✅ ActorCritic network defined!")
+
+
+class NumpyActorCritic:
+    """NumPy-only mirror của ActorCritic để chọn action (probs, values) không qua torch."""
+
+    def __init__(self, network: ActorCritic):
+        linears = [m for m in network.shared if isinstance(m, nn.Linear)]
+        linears += [network.actor[0], network.critic]
+        self.weights = [np.empty((m.in_features, m.out_features), dtype=np.float32) for m in linears]
+        self.biases = [np.empty(m.out_features, dtype=np.float32) for m in linears]
+        self.load_from(network)
+
+    def load_from(self, network: ActorCritic):
+        """Chép trọng số hiện tại của network vào các mảng đã cấp phát."""
+        linears = [m for m in network.shared if isinstance(m, nn.Linear)]
+        linears += [network.actor[0], network.critic]
+        for weight, bias, linear in zip(self.weights, self.biases, linears):
+            np.copyto(weight, linear.weight.detach().cpu().numpy().T)
+            np.copyto(bias, linear.bias.detach().cpu().numpy())
+
+    def __call__(self, states):
+        """states (N, state_dim) float32 -> probs (N, action_dim), values (N,)."""
+        h = states
+        for weight, bias in zip(self.weights[:-2], self.biases[:-2]):
+            h = np.tanh(h @ weight + bias)
+        logits = h @ self.weights[-2] + self.biases[-2]
+        logits -= logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        values = h @ self.weights[-1][:, 0] + self.biases[-1][0]
+        return probs, values
+
+
+class _CompiledForward:
+    """Forward qua torch.compile, không đổi cấu hình toàn cục: compile lỗi khi gọi -> cảnh báo và chuyển
+    hẳn sang eager; compile chạy lazy nên TORCHINDUCTOR_CACHE_DIR = cache_dir chỉ trong lúc gọi."""
+
+    def __init__(self, network, compiled, cache_dir=None):
+        self.network = network
+        self.compiled = compiled
+        self.cache_dir = cache_dir
+
+    def __call__(self, x):
+        if self.compiled is None:
+            return self.network(x)
+        if self.cache_dir is not None:
+            previous = os.environ.get("TORCHINDUCTOR_CACHE_DIR")
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.cache_dir
+        try:
+            return self.compiled(x)
+        except Exception as e:
+            out = self.network(x)  # Lỗi không phải do compile vẫn raise từ eager
+            print(f"⚠️ torch.compile failed ({type(e).__name__}); using eager")
+            self.compiled = None
+            return out
+        finally:
+            if self.cache_dir is not None:
+                if previous is None:
+                    os.environ.pop("TORCHINDUCTOR_CACHE_DIR", None)
+                else:
+                    os.environ["TORCHINDUCTOR_CACHE_DIR"] = previous
+
+
+def compile_network(network, mode="none", cache_dir=None):
+    """Compile forward của network (chung parameters); quay về eager nếu không compile được.
+    cache_dir: graph cache của inductor cho network này."""
+    if mode not in ("none", "torch_compile", "torchscript"):
+        raise ValueError(f"compile_mode must be 'none', 'torch_compile' or 'torchscript', got {mode!r}")
+    if mode == "none":
+        return network
+    try:
+        if mode == "torchscript":
+            return torch.jit.script(network)
+        # fx_graph_cache chỉ áp dụng cho lần compile này (options), không đổi config toàn cục
+        compiled = torch.compile(network, dynamic=True, options={"fx_graph_cache": True})
+        return _CompiledForward(network, compiled, None if cache_dir is None else os.path.abspath(cache_dir))
+    except Exception as e:
+        print(f"⚠️ compile_mode={mode!r} unavailable ({type(e).__name__}: {e}); using eager")
+        return network
+
+EXPORT_QUANTIZATIONS = ("fp32", "fp16", "dynamic_int8", "static_int8")
+
+
+def policy_head(network):
+    """Bản sao CPU, eval mode của phần policy (shared + actor -> probs), bỏ critic."""
+    return copy.deepcopy(nn.Sequential(network.shared, network.actor, nn.Softmax(dim=-1))).cpu().eval()
+
+
+class _Float16Policy(nn.Module):
+    """Bọc model fp16: nhận/trả float32 như các bản export khác."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.half()
+
+    def forward(self, x):
+        return self.model(x.half()).float()
+
+
+def export_policy(network, path, quantization="dynamic_int8", calibration_states=None):
+    """Export policy head thành TorchScript (float32 states -> probs), ghi atomic vào path."""
+    if quantization not in EXPORT_QUANTIZATIONS:
+        raise ValueError(f"quantization must be one of {EXPORT_QUANTIZATIONS}, got {quantization!r}")
+    if quantization == "static_int8" and calibration_states is None:
+        raise ValueError("static_int8 export requires calibration_states")
+    model = policy_head(network)
+    example = torch.zeros(1, network.shared[0].in_features)
+    with warnings.catch_warnings():  # torch.ao.quantization deprecated (-> torchao) nhưng vẫn có sẵn
+        warnings.simplefilter("ignore")
+        if quantization == "fp16":
+            model = _Float16Policy(model)
+        elif quantization == "dynamic_int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        elif quantization == "static_int8":
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+            model = prepare_fx(model, get_default_qconfig_mapping(torch.backends.quantized.engine),
+                               example_inputs=(example,))
+            with torch.no_grad():
+                for batch in np.array_split(calibration_states, max(1, len(calibration_states) // 1024)):
+                    model(torch.from_numpy(np.ascontiguousarray(batch, dtype=np.float32)))
+            model = convert_fx(model)
+        with torch.no_grad():
+            exported = torch.jit.freeze(torch.jit.trace(model, example).eval())
+    metadata = {"kind": "probs", "state_dim": example.shape[1], "action_dim": network.actor[0].out_features,
+                "quantization": quantization}  # đọc bởi microgrid_policy_server.py
+    torch.jit.save(exported, path + ".tmp", _extra_files={"policy.json": json.dumps(metadata)})
+    os.replace(path + ".tmp", path)
+    return exported
+
+
+def action_agreement(network, exported, states, batch_size=8192):
+    """Tỷ lệ greedy action của bản export trùng với policy float + sai lệch probs lớn nhất."""
+    reference = policy_head(network)
+    matches, max_diff = 0, 0.0
+    with torch.no_grad():
+        for start in range(0, len(states), batch_size):
+            batch = torch.from_numpy(np.ascontiguousarray(states[start:start + batch_size]))
+            p_ref, p_exp = reference(batch), exported(batch)
+            matches += int((p_ref.argmax(dim=1) == p_exp.argmax(dim=1)).sum())
+            max_diff = max(max_diff, float((p_ref - p_exp).abs().max()))
+    return {"agreement": matches / len(states), "max_abs_prob_diff": max_diff}
+
+
+print("✅ ActorCritic, policy_outputs, NumpyActorCritic, compile_network & export_policy defined!")
 
 #@title 5️⃣ PPO Agent
 """
@@ -392,30 +762,239 @@ So sánh với DQN:
 ================================================================================
 """
 
+class StreamingStats:
+    """Thống kê streaming bộ nhớ cố định: count, mean/variance (Welford), min, max, EMA, cửa sổ window giá trị gần nhất."""
+
+    def __init__(self, window: int = 100, ema_alpha: float = 0.1):
+        self.ema_alpha = ema_alpha
+        self.values = np.zeros(window)
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.ema = float("nan")
+
+    def add(self, value: float):
+        """Cập nhật mọi thống kê với một giá trị mới, O(1)."""
+        value = float(value)
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.ema = value if self.count == 1 else self.ema + self.ema_alpha * (value - self.ema)
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.variance))
+
+    def recent(self, n: Optional[int] = None) -> np.ndarray:
+        """n giá trị gần nhất (tối đa window), theo thứ tự cũ -> mới."""
+        n = min(n if n is not None else len(self.values), len(self.values), self.count)
+        idx = (self.count - n + np.arange(n)) % len(self.values)
+        return self.values[idx]
+
+
+class MetricsLogger:
+    """
+    Metrics theo episode với bộ nhớ cố định (giống bản DQN): StreamingStats mỗi metric +
+    tối đa max_points bucket aggregate (mean/min/max/EMA) cho plot; đầy thì gộp từng cặp.
+    flush() ghi aggregates ra path (.npz), tự gọi mỗi flush_every record.
+    """
+
+    def __init__(self, names: List[str], window: int = 100, ema_alpha: float = 0.1,
+                 max_points: int = 500, path: Optional[str] = None, flush_every: int = 100):
+        if max_points < 2 or max_points % 2:
+            raise ValueError(f"max_points must be an even number >= 2, got {max_points}")
+        self.names = list(names)
+        self._index = {name: j for j, name in enumerate(self.names)}
+        self.stats = {name: StreamingStats(window, ema_alpha) for name in self.names}
+        self.max_points = max_points
+        self.path = path
+        self.flush_every = flush_every
+        self.num_records = 0
+        self.bucket_size = 1
+        self._num_buckets = 0  # Số bucket đã đóng; bucket đang mở ở hàng _num_buckets
+        self._open_records = 0
+        shape = (max_points, len(self.names))
+        self._sum = np.zeros(shape)
+        self._count = np.zeros(shape, dtype=np.int64)
+        self._min = np.full(shape, np.inf)
+        self._max = np.full(shape, -np.inf)
+        self._ema = np.full(shape, np.nan)
+        self._end = np.zeros(max_points, dtype=np.int64)  # Số record tính tới cuối bucket
+
+    def __getitem__(self, name: str) -> StreamingStats:
+        return self.stats[name]
+
+    def log(self, **values: float):
+        """Ghi một record; metric không có mặt trong record thì bỏ qua."""
+        b = self._num_buckets
+        for name, value in values.items():
+            j = self._index[name]
+            value = float(value)
+            self.stats[name].add(value)
+            self._sum[b, j] += value
+            self._count[b, j] += 1
+            self._min[b, j] = min(self._min[b, j], value)
+            self._max[b, j] = max(self._max[b, j], value)
+            self._ema[b, j] = self.stats[name].ema
+        self.num_records += 1
+        self._end[b] = self.num_records
+        self._open_records += 1
+        if self._open_records == self.bucket_size:
+            self._num_buckets += 1
+            self._open_records = 0
+            if self._num_buckets == self.max_points:
+                self._merge_pairs()
+        if self.path is not None and self.num_records % self.flush_every == 0:
+            self.flush()
+
+    def _merge_pairs(self):
+        """Gộp bucket 2k và 2k+1 thành bucket k, nhân đôi bucket_size."""
+        half = self.max_points // 2
+        even, odd = slice(0, None, 2), slice(1, None, 2)
+        self._sum[:half] = self._sum[even] + self._sum[odd]
+        later_logged = self._count[odd] > 0
+        self._count[:half] = self._count[even] + self._count[odd]
+        self._min[:half] = np.minimum(self._min[even], self._min[odd])
+        self._max[:half] = np.maximum(self._max[even], self._max[odd])
+        self._ema[:half] = np.where(later_logged, self._ema[odd], self._ema[even])
+        self._end[:half] = self._end[odd]
+        self._sum[half:], self._count[half:] = 0.0, 0
+        self._min[half:], self._max[half:], self._ema[half:] = np.inf, -np.inf, np.nan
+        self._num_buckets = half
+        self.bucket_size *= 2
+
+    def aggregates(self, name: str) -> Dict[str, np.ndarray]:
+        """
+        Chuỗi đã downsample của một metric (kể cả bucket đang mở).
+
+        Returns:
+            {"step": record cuối mỗi bucket, "mean", "min", "max", "ema"}
+            (bỏ các bucket không có giá trị của metric)
+        """
+        j = self._index[name]
+        rows = self._num_buckets + (self._open_records > 0)
+        count = self._count[:rows, j]
+        logged = count > 0
+        return {
+            "step": self._end[:rows][logged],
+            "mean": self._sum[:rows, j][logged] / count[logged],
+            "min": self._min[:rows, j][logged],
+            "max": self._max[:rows, j][logged],
+            "ema": self._ema[:rows, j][logged],
+        }
+
+    def flush(self):
+        """Ghi aggregates + thống kê toàn run ra self.path (file tạm rồi os.replace)."""
+        arrays = {"num_records": np.array(self.num_records)}
+        for name in self.names:
+            for key, value in self.aggregates(name).items():
+                arrays[f"{name}/{key}"] = value
+            stats = self.stats[name]
+            arrays[f"{name}/summary"] = np.array([stats.count, stats.mean, stats.std,
+                                                  stats.min, stats.max, stats.ema])
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+
+
+def compute_gae_reference(rewards, values, dones, next_value, gamma, gae_lambda):
+    """
+    GAE vô hướng (vòng lặp Python, một env) - bản tham chiếu cho compute_gae.
+    rewards/values/dones: list độ dài T; trả về list advantages độ dài T.
+    """
+    values = list(values) + [next_value]
+    advantages = []
+    gae = 0
+    for t in reversed(range(len(rewards))):
+        delta = rewards[t] + gamma * values[t + 1] * (1 - dones[t]) - values[t]
+        gae = delta + gamma * gae_lambda * (1 - dones[t]) * gae
+        advantages.insert(0, gae)
+    return advantages
+
+
+def compute_gae(rewards, values, dones, next_value, gamma, gae_lambda):
+    """
+    GAE vectorized cho mảng (T, N): reverse scan theo T, batched theo env.
+
+    A_t = δ_t + γλ(1 - d_t)·A_{t+1} là hồi quy tuyến tính x_t = a_t·x_{t+1} + b_t;
+    scan kiểu nhân đôi bước (log2 T lần, mỗi lần một phép NumPy trên cả mảng) thay
+    cho vòng lặp T bước. Chỉ nhân các hệ số a ∈ [0, 1] nên ổn định số học; dừng sớm
+    khi mọi cửa sổ đã chứa một done (a = 0), vd. sau ~log2(24) bước với episode 24 giờ.
+
+    Args:
+        rewards, values, dones: shape (T, N)
+        next_value: V(s_T) để bootstrap, shape (N,)
+
+    Returns:
+        advantages shape (T, N), float64
+    """
+    values = np.asarray(values, dtype=np.float64)
+    not_done = 1.0 - np.asarray(dones, dtype=np.float64)
+    next_values = np.concatenate([values[1:], np.asarray(next_value, dtype=np.float64).reshape(1, -1)])
+    b = np.asarray(rewards, dtype=np.float64) + gamma * next_values * not_done - values  # δ_t
+    a = gamma * gae_lambda * not_done
+    k = 1
+    while k < len(b) and a.any():
+        b[:-k] += a[:-k] * b[k:]
+        a[:-k] *= a[k:]
+        a[-k:] = 0.0  # Hết rollout: không còn số hạng nào để cộng
+        k *= 2
+    return b
+
+
 class RolloutBuffer:
-    """Buffer lưu trữ rollout data cho PPO (on-policy)."""
+    """
+    Buffer lưu trữ rollout data cho PPO (on-policy), cấp phát trước dạng (T, N_envs).
+    add() ghi một bước cho cả N env; len() = số transition đã ghi (bước × N).
+    """
 
-    def __init__(self):
-        self.clear()
+    def __init__(self, num_steps: int, num_envs: int = 1, state_dim: int = 8):
+        self.num_steps = num_steps
+        self.num_envs = num_envs
+        self.states = np.zeros((num_steps, num_envs, state_dim), dtype=np.float32)
+        self.actions = np.zeros((num_steps, num_envs), dtype=np.int64)
+        self.log_probs = np.zeros((num_steps, num_envs), dtype=np.float32)
+        self.rewards = np.zeros((num_steps, num_envs), dtype=np.float32)
+        self.values = np.zeros((num_steps, num_envs), dtype=np.float32)
+        self.dones = np.zeros((num_steps, num_envs), dtype=np.float32)
+        self.ptr = 0
 
     def clear(self):
-        self.states = []
-        self.actions = []
-        self.log_probs = []
-        self.rewards = []
-        self.values = []
-        self.dones = []
+        self.ptr = 0
 
     def add(self, state, action, log_prob, reward, value, done):
-        self.states.append(state)
-        self.actions.append(action)
-        self.log_probs.append(log_prob)
-        self.rewards.append(reward)
-        self.values.append(value)
-        self.dones.append(done)
+        """Một bước: state (N, state_dim) hoặc (state_dim,) khi N=1, còn lại (N,) hoặc scalar."""
+        t = self.ptr
+        if t == self.num_steps:
+            raise RuntimeError(f"RolloutBuffer is full ({self.num_steps} steps); call update() first")
+        self.states[t] = state
+        self.actions[t] = action
+        self.log_probs[t] = log_prob
+        self.rewards[t] = reward
+        self.values[t] = value
+        self.dones[t] = done
+        self.ptr = t + 1
 
     def __len__(self):
-        return len(self.states)
+        return self.ptr * self.num_envs
+
+
+def sample_categorical(probs, rng):
+    """Inverse-CDF sampling một action mỗi hàng của probs (N, A): trả về (actions, log_probs)."""
+    u = rng.random(len(probs))[:, None]
+    actions = np.minimum((probs.cumsum(axis=1) < u).sum(axis=1), probs.shape[1] - 1)
+    return actions, np.log(probs[np.arange(len(probs)), actions])
 
 
 class PPOAgent:
@@ -428,9 +1007,16 @@ class PPOAgent:
     - Clipped surrogate objective thay vì MSE loss trên Q-values
     """
 
-    def __init__(self, config: Dict, device: torch.device):
+    def __init__(self, config: Dict, device: torch.device, seed=None):
         self.config = config
         self.device = device
+        # Luồng ngẫu nhiên riêng (seed: int hoặc SeedSequence): init trọng số, sampling action, minibatch
+        self.seed_seq = make_seed_sequence(seed)
+        init_seq, action_seq, minibatch_seq = self.seed_seq.spawn(3)
+        self.rng = np.random.default_rng(minibatch_seq)
+        self.torch_rng = torch.Generator(device=device)
+        self.torch_rng.manual_seed(int(action_seq.generate_state(1)[0]))
+        self.action_rng = np.random.default_rng(action_seq.spawn(1)[0])  # Sampling của NumPy actor
         self.gamma = config["gamma"]
         self.gae_lambda = config["gae_lambda"]
         self.clip_epsilon = config["clip_epsilon"]
@@ -439,11 +1025,15 @@ class PPOAgent:
         self.entropy_coeff = config["entropy_coeff"]
         self.value_loss_coeff = config["value_loss_coeff"]
         self.max_grad_norm = config["max_grad_norm"]
+        self.target_kl = config["target_kl"]
+        self.num_minibatches = config["num_minibatches"]
 
-        # Actor-Critic network
-        self.network = ActorCritic(
-            config["state_dim"], config["action_dim"], config["hidden_dims"]
-        ).to(device)
+        # Actor-Critic network (fork_rng: không động vào global torch RNG)
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(int(init_seq.generate_state(1)[0]))
+            self.network = ActorCritic(
+                config["state_dim"], config["action_dim"], config["hidden_dims"]
+            ).to(device)
 
         # Separate learning rates for actor and critic
         self.optimizer = optim.Adam([
@@ -452,45 +1042,79 @@ class PPOAgent:
             {"params": self.network.critic.parameters(), "lr": config["lr_critic"]},
         ])
 
-        self.buffer = RolloutBuffer()
+        # Forward đã compile (CONFIG["compile_mode"]) cho act() và update()
+        self.forward = compile_network(self.network, config["compile_mode"], config["compile_cache_dir"])
+
+        self.buffer = RolloutBuffer(config["rollout_steps"], config["num_envs"], config["state_dim"])
         self.training_step = 0
+        self.last_update_stats = {}  # Thống kê của update() gần nhất (loss, KL, clip fraction, epochs, ...)
+        self.actor_refresh_every = config["actor_refresh_every"]
+        self.actor_mirror = NumpyActorCritic(self.network) if config["numpy_actor"] else None
 
     def select_action(self, state, eval_mode=False):
-        """Chọn action từ policy."""
+        """Chọn action từ policy (act() với batch 1 state)."""
+        out = self.act(np.asarray(state, dtype=np.float32)[None], eval_mode)
         if eval_mode:
-            with torch.no_grad():
-                state_t = torch.FloatTensor(state).unsqueeze(0).to(self.device)
-                probs, _ = self.network(state_t)
-                return probs.argmax(dim=-1).item()
-        action, log_prob, value = self.network.get_action(state)
-        return action, log_prob, value
+            return int(out[0])
+        return int(out[0][0]), float(out[1][0]), float(out[2][0])
+
+    def act(self, states, eval_mode=False):
+        """
+        Batched action selection cho N env (một forward, sampling vectorized).
+        states: (N, state_dim). eval_mode -> actions (N,) greedy;
+        ngược lại -> (actions, log_probs, values), mỗi mảng shape (N,).
+        """
+        states = np.asarray(states, dtype=np.float32)
+        if self.actor_mirror is not None:
+            probs, values = self.actor_mirror(states)
+            if eval_mode:
+                return probs.argmax(axis=1)
+            actions, log_probs = sample_categorical(probs, self.action_rng)
+            return actions, log_probs, values
+        with torch.no_grad():
+            logits, values = self.forward(torch.from_numpy(states).to(self.device))
+            if eval_mode:
+                return logits.argmax(dim=-1).cpu().numpy()
+            actions, log_probs, _ = policy_outputs(logits, generator=self.torch_rng)
+        return actions.cpu().numpy(), log_probs.cpu().numpy(), values.squeeze(1).cpu().numpy()
+
+    def value(self, states):
+        """V(s) cho batch states (N, state_dim) -> (N,), vd. bootstrap next_value ở cuối rollout."""
+        states = np.asarray(states, dtype=np.float32)
+        if self.actor_mirror is not None:
+            return self.actor_mirror(states)[1]
+        with torch.no_grad():
+            _, values = self.forward(torch.from_numpy(states).to(self.device))
+        return values.squeeze(1).cpu().numpy()
+
+    def evaluate(self, states, actions):
+        """ActorCritic.evaluate qua forward đã compile: (log_probs, values, entropy)."""
+        logits, values = self.forward(states)
+        _, log_probs, entropy = policy_outputs(logits, actions)
+        return log_probs, values.squeeze(-1), entropy
 
     def store(self, state, action, log_prob, reward, value, done):
         self.buffer.add(state, action, log_prob, reward, value, done)
 
     def compute_gae(self, next_value):
         """
-        Generalized Advantage Estimation (GAE).
+        Generalized Advantage Estimation (GAE) trên phần đã ghi của buffer.
 
         A_t = Σ (γλ)^l · δ_{t+l}
         δ_t = r_t + γV(s_{t+1}) - V(s_t)
 
         GAE(λ=0) = TD error (high bias, low variance)
         GAE(λ=1) = Monte Carlo (low bias, high variance)
+
+        next_value: V(s_T), scalar hoặc (N,). Trả về (advantages, returns) shape (T·N,)
+        trên device, thứ tự time-major.
         """
-        rewards = self.buffer.rewards
-        values = self.buffer.values + [next_value]
-        dones = self.buffer.dones
-
-        advantages = []
-        gae = 0
-        for t in reversed(range(len(rewards))):
-            delta = rewards[t] + self.gamma * values[t + 1] * (1 - dones[t]) - values[t]
-            gae = delta + self.gamma * self.gae_lambda * (1 - dones[t]) * gae
-            advantages.insert(0, gae)
-
-        advantages = torch.FloatTensor(advantages).to(self.device)
-        returns = advantages + torch.FloatTensor(self.buffer.values).to(self.device)
+        T, buf = self.buffer.ptr, self.buffer
+        advantages = compute_gae(buf.rewards[:T], buf.values[:T], buf.dones[:T],
+                                 np.broadcast_to(next_value, (buf.num_envs,)), self.gamma, self.gae_lambda)
+        returns = advantages + buf.values[:T]
+        advantages = torch.from_numpy(advantages.reshape(-1).astype(np.float32)).to(self.device)
+        returns = torch.from_numpy(returns.reshape(-1).astype(np.float32)).to(self.device)
         return advantages, returns
 
     def update(self, next_value):
@@ -499,36 +1123,56 @@ class PPOAgent:
 
         1. Compute GAE advantages
         2. Normalize advantages
-        3. Mini-batch SGD for ppo_epochs
+        3. Mini-batch SGD for ppo_epochs (dừng sớm nếu approx KL so với policy lúc bắt đầu
+           update > 1.5 × target_kl)
         4. Clipped surrogate loss + value loss + entropy bonus
+
+        Trả về loss trung bình; thống kê chi tiết ở self.last_update_stats (trung bình
+        trên các mini-batch đã step; stop_kl = KL của mini-batch kích hoạt dừng sớm).
         """
+        start_time = time.perf_counter()
         advantages, returns = self.compute_gae(next_value)
 
         # Normalize advantages
         advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
 
-        # Prepare tensors
-        states = torch.FloatTensor(np.array(self.buffer.states)).to(self.device)
-        actions = torch.LongTensor(self.buffer.actions).to(self.device)
-        old_log_probs = torch.FloatTensor(self.buffer.log_probs).to(self.device)
-
-        total_loss_val = 0
+        # Prepare tensors (một lần copy lên device mỗi update)
+        T, n = self.buffer.ptr, len(self.buffer)
+        states = torch.from_numpy(self.buffer.states[:T].reshape(n, -1)).to(self.device)
+        actions = torch.from_numpy(self.buffer.actions[:T].reshape(n)).to(self.device)
+        old_log_probs = torch.from_numpy(self.buffer.log_probs[:T].reshape(n)).to(self.device)
+        # Approx KL (và early stop) đo so với policy lúc bắt đầu update, không phải policy đã
+        # thu rollout: ở chế độ pipelined / numpy_actor old_log_probs có thể trễ một version,
+        # khi đó KL đã vượt target ngay mini-batch đầu. Ratio PPO vẫn dùng old_log_probs.
+        with torch.no_grad():
+            start_log_probs = self.evaluate(states, actions)[0]
+
+        mini_batch_size = self.mini_batch_size if self.num_minibatches is None else -(-n // self.num_minibatches)
+        stat_names = ("loss", "policy_loss", "value_loss", "entropy", "approx_kl", "clip_fraction")
+        totals = dict.fromkeys(stat_names, 0.0)
         n_updates = 0
+        epochs_run = 0
+        early_stopped = False
+        stop_kl = None
 
         for _ in range(self.ppo_epochs):
-            # Mini-batch iteration
-            indices = np.random.permutation(len(self.buffer))
-            for start in range(0, len(self.buffer), self.mini_batch_size):
-                end = start + self.mini_batch_size
+            if early_stopped:
+                break
+            epochs_run += 1
+            # Mini-batch iteration (permutation chép lên device một lần mỗi epoch, index trên device)
+            indices = torch.from_numpy(self.rng.permutation(n)).to(self.device)
+            for start in range(0, n, mini_batch_size):
+                end = start + mini_batch_size
                 idx = indices[start:end]
 
                 # Evaluate current policy
-                new_log_probs, new_values, entropy = self.network.evaluate(
+                new_log_probs, new_values, entropy = self.evaluate(
                     states[idx], actions[idx]
                 )
 
                 # PPO Clipped Objective
-                ratio = torch.exp(new_log_probs - old_log_probs[idx])
+                log_ratio = new_log_probs - old_log_probs[idx]
+                ratio = torch.exp(log_ratio)
                 surr1 = ratio * advantages[idx]
                 surr2 = torch.clamp(ratio, 1 - self.clip_epsilon, 1 + self.clip_epsilon) * advantages[idx]
                 policy_loss = -torch.min(surr1, surr2).mean()
@@ -543,19 +1187,163 @@ class PPOAgent:
                     - self.entropy_coeff * entropy.mean()
                 )
 
+                # Approx KL(π_start || π_new) ≈ E[(r - 1) - log r] (không âm, phương sai thấp) và
+                # tỷ lệ sample bị clip; một lần đồng bộ device mỗi mini-batch
+                with torch.no_grad():
+                    kl_log_ratio = new_log_probs - start_log_probs[idx]
+                    approx_kl = (torch.expm1(kl_log_ratio) - kl_log_ratio).mean()
+                    clip_fraction = ((ratio - 1).abs() > self.clip_epsilon).float().mean()
+                    values = torch.stack([loss, policy_loss, value_loss, entropy.mean(),
+                                          approx_kl, clip_fraction]).tolist()
+                if self.target_kl is not None and values[4] > 1.5 * self.target_kl:
+                    early_stopped = True  # Policy đã đi đủ xa: bỏ mini-batch này và các epoch còn lại
+                    stop_kl = values[4]
+                    break
+
                 self.optimizer.zero_grad()
                 loss.backward()
                 nn.utils.clip_grad_norm_(self.network.parameters(), self.max_grad_norm)
                 self.optimizer.step()
 
-                total_loss_val += loss.item()
+                for name, value in zip(stat_names, values):
+                    totals[name] += value
                 n_updates += 1
 
         self.buffer.clear()
         self.training_step += 1
-        return total_loss_val / max(1, n_updates)
+        if self.actor_mirror is not None and self.training_step % self.actor_refresh_every == 0:
+            self.actor_mirror.load_from(self.network)
+        self.last_update_stats = {name: total / max(1, n_updates) for name, total in totals.items()}
+        self.last_update_stats.update({
+            "epochs": epochs_run, "minibatches": n_updates, "mini_batch_size": mini_batch_size,
+            "early_stopped": early_stopped, "stop_kl": stop_kl,
+            "update_seconds": time.perf_counter() - start_time,
+        })
+        return self.last_update_stats["loss"]
+
+
+class RolloutCollector:
+    """
+    Thu thập rollout từ N env chạy lockstep (VectorMicrogridEnv, tự reset env kết thúc):
+    mỗi bước một forward ActorCritic (agent.act) cho N action, ghi (T, N) vào agent.buffer.
+    Episode kết thúc giữa rollout được che bởi done trong GAE; next_value() bootstrap từng env.
+    """
+
+    def __init__(self, agent: PPOAgent, env: VectorMicrogridEnv):
+        self.agent = agent
+        self.env = env
+        self.obs = env.reset()
+        self.episode_rewards = np.zeros(env.num_envs)
+
+    def collect(self, num_steps: int) -> List[Dict]:
+        """
+        Chạy num_steps bước trên cả N env.
 
-print("✅ PPOAgent defined!")
+        Returns:
+            Các episode đã kết thúc: {"reward", "renewable_ratio", "cost"}
+        """
+        return self._run(num_steps, self.agent.buffer, self.agent.act)
+
+    def _run(self, num_steps, buffer, act):
+        finished = []
+        for _ in range(num_steps):
+            actions, log_probs, values = act(self.obs)
+            next_obs, rewards, dones, info = self.env.step(actions)
+            buffer.add(self.obs, actions, log_probs, rewards, values, dones)
+            self.episode_rewards += rewards
+            for i in np.flatnonzero(dones):
+                finished.append({"reward": self.episode_rewards[i], "renewable_ratio": info["renewable_ratio"][i],
+                                 "cost": info["total_cost"][i]})
+            self.episode_rewards[dones] = 0.0
+            self.obs = next_obs
+        return finished
+
+    def next_value(self) -> np.ndarray:
+        """V(s_T) mỗi env (env vừa done: bị che bởi done trong GAE)."""
+        return self.agent.value(self.obs)
+
+    def close(self):
+        pass
+
+
+class PipelinedRolloutCollector(RolloutCollector):
+    """
+    RolloutCollector hai buffer: trong khi learner update trên rollout k (agent.buffer),
+    một thread nền thu thập rollout k+1 vào buffer còn lại bằng snapshot NumPy của policy.
+
+    Snapshot được làm mới ở mỗi collect() nên rollout dùng để update trễ tối đa một
+    version policy; ratio của PPO tính với old_log_probs của chính snapshot đó (policy
+    hành vi) nên vẫn đúng. Values của rollout được tính lại bằng critic hiện tại.
+    Early stop theo target_kl đo KL so với policy lúc bắt đầu update, nên độ trễ này
+    không làm update dừng ngay mini-batch đầu.
+    """
+
+    def __init__(self, agent: PPOAgent, env: VectorMicrogridEnv):
+        super().__init__(agent, env)
+        self.snapshot = NumpyActorCritic(agent.network)
+        self.rng = np.random.default_rng(agent.seed_seq.spawn(1)[0])
+        buffer = agent.buffer
+        self._spare = RolloutBuffer(buffer.num_steps, buffer.num_envs, buffer.states.shape[2])
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ppo-collector")
+        self._pending = None
+        self._next_value = None
+
+    def _act(self, obs):
+        probs, values = self.snapshot(obs)
+        actions, log_probs = sample_categorical(probs, self.rng)
+        return actions, log_probs, values
+
+    def collect(self, num_steps: int) -> List[Dict]:
+        """
+        Lấy rollout đang thu thập (chờ nếu chưa xong), đặt nó làm agent.buffer rồi
+        khởi động rollout kế tiếp với policy hiện tại; trả về các episode đã kết thúc.
+        """
+        if self._pending is None:
+            self._pending = self._executor.submit(self._run, num_steps, self._spare, self._act)
+        finished = self._pending.result()
+        filled, self._spare = self._spare, self.agent.buffer
+        last_obs = self.obs
+
+        # Thread nền đang rảnh: cập nhật snapshot rồi thu thập rollout kế tiếp trong lúc learner update
+        self.snapshot.load_from(self.agent.network)
+        self._spare.clear()
+        self._pending = self._executor.submit(self._run, num_steps, self._spare, self._act)
+
+        T, N = filled.ptr, filled.num_envs
+        filled.values[:T] = self.agent.value(filled.states[:T].reshape(T * N, -1)).reshape(T, N)
+        self._next_value = self.agent.value(last_obs)
+        self.agent.buffer = filled
+        return finished
+
+    def next_value(self) -> np.ndarray:
+        return self._next_value
+
+    def close(self):
+        """Chờ rollout đang chạy (bỏ kết quả) và dừng thread."""
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+        self._executor.shutdown()
+
+
+def sample_policy_states(config, num_states, agent=None, epsilon=0.2, seed=0):
+    """States thực tế (hiệu chỉnh / kiểm tra export) từ VectorMicrogridEnv: greedy của agent + epsilon, hoặc ngẫu nhiên."""
+    num_envs = min(1024, num_states)
+    env = VectorMicrogridEnv(config, num_envs, seed=seed)
+    rng = np.random.default_rng(seed)
+    states = np.empty((num_states, config["state_dim"]), dtype=np.float32)
+    obs = env.reset()
+    for start in range(0, num_states, num_envs):
+        n = min(num_envs, num_states - start)
+        states[start:start + n] = obs[:n]
+        actions = rng.integers(config["action_dim"], size=num_envs)
+        if agent is not None:
+            actions = np.where(rng.random(num_envs) < epsilon, actions, agent.act(obs, eval_mode=True))
+        obs, _, _, _ = env.step(actions)
+    return states
+
+
+print("✅ PPOAgent, RolloutCollector, PipelinedRolloutCollector, MetricsLogger & sample_policy_states defined!")
 
 #@title 6️⃣ Training Loop
 """
@@ -568,76 +1356,58 @@ So sánh training loop DQN vs PPO:
 ================================================================================
 """
 
-# Set seed
-torch.manual_seed(CONFIG["seed"])
-np.random.seed(CONFIG["seed"])
-random.seed(CONFIG["seed"])
+# Seed tree - mỗi thành phần một luồng ngẫu nhiên riêng (không dùng global seed)
+env_seq, agent_seq = np.random.SeedSequence(CONFIG["seed"]).spawn(2)
 
-env = MicrogridEnv(CONFIG)
-agent = PPOAgent(CONFIG, device)
+env = VectorMicrogridEnv(CONFIG, CONFIG["num_envs"], seed=env_seq)
+agent = PPOAgent(CONFIG, device, seed=agent_seq)
+collector = (PipelinedRolloutCollector if CONFIG["pipelined"] else RolloutCollector)(agent, env)
 
-# Training metrics
-rewards_history = []
-renewable_history = []
-cost_history = []
-loss_history = []
+# Training metrics - streaming, bộ nhớ cố định
+os.makedirs(os.path.dirname(CONFIG["metrics_path"]) or ".", exist_ok=True)
+metrics = MetricsLogger(["reward", "renewable_ratio", "cost", "loss", "approx_kl", "clip_fraction"],
+                        window=CONFIG["metrics_window"], ema_alpha=CONFIG["metrics_ema_alpha"],
+                        max_points=CONFIG["metrics_max_points"], path=CONFIG["metrics_path"],
+                        flush_every=CONFIG["metrics_flush_every"])
 
 NUM_EPISODES = CONFIG["num_episodes"]
 print("=" * 60)
-print(f"🚀 TRAINING PPO AGENT - {NUM_EPISODES} episodes")
+print(f"🚀 TRAINING PPO AGENT - {NUM_EPISODES} episodes, {CONFIG['num_envs']} env(s)"
+      + (", pipelined" if CONFIG["pipelined"] else ""))
 print("=" * 60)
 
 start_time = time.time()
-steps_since_update = 0
-
-for episode in range(1, NUM_EPISODES + 1):
-    state = env.reset(seed=CONFIG["seed"] + episode)
-    episode_reward = 0
-
-    for step in range(CONFIG["max_steps_per_episode"]):
-        action, log_prob, value = agent.select_action(state)
-        next_state, reward, done, info = env.step(action)
-
-        agent.store(state, action, log_prob, reward, value, float(done))
-        episode_reward += reward
-        steps_since_update += 1
-        state = next_state
-
-        # Update when enough steps collected
-        if steps_since_update >= CONFIG["rollout_steps"]:
-            with torch.no_grad():
-                state_t = torch.FloatTensor(state).unsqueeze(0).to(device)
-                _, next_value = agent.network(state_t)
-                next_value = next_value.item()
-            loss = agent.update(next_value)
-            loss_history.append(loss)
-            steps_since_update = 0
-
-        if done:
-            break
-
-    rewards_history.append(episode_reward)
-    renewable_history.append(info["renewable_ratio"])
-    cost_history.append(info["total_cost"])
-
-    if episode % CONFIG["log_freq"] == 0:
-        avg_r = np.mean(rewards_history[-CONFIG["log_freq"]:])
-        avg_ren = np.mean(renewable_history[-CONFIG["log_freq"]:])
-        elapsed = time.time() - start_time
-        print(f"Ep {episode:4d}/{NUM_EPISODES} | "
-              f"Reward: {avg_r:7.2f} | "
-              f"Renewable: {avg_ren:.1%} | "
-              f"Cost: ${info['total_cost']:.2f} | "
-              f"Time: {elapsed:.0f}s")
-
-# Handle remaining data in buffer
-if len(agent.buffer) > 0:
-    with torch.no_grad():
-        state_t = torch.FloatTensor(state).unsqueeze(0).to(device)
-        _, next_value = agent.network(state_t)
-        next_value = next_value.item()
-    agent.update(next_value)
-
+episode = 0
+pending_updates = []  # Thống kê của các update chưa gắn vào episode nào
+
+while episode < NUM_EPISODES:
+    # Rollout rollout_steps bước × num_envs env, rồi update với next_value riêng từng env
+    finished = collector.collect(CONFIG["rollout_steps"])
+    agent.update(collector.next_value())
+    if agent.last_update_stats["minibatches"]:  # Dừng ngay mini-batch đầu: không có loss để log
+        pending_updates.append(agent.last_update_stats)
+
+    for record in finished[:NUM_EPISODES - episode]:
+        episode += 1
+        if pending_updates:
+            for name in ("loss", "approx_kl", "clip_fraction"):
+                record[name] = np.mean([stats[name] for stats in pending_updates])
+            pending_updates = []
+        metrics.log(**record)
+
+        if episode % CONFIG["log_freq"] == 0:
+            avg_r = metrics["reward"].recent(CONFIG["log_freq"]).mean()
+            avg_ren = metrics["renewable_ratio"].recent(CONFIG["log_freq"]).mean()
+            elapsed = time.time() - start_time
+            print(f"Ep {episode:4d}/{NUM_EPISODES} | "
+                  f"Reward: {avg_r:7.2f} | "
+                  f"Renewable: {avg_ren:.1%} | "
+                  f"Cost: ${record['cost']:.2f} | "
+                  f"KL: {metrics['approx_kl'].ema:.4f} | "
+                  f"Time: {elapsed:.0f}s")
+
+collector.close()
+metrics.flush()
 total_time = time.time() - start_time
 print(f"\n✅ Training complete in {total_time:.1f}s")
 
@@ -655,16 +1425,18 @@ print("📊 EVALUATION: PPO Agent vs Random Baseline")
 print("=" * 60)
 
 def evaluate_agent(agent, config, use_random=False, num_eval=20):
-    """Evaluate agent over multiple episodes."""
-    eval_env = MicrogridEnv(config)
+    """Evaluate agent over multiple episodes (episode i: luồng seed con thứ i, độc lập nhau)."""
+    eval_env = MicrogridEnv(config, record_history=False)
     all_rewards, all_costs, all_renewable, all_unmet = [], [], [], []
+    episode_seqs = np.random.SeedSequence(config["seed"] + 10000).spawn(num_eval + 1)
+    policy_rng = np.random.default_rng(episode_seqs[-1])
 
     for i in range(num_eval):
-        state = eval_env.reset(seed=config["seed"] + 10000 + i)
+        state = eval_env.reset(seed=episode_seqs[i])
         ep_reward = 0
         for _ in range(config["max_steps_per_episode"]):
             if use_random:
-                action = random.randint(0, config["action_dim"] - 1)
+                action = int(policy_rng.integers(config["action_dim"]))
             else:
                 action = agent.select_action(state, eval_mode=True)
             state, reward, done, info = eval_env.step(action)
@@ -699,21 +1471,37 @@ for key in ["rewards", "costs", "renewable", "unmet"]:
         imp = (ppo_v - rand_v) / max(abs(rand_v), 1e-8) * 100
         print(f"{key:<25} {ppo_v:>11.3f} {rand_v:>11.3f} {imp:>10.1f}%")
 
+torch.save(agent.network.state_dict(), CONFIG["model_path"])
+
+# Export policy head (quantized) cho inference CPU, kiểm tra với policy float
+exported_policy = export_policy(agent.network, CONFIG["export_path"], CONFIG["export_quantization"],
+                                calibration_states=sample_policy_states(CONFIG, CONFIG["export_calibration_states"], agent, seed=1))
+validation_states = sample_policy_states(CONFIG, CONFIG["export_validation_states"], agent, seed=2)
+export_check = action_agreement(agent.network, exported_policy, validation_states)
+print(f"\n📦 Exported {CONFIG['export_quantization']} policy → {CONFIG['export_path']} "
+      f"({os.path.getsize(CONFIG['export_path']) / 1024:.0f} KB) | action agreement "
+      f"{export_check['agreement']:.2%} on {len(validation_states):,} states")
+
 #@title 8️⃣ Visualization
 """
 📈 TRAINING CURVES & EVALUATION CHARTS
 """
 
+def plot_aggregates(ax, name, color):
+    """Aggregate đã downsample của metrics: dải min-max + mean mỗi bucket (mờ), EMA (đậm)."""
+    agg = metrics.aggregates(name)
+    if metrics.bucket_size > 1:
+        ax.fill_between(agg["step"], agg["min"], agg["max"], color=color, alpha=0.1)
+    ax.plot(agg["step"], agg["mean"], alpha=0.3, color=color)
+    ax.plot(agg["step"], agg["ema"], color=color, linewidth=2)
+
+
 fig, axes = plt.subplots(2, 2, figsize=(14, 10))
 fig.suptitle("PPO Agent - Microgrid Energy Optimization", fontsize=14, fontweight="bold")
 
 # 1. Training Reward
 ax = axes[0, 0]
-ax.plot(rewards_history, alpha=0.3, color="purple")
-w = 20
-if len(rewards_history) >= w:
-    smoothed = np.convolve(rewards_history, np.ones(w)/w, mode="valid")
-    ax.plot(range(w-1, len(rewards_history)), smoothed, color="purple", linewidth=2)
+plot_aggregates(ax, "reward", "purple")
 ax.set_title("Training Reward (PPO)")
 ax.set_xlabel("Episode")
 ax.set_ylabel("Total Reward")
@@ -721,10 +1509,7 @@ ax.grid(True, alpha=0.3)
 
 # 2. Renewable Ratio
 ax = axes[0, 1]
-ax.plot(renewable_history, alpha=0.3, color="green")
-if len(renewable_history) >= w:
-    smoothed = np.convolve(renewable_history, np.ones(w)/w, mode="valid")
-    ax.plot(range(w-1, len(renewable_history)), smoothed, color="green", linewidth=2)
+plot_aggregates(ax, "renewable_ratio", "green")
 ax.set_title("Renewable Energy Usage Ratio")
 ax.set_xlabel("Episode")
 ax.set_ylabel("Ratio")
@@ -734,10 +1519,7 @@ ax.grid(True, alpha=0.3)
 
 # 3. Grid Cost
 ax = axes[1, 0]
-ax.plot(cost_history, alpha=0.3, color="red")
-if len(cost_history) >= w:
-    smoothed = np.convolve(cost_history, np.ones(w)/w, mode="valid")
-    ax.plot(range(w-1, len(cost_history)), smoothed, color="red", linewidth=2)
+plot_aggregates(ax, "cost", "red")
 ax.set_title("Daily Grid Cost ($)")
 ax.set_xlabel("Episode")
 ax.set_ylabel("Cost ($)")
@@ -777,17 +1559,17 @@ for _ in range(24):
         break
 
 history = eval_env.episode_history
-hours = [h["hour"] for h in history]
+hours = history["hour"]
 
 fig, axes = plt.subplots(2, 2, figsize=(14, 10))
 fig.suptitle("PPO Agent - 24-Hour Energy Dispatch", fontsize=14, fontweight="bold")
 
 # Demand vs Renewable
 ax = axes[0, 0]
-ax.plot(hours, [h["demand"] for h in history], "r-o", label="Demand", linewidth=2)
-ax.plot(hours, [h["solar"] + h["wind"] for h in history], "g--s", label="Renewable", linewidth=2)
-ax.fill_between(hours, [h["solar"] for h in history], alpha=0.3, color="orange", label="Solar")
-ax.fill_between(hours, [h["wind"] for h in history], alpha=0.3, color="skyblue", label="Wind")
+ax.plot(hours, history["demand"], "r-o", label="Demand", linewidth=2)
+ax.plot(hours, history["solar"] + history["wind"], "g--s", label="Renewable", linewidth=2)
+ax.fill_between(hours, history["solar"], alpha=0.3, color="orange", label="Solar")
+ax.fill_between(hours, history["wind"], alpha=0.3, color="skyblue", label="Wind")
 ax.set_title("Demand vs Renewable Generation")
 ax.set_xlabel("Hour")
 ax.set_ylabel("kW")
@@ -796,7 +1578,7 @@ ax.grid(True, alpha=0.3)
 
 # Battery Level
 ax = axes[0, 1]
-ax.plot(hours, [h["battery_level"] for h in history], "b-o", linewidth=2)
+ax.plot(hours, history["battery_level"], "b-o", linewidth=2)
 ax.axhline(y=CONFIG["battery_capacity"], color="r", linestyle="--", alpha=0.5, label="Max")
 ax.set_title("Battery Level")
 ax.set_xlabel("Hour")
@@ -807,7 +1589,7 @@ ax.grid(True, alpha=0.3)
 # Actions
 ax = axes[1, 0]
 action_names = ["Discharge", "Charge\nRenew", "Buy\nGrid", "Renew+\nDisch", "Renew+\nGrid"]
-action_counts = [sum(1 for h in history if h["action"] == i) for i in range(5)]
+action_counts = np.bincount(history["action"], minlength=5)
 colors = ["#e74c3c", "#2ecc71", "#e67e22", "#3498db", "#9b59b6"]
 ax.bar(action_names, action_counts, color=colors, edgecolor="black")
 ax.set_title("Action Distribution")
@@ -816,8 +1598,8 @@ ax.grid(True, alpha=0.3, axis="y")
 
 # Reward per hour
 ax = axes[1, 1]
-ax.bar(hours, [h["reward"] for h in history],
-       color=["green" if h["reward"] > 0 else "red" for h in history], alpha=0.7)
+ax.bar(hours, history["reward"],
+       color=np.where(history["reward"] > 0, "green", "red"), alpha=0.7)
 ax.set_title("Reward per Hour")
 ax.set_xlabel("Hour")
 ax.set_ylabel("Reward")
@@ -834,3 +1616,455 @@ print("=" * 60)
 print(f"📊 Results saved in evaluation_results/")
 print(f"🧠 Algorithm: PPO (Proximal Policy Optimization)")
 print(f"📝 Reference: Schulman et al., 2017")
+
+#@title 🔟 🔬 Performance Benchmarks (Optional)
+"""
+🔬 BENCHMARKS - Đặt RUN_BENCHMARKS = True để chạy (chỉ cần các cell định nghĩa 1-5)
+"""
+
+RUN_BENCHMARKS = False  #@param {type:"boolean"}
+
+
+def benchmark_vector_env(config, num_envs_list=(1, 64, 1024, 4096), num_steps=200, seed=0):
+    """env-steps/sec của MicrogridEnv vs VectorMicrogridEnv + kiểm tra từng env khớp bit-for-bit."""
+    action_rng = np.random.default_rng(seed)
+    parity_envs = 4
+    actions = action_rng.integers(config["action_dim"], size=(num_steps * 5, parity_envs))
+
+    # Parity: env i của VectorMicrogridEnv == MicrogridEnv với luồng seed con thứ i
+    vector_env = VectorMicrogridEnv(config, num_envs=parity_envs)
+    vector_obs, vector_rewards = [vector_env.reset(seed=seed)], []
+    for step_actions in actions:
+        obs, r, _, _ = vector_env.step(step_actions)
+        vector_obs.append(obs)
+        vector_rewards.append(r)
+    for i, env_seq in enumerate(np.random.SeedSequence(seed).spawn(parity_envs)):
+        scalar_env = MicrogridEnv(config)
+        scalar_obs, scalar_rewards = [scalar_env.reset(seed=env_seq)], []
+        for a in actions[:, i]:
+            obs, r, done, _ = scalar_env.step(int(a))
+            scalar_obs.append(scalar_env.reset() if done else obs)
+            scalar_rewards.append(r)
+        assert np.array_equal(scalar_obs, np.array(vector_obs)[:, i])
+        assert np.array_equal(scalar_rewards, np.array(vector_rewards)[:, i])
+    print(f"✅ VectorMicrogridEnv matches MicrogridEnv exactly (per-env seed streams, N={parity_envs})")
+    actions = actions[:, 0]
+
+    results = {}
+    scalar_env.reset(seed=seed)
+    start = time.perf_counter()
+    for a in actions:
+        if scalar_env.step(int(a))[2]:
+            scalar_env.reset()
+    results[0] = len(actions) / (time.perf_counter() - start)
+    print(f"   {'MicrogridEnv':<26}: {results[0]:>12,.0f} env-steps/s")
+    for n in num_envs_list:
+        vector_env = VectorMicrogridEnv(config, num_envs=n)
+        vector_env.reset(seed=seed)
+        batch_actions = action_rng.integers(config["action_dim"], size=(num_steps, n))
+        start = time.perf_counter()
+        for step_actions in batch_actions:
+            vector_env.step(step_actions)
+        results[n] = num_steps * n / (time.perf_counter() - start)
+        label = f"VectorMicrogridEnv N={n}"
+        print(f"   {label:<26}: {results[n]:>12,.0f} env-steps/s")
+    return results
+
+
+def benchmark_act(config, device, num_envs_list=(1, 64, 4096), num_iters=200, seed=0):
+    """µs/decision (sampling): select_action từng state vs act() qua torch vs act() qua NumPy mirror."""
+    agent = PPOAgent({**config, "numpy_actor": True}, device, seed=seed)
+    mirror = agent.actor_mirror
+    rng = np.random.default_rng(seed)
+
+    states = rng.random((256, config["state_dim"]), dtype=np.float32)
+    with torch.no_grad():
+        torch_logits, torch_values = agent.network(torch.from_numpy(states).to(device))
+        torch_probs = torch.softmax(torch_logits, dim=-1)
+    numpy_probs, numpy_values = mirror(states)
+    assert np.allclose(numpy_probs, torch_probs.cpu().numpy(), atol=1e-5)
+    assert np.allclose(numpy_values, torch_values.squeeze(1).cpu().numpy(), atol=1e-5)
+    print("✅ NumpyActorCritic matches ActorCritic")
+
+    def per_decision_us(fn, n):
+        batch = rng.random((n, config["state_dim"]), dtype=np.float32)
+        iters = max(1, num_iters // max(1, n // 64))
+        fn(batch)
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn(batch)
+        return (time.perf_counter() - start) / (iters * n) * 1e6
+
+    def select_each(batch):
+        for state in batch:
+            agent.select_action(state)
+
+    results = {}
+    for n in num_envs_list:
+        agent.actor_mirror = None
+        timings = {"select_action": per_decision_us(select_each, n),
+                   "act (torch)": per_decision_us(agent.act, n)}
+        agent.actor_mirror = mirror
+        timings["act (numpy)"] = per_decision_us(agent.act, n)
+        results[n] = timings
+        label = f"N={n}"
+        print(f"   {label:<26}: " + " | ".join(f"{k} {v:>7.2f}" for k, v in timings.items()) + " µs/decision")
+    return results
+
+
+def benchmark_compile(config, device, modes=("none", "torchscript", "torch_compile"),
+                      num_rollouts=20, episode_counts=(500, 50000), seed=0):
+    """Startup (tạo agent + rollout/update đầu, gồm compile) vs ms mỗi rollout ở steady state, theo compile_mode."""
+    rng = np.random.default_rng(seed)
+    states = rng.random((config["rollout_steps"], config["state_dim"]), dtype=np.float32)
+    rewards = rng.normal(size=config["rollout_steps"])
+
+    def rollout(agent):
+        for state, reward in zip(states, rewards):
+            action, log_prob, value = agent.select_action(state)
+            agent.store(state, action, log_prob, reward, value, False)
+        agent.update(0.0)
+
+    runs = [(mode, mode) for mode in modes]
+    if "torch_compile" in modes:
+        runs.append(("torch_compile (cached)", "torch_compile"))
+    results = {}
+    for label, mode in runs:
+        if hasattr(torch, "_dynamo"):
+            torch._dynamo.reset()  # Chỉ còn graph cache trên đĩa
+        start = time.perf_counter()
+        agent = PPOAgent({**config, "compile_mode": mode}, device, seed=seed)
+        rollout(agent)
+        startup = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(num_rollouts):
+            rollout(agent)
+        rollout_ms = (time.perf_counter() - start) / num_rollouts * 1000
+        rollouts_per_episode = config["max_steps_per_episode"] / config["rollout_steps"]
+        results[label] = {"startup_s": startup, "rollout_ms": rollout_ms}
+        totals = []
+        for episodes in episode_counts:
+            total = startup + episodes * rollouts_per_episode * rollout_ms / 1000
+            results[label][f"total_s_{episodes}"] = total
+            totals.append(f"{episodes:,} ep ≈ {total / 60:6.1f} min")
+        print(f"   {label:<26}: startup {startup:>6.1f}s | {rollout_ms:>7.1f} ms/rollout | " + " | ".join(totals))
+    return results
+
+
+def benchmark_export(config, device, agent=None, quantizations=EXPORT_QUANTIZATIONS, num_states=100_000,
+                     num_iters=500, seed=0):
+    """Mỗi quantization: action agreement với policy float, kích thước file, latency batch 1 / batch 1024 (CPU)."""
+    agent = agent if agent is not None else PPOAgent(config, device, seed=seed)
+    calibration = sample_policy_states(config, config["export_calibration_states"], agent, seed=seed + 1)
+    states = sample_policy_states(config, num_states, agent, seed=seed + 2)
+    single, batch = torch.from_numpy(states[:1]), torch.from_numpy(states[:1024])
+
+    def per_call_us(model, x):
+        with torch.no_grad():
+            model(x)
+            start = time.perf_counter()
+            for _ in range(num_iters):
+                model(x)
+        return (time.perf_counter() - start) / num_iters * 1e6
+
+    reference = policy_head(agent.network)
+    label = "float eager (reference)"
+    print(f"   {label:<26}: {'':>21} | batch 1 {per_call_us(reference, single):>6.1f} µs | "
+          f"batch 1024 {per_call_us(reference, batch) / 1024:>5.2f} µs/state")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for quantization in quantizations:
+            path = os.path.join(tmp_dir, f"policy_{quantization}.pt")
+            exported = export_policy(agent.network, path, quantization, calibration_states=calibration)
+            r = results[quantization] = {
+                "agreement": action_agreement(agent.network, exported, states)["agreement"],
+                "size_kb": os.path.getsize(path) / 1024,
+                "latency_us": per_call_us(exported, single),
+                "batch_us": per_call_us(exported, batch) / 1024,
+            }
+            print(f"   {quantization:<26}: agree {r['agreement'] * 100:6.2f}% | {r['size_kb']:>5.0f} KB | "
+                  f"batch 1 {r['latency_us']:>6.1f} µs | batch 1024 {r['batch_us']:>5.2f} µs/state")
+    return results
+
+
+def benchmark_gae(config, device, lengths=(96, 8192, 65536), num_envs=64, seed=0):
+    """
+    GAE vectorized (compute_gae, mảng (T, N)) vs bản vô hướng compute_gae_reference:
+    kiểm tra khớp (từng env, có done giữa rollout; qua PPOAgent.compute_gae) rồi đo thời gian
+    cho rollout T transition: một env T bước, hoặc num_envs env × T/num_envs bước.
+    """
+    rng = np.random.default_rng(seed)
+    gamma, lam = config["gamma"], config["gae_lambda"]
+
+    def random_rollout(T, N):
+        return (rng.normal(size=(T, N)).astype(np.float32), rng.normal(size=(T, N)).astype(np.float32),
+                (rng.random((T, N)) < 1 / config["max_steps_per_episode"]).astype(np.float32),
+                rng.normal(size=N).astype(np.float32))
+
+    # Equivalence: từng cột env so với vòng lặp vô hướng
+    rewards, values, dones, next_value = random_rollout(1000, 8)
+    advantages = compute_gae(rewards, values, dones, next_value, gamma, lam)
+    for i in range(8):
+        expected = compute_gae_reference(rewards[:, i].tolist(), values[:, i].tolist(), dones[:, i].tolist(),
+                                         float(next_value[i]), gamma, lam)
+        assert np.allclose(advantages[:, i], expected, rtol=1e-9, atol=1e-9), f"GAE mismatch in env {i}"
+    # Qua agent: RolloutBuffer + PPOAgent.compute_gae (float32, trên device)
+    T = config["rollout_steps"]
+    agent = PPOAgent(config, device, seed=seed)
+    rewards, values, dones, next_value = random_rollout(T, 1)
+    for t in range(T):
+        agent.store(np.zeros(config["state_dim"], dtype=np.float32), 0, 0.0, rewards[t, 0], values[t, 0], dones[t, 0])
+    agent_advantages, agent_returns = agent.compute_gae(float(next_value[0]))
+    expected = compute_gae_reference(rewards[:, 0].tolist(), values[:, 0].tolist(), dones[:, 0].tolist(),
+                                     float(next_value[0]), gamma, lam)
+    assert np.allclose(agent_advantages.cpu().numpy(), expected, rtol=1e-5, atol=1e-5)
+    assert np.allclose(agent_returns.cpu().numpy(), np.add(expected, values[:, 0]), rtol=1e-5, atol=1e-5)
+    print("✅ compute_gae matches compute_gae_reference (per env, with dones)")
+
+    results = {}
+    for T in lengths:
+        rewards, values, dones, next_value = random_rollout(T, 1)
+        lists = rewards[:, 0].tolist(), values[:, 0].tolist(), dones[:, 0].tolist()
+        start = time.perf_counter()
+        compute_gae_reference(*lists, float(next_value[0]), gamma, lam)
+        reference_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        compute_gae(rewards, values, dones, next_value, gamma, lam)
+        vector_ms = (time.perf_counter() - start) * 1000
+        rewards, values, dones, next_value = random_rollout(max(1, T // num_envs), num_envs)
+        start = time.perf_counter()
+        compute_gae(rewards, values, dones, next_value, gamma, lam)
+        batched_ms = (time.perf_counter() - start) * 1000
+        results[T] = {"reference_ms": reference_ms, "vectorized_ms": vector_ms, "batched_ms": batched_ms}
+        label = f"T={T}"
+        print(f"   {label:<26}: reference {reference_ms:>9.2f} ms | vectorized {vector_ms:>7.2f} ms | "
+              f"{num_envs} envs × {max(1, T // num_envs)} steps {batched_ms:>7.2f} ms")
+    return results
+
+
+def benchmark_vector_ppo(config, device, num_envs_list=(1, 8, 64, 256), target_reward=6.5, window=100,
+                         max_seconds=60.0, seed=0):
+    """
+    Training PPO với RolloutCollector trên N env lockstep (mini_batch_size × N): episodes/sec
+    (thu thập + update) và thời gian tới khi reward trung bình window episode gần nhất >= target_reward.
+    """
+    results = {}
+    for n in num_envs_list:
+        run_config = {**config, "num_envs": n, "mini_batch_size": config["mini_batch_size"] * n}
+        agent = PPOAgent(run_config, device, seed=seed)
+        collector = RolloutCollector(agent, VectorMicrogridEnv(run_config, n, seed=seed + 1))
+        rewards = StreamingStats(window)
+        episodes, time_to_target, episodes_to_target = 0, None, None
+        start = time.perf_counter()
+        while time.perf_counter() - start < max_seconds:
+            finished = collector.collect(run_config["rollout_steps"])
+            agent.update(collector.next_value())
+            for record in finished:
+                rewards.add(record["reward"])
+            episodes += len(finished)
+            if rewards.count >= window and rewards.recent().mean() >= target_reward:
+                time_to_target, episodes_to_target = time.perf_counter() - start, episodes
+                break
+        elapsed = time.perf_counter() - start
+        results[n] = {"episodes_per_s": episodes / elapsed, "time_to_target_s": time_to_target,
+                      "episodes_to_target": episodes_to_target}
+        reached = (f"target in {time_to_target:>5.1f}s ({episodes_to_target:,} ep)" if time_to_target is not None
+                   else f"target not reached in {max_seconds:.0f}s (mean {rewards.recent().mean():.2f})")
+        label = f"N={n} envs"
+        print(f"   {label:<26}: {episodes / elapsed:>7.1f} episodes/s | {reached}")
+    return results
+
+
+def benchmark_target_kl(config, device, target_kls=(None, 0.005, 0.01, 0.02), num_envs=1, num_minibatches=None,
+                        num_episodes=800, window=100, seed=0):
+    """
+    Early stopping theo target_kl: thời gian update, số epoch thực chạy, KL / clip fraction
+    trung bình và reward trung bình window episode cuối sau num_episodes episodes.
+    """
+    results = {}
+    for target_kl in target_kls:
+        run_config = {**config, "num_envs": num_envs, "num_minibatches": num_minibatches, "target_kl": target_kl}
+        agent = PPOAgent(run_config, device, seed=seed)
+        collector = RolloutCollector(agent, VectorMicrogridEnv(run_config, num_envs, seed=seed + 1))
+        rewards = StreamingStats(window)
+        update_stats = []
+        start = time.perf_counter()
+        while rewards.count < num_episodes:
+            for record in collector.collect(run_config["rollout_steps"]):
+                rewards.add(record["reward"])
+            agent.update(collector.next_value())
+            update_stats.append(agent.last_update_stats)
+        total = time.perf_counter() - start
+        stepped = [stats for stats in update_stats if stats["minibatches"]] or update_stats
+        mean = {name: np.mean([stats[name] for stats in update_stats])
+                for name in ("update_seconds", "epochs", "early_stopped")}
+        mean.update({name: np.mean([stats[name] for stats in stepped]) for name in ("approx_kl", "clip_fraction")})
+        results[target_kl] = {**mean, "total_s": total, "reward": rewards.recent().mean()}
+        label = f"target_kl={target_kl}"
+        print(f"   {label:<26}: update {mean['update_seconds'] * 1000:>6.1f} ms | epochs {mean['epochs']:>4.1f} "
+              f"(stopped {mean['early_stopped']:>4.0%}) | KL {mean['approx_kl']:.4f} | clip {mean['clip_fraction']:.3f} | "
+              f"total {total:>5.1f}s | reward {rewards.recent().mean():.2f}")
+    return results
+
+
+def benchmark_pipelined(config, device, num_envs_list=(1, 8, 64), num_rollouts=40, window=100, seed=0):
+    """
+    Throughput (env-steps/s gồm cả update) của vòng lặp tuần tự vs PipelinedRolloutCollector,
+    kèm thời gian thu thập / update riêng (pipeline lý tưởng: max thay vì tổng) và reward
+    trung bình window episode cuối. Cả hai chế độ chọn action bằng NumPy mirror (numpy_actor)
+    để chỉ khác ở phần overlap; overlap cần ≥ 2 CPU core (và torch không chiếm hết core).
+    """
+    print(f"   CPU cores: {os.cpu_count()}, torch threads: {torch.get_num_threads()}")
+    results = {}
+    for n in num_envs_list:
+        run_config = {**config, "num_envs": n, "mini_batch_size": config["mini_batch_size"] * n, "numpy_actor": True}
+        steps = run_config["rollout_steps"] * n
+        for pipelined in (False, True):
+            agent = PPOAgent(run_config, device, seed=seed)
+            env = VectorMicrogridEnv(run_config, n, seed=seed + 1)
+            collector = (PipelinedRolloutCollector if pipelined else RolloutCollector)(agent, env)
+            rewards = StreamingStats(window)
+            collect_s = update_s = 0.0
+            start = time.perf_counter()
+            for _ in range(num_rollouts):
+                t = time.perf_counter()
+                for record in collector.collect(run_config["rollout_steps"]):
+                    rewards.add(record["reward"])
+                collect_s += time.perf_counter() - t
+                t = time.perf_counter()
+                agent.update(collector.next_value())
+                update_s += time.perf_counter() - t
+            total = time.perf_counter() - start
+            collector.close()
+            mode = "pipelined" if pipelined else "sequential"
+            results[(n, mode)] = {"steps_per_s": num_rollouts * steps / total, "collect_s": collect_s,
+                                  "update_s": update_s, "reward": rewards.recent().mean()}
+            label = f"N={n} {mode}"
+            wait = "wait" if pipelined else "collect"
+            print(f"   {label:<26}: {num_rollouts * steps / total:>8,.0f} env-steps/s | {wait} {collect_s:>5.2f}s | "
+                  f"update {update_s:>5.2f}s | total {total:>5.2f}s | reward {rewards.recent().mean():.2f}")
+    return results
+
+
+def benchmark_policy_head(config, device, batch_sizes=(1, 64, 4096), minibatch_sizes=(32, 1024),
+                          num_iters=200, seed=0):
+    """
+    Đường fused policy_outputs (log-softmax + Gumbel-max) vs softmax + Categorical(probs):
+    kiểm tra khớp log-prob / entropy / phân phối sample, rồi đo µs mỗi lần act (forward +
+    sample + log-prob) và mỗi mini-batch update (forward + log-prob + entropy + backward).
+    """
+    network = ActorCritic(config["state_dim"], config["action_dim"], config["hidden_dims"]).to(device)
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+
+    # Equivalence với Categorical, kể cả policy gần như deterministic (logits lớn)
+    logits = torch.from_numpy(rng.normal(size=(4096, config["action_dim"])).astype(np.float32)).to(device)
+    for scale in (1.0, 50.0):
+        dist = Categorical(logits=logits * scale)
+        actions, log_probs, entropy = policy_outputs(logits * scale, generator=generator)
+        assert torch.allclose(log_probs, dist.log_prob(actions), atol=1e-5)
+        assert torch.allclose(entropy, dist.entropy(), atol=1e-5)
+    probs = torch.softmax(logits[:1], dim=-1).expand(200_000, -1)
+    samples = policy_outputs(probs.log(), generator=generator)[0]
+    frequencies = torch.bincount(samples, minlength=config["action_dim"]).float() / len(samples)
+    assert torch.allclose(frequencies, probs[0], atol=0.01), "Gumbel-max frequencies differ from softmax"
+    print("✅ policy_outputs matches Categorical (log-prob, entropy, sample frequencies)")
+
+    def categorical_act(states):
+        logits, values = network(states)
+        probs = torch.softmax(logits, dim=-1)
+        dist = Categorical(probs)
+        actions = torch.multinomial(probs, 1, generator=generator).squeeze(-1)
+        return actions, dist.log_prob(actions), values
+
+    def fused_act(states):
+        return network.act(states, generator)
+
+    def categorical_loss(states, actions):
+        logits, values = network(states)
+        dist = Categorical(torch.softmax(logits, dim=-1))
+        return -(dist.log_prob(actions).mean() + 0.01 * dist.entropy().mean()) + values.pow(2).mean()
+
+    def fused_loss(states, actions):
+        log_probs, values, entropy = network.evaluate(states, actions)
+        return -(log_probs.mean() + 0.01 * entropy.mean()) + values.pow(2).mean()
+
+    def per_call_us(fn, *args, grad=False):
+        def call():
+            if grad:
+                network.zero_grad()
+                fn(*args).backward()
+            else:
+                with torch.no_grad():
+                    fn(*args)
+        call()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            call()
+        return (time.perf_counter() - start) / num_iters * 1e6
+
+    results = {}
+    for n in batch_sizes:
+        states = torch.from_numpy(rng.random((n, config["state_dim"]), dtype=np.float32)).to(device)
+        r = results[f"act N={n}"] = {"categorical_us": per_call_us(categorical_act, states),
+                                     "fused_us": per_call_us(fused_act, states)}
+        label = f"act N={n}"
+        print(f"   {label:<26}: Categorical {r['categorical_us']:>8.1f} µs | fused {r['fused_us']:>8.1f} µs | "
+              f"{r['categorical_us'] / r['fused_us']:.2f}x")
+    for n in minibatch_sizes:
+        states = torch.from_numpy(rng.random((n, config["state_dim"]), dtype=np.float32)).to(device)
+        actions = torch.from_numpy(rng.integers(config["action_dim"], size=n)).to(device)
+        r = results[f"update mb={n}"] = {"categorical_us": per_call_us(categorical_loss, states, actions, grad=True),
+                                         "fused_us": per_call_us(fused_loss, states, actions, grad=True)}
+        label = f"update minibatch={n}"
+        print(f"   {label:<26}: Categorical {r['categorical_us']:>8.1f} µs | fused {r['fused_us']:>8.1f} µs | "
+              f"{r['categorical_us'] / r['fused_us']:.2f}x")
+    return results
+
+
+if RUN_BENCHMARKS:
+    print("=" * 60)
+    print("🔬 BENCHMARK: Vectorized environment")
+    print("=" * 60)
+    benchmark_vector_env(CONFIG)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Per-decision latency (select_action vs batched act)")
+    print("=" * 60)
+    benchmark_act(CONFIG, device)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Compile mode - startup vs steady-state")
+    print("=" * 60)
+    benchmark_compile(CONFIG, device)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Quantized policy export (CPU inference)")
+    print("=" * 60)
+    benchmark_export(CONFIG, device)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: GAE - vectorized reverse scan vs scalar loop")
+    print("=" * 60)
+    benchmark_gae(CONFIG, device)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Multi-env PPO collection - episodes/sec & time-to-target")
+    print("=" * 60)
+    benchmark_vector_ppo(CONFIG, device)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: KL early stopping in PPOAgent.update")
+    print("=" * 60)
+    benchmark_target_kl(CONFIG, device)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Pipelined collection + learning vs sequential")
+    print("=" * 60)
+    benchmark_pipelined(CONFIG, device)
+
+    print("\n" + "=" * 60)
+    print("🔬 BENCHMARK: Logits head - fused sampling/log-prob vs Categorical")
+    print("=" * 60)
+    benchmark_policy_head(CONFIG, device)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Microgrid Policy Server - Micro-batching inference server
+Serve một policy đã export (export_policy trong Microgrid_DQN_Colab.py /
+Microgrid_PPO_Colab.py) cho nhiều site cùng lúc.
+
+Các request đồng thời được gom thành micro-batch (tối đa --max-batch request
+hoặc chờ tối đa --max-wait-ms) và chạy chung một forward pass.
+
+Protocol: JSON theo dòng (newline-delimited) qua TCP hoặc Unix socket
+    request : {"id": 7, "obs": [8 số, định dạng MicrogridEnv._get_obs]}
+    response: {"id": 7, "action": 2, "q_values": [...]}   (DQN export)
+              {"id": 7, "action": 2, "probs": [...]}      (PPO export)
+    lỗi     : {"id": 7, "error": "..."}
+Một connection có thể gửi nhiều request liên tiếp; response mang theo "id".
+
+Usage:
+    python microgrid_policy_server.py serve --model policy_export.pt --port 8765
+    python microgrid_policy_server.py serve --model policy_export.pt --unix /tmp/microgrid.sock
+    python microgrid_policy_server.py loadtest --model policy_export.pt --concurrency 1,32,256
+    python microgrid_policy_server.py loadtest --connect 127.0.0.1:8765 --concurrency 256
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from microgrid_runtime import random_observations
+
+# ═══════════════════════════════════════════════════════════════════════════
+# POLICY
+# ═══════════════════════════════════════════════════════════════════════════
+def load_policy(path):
+    """
+    Load bản export TorchScript và metadata "policy.json" đi kèm.
+    Bản export cũ không có metadata được coi là DQN (Q-values, state 8 chiều).
+    """
+    extra_files = {"policy.json": ""}
+    policy = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    policy.eval()
+    metadata = json.loads(extra_files["policy.json"] or "{}")
+    metadata.setdefault("kind", "q_values")
+    metadata.setdefault("state_dim", 8)
+    if "action_dim" not in metadata:
+        with torch.inference_mode():
+            metadata["action_dim"] = int(policy(torch.zeros(1, metadata["state_dim"])).shape[1])
+    return policy, metadata
+
+
+class MicroBatcher:
+    """
+    Gom các observation đang chờ thành một batch và chạy một forward pass.
+
+    Forward chạy trên một worker thread riêng để event loop vẫn nhận/parse
+    request trong lúc tính toán; request đến trong lúc đó vào batch kế tiếp.
+    """
+
+    def __init__(self, policy, metadata, max_batch=256, max_wait_ms=2.0):
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be >= 1, got {max_batch}")
+        if max_wait_ms < 0:
+            raise ValueError(f"max_wait_ms must be >= 0, got {max_wait_ms}")
+        self.policy = policy
+        self.metadata = metadata
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="policy-forward")
+        self.batch = np.empty((max_batch, metadata["state_dim"]), dtype=np.float32)
+        self.num_batches = 0
+        self.num_requests = 0
+        self.forward_seconds = 0.0
+
+    async def submit(self, obs):
+        """Đưa một observation vào hàng đợi; trả về (action, values)."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((obs, future))
+        return await future
+
+    async def _collect(self):
+        """Chờ request đầu tiên rồi gom thêm tới max_batch hoặc hết max_wait."""
+        items = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(items) < self.max_batch:
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    def _forward(self, n):
+        start = time.perf_counter()
+        with torch.inference_mode():
+            values = self.policy(torch.from_numpy(self.batch[:n])).numpy()
+        self.forward_seconds += time.perf_counter() - start
+        return values.argmax(axis=1), values
+
+    async def run(self):
+        """Vòng lặp batching (chạy như một task nền)."""
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self._collect()
+            n = len(items)
+            for i, (obs, _) in enumerate(items):
+                self.batch[i] = obs
+            try:
+                actions, values = await loop.run_in_executor(self.executor, self._forward, n)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_requests += n
+            for i, (_, future) in enumerate(items):
+                if not future.done():  # client có thể đã ngắt kết nối
+                    future.set_result((int(actions[i]), values[i].tolist()))
+
+    def stats(self):
+        return {
+            "batches": self.num_batches,
+            "requests": self.num_requests,
+            "mean_batch_size": self.num_requests / max(1, self.num_batches),
+            "forward_ms_per_batch": 1000 * self.forward_seconds / max(1, self.num_batches),
+        }
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# SERVER
+# ═══════════════════════════════════════════════════════════════════════════
+def parse_request(line, state_dim):
+    """Parse một dòng request thành dict + obs float32; raise ValueError nếu không hợp lệ."""
+    try:
+        request = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e.msg}") from None
+    if not isinstance(request, dict):
+        raise ValueError("request must be a JSON object")
+    try:
+        obs = np.asarray(request.get("obs"), dtype=np.float32)
+    except (TypeError, ValueError):
+        raise ValueError("obs must be a list of numbers") from None
+    if obs.shape != (state_dim,):
+        raise ValueError(f"obs must have {state_dim} values, got shape {obs.shape}")
+    if not np.isfinite(obs).all():
+        raise ValueError("obs contains NaN/inf")
+    return request, obs
+
+
+def make_handler(batcher):
+    """Tạo callback cho asyncio.start_server / start_unix_server."""
+    state_dim = batcher.metadata["state_dim"]
+    values_key = batcher.metadata["kind"]
+
+    async def respond(line, writer):
+        try:
+            request, obs = parse_request(line, state_dim)
+        except ValueError as e:
+            try:  # giữ "id" của request nếu đọc được
+                request_id = json.loads(line).get("id")
+            except (ValueError, AttributeError):
+                request_id = None
+            writer.write((json.dumps({"id": request_id, "error": str(e)}) + "\n").encode())
+            return
+        try:
+            action, values = await batcher.submit(obs)
+            response = {"id": request.get("id"), "action": action, values_key: values}
+        except Exception as e:
+            response = {"id": request.get("id"), "error": f"{type(e).__name__}: {e}"}
+        writer.write((json.dumps(response) + "\n").encode())
+
+    async def handle(reader, writer):
+        pending = set()
+        try:
+            while line := await reader.readline():
+                if not line.strip():
+                    continue
+                task = asyncio.create_task(respond(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                await writer.drain()
+            if pending:
+                await asyncio.gather(*pending)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+    return handle
+
+
+async def start_server(batcher, host="127.0.0.1", port=8765, unix_path=None):
+    """Khởi động batcher task và server; trả về (server, batcher_task)."""
+    batcher_task = asyncio.create_task(batcher.run())
+    handler = make_handler(batcher)
+    if unix_path:
+        server = await asyncio.start_unix_server(handler, path=unix_path)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+    return server, batcher_task
+
+
+async def serve(args):
+    policy, metadata = load_policy(args.model)
+    batcher = MicroBatcher(policy, metadata, args.max_batch, args.max_wait_ms)
+    server, _ = await start_server(batcher, args.host, args.port, args.unix)
+    where = args.unix or "%s:%d" % server.sockets[0].getsockname()[:2]
+    print(f"🚀 Serving {args.model} ({metadata['kind']}, {metadata.get('quantization', '?')}) on {where}")
+    print(f"   max_batch={args.max_batch}, max_wait_ms={args.max_wait_ms}")
+    async with server:
+        await server.serve_forever()
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# LOAD GENERATOR
+# ═══════════════════════════════════════════════════════════════════════════
+async def _open(connect):
+    if connect.startswith("unix:"):
+        return await asyncio.open_unix_connection(connect[len("unix:"):])
+    host, port = connect.rsplit(":", 1)
+    return await asyncio.open_connection(host, int(port))
+
+
+async def _client(connect, observations, stop_at, latencies):
+    """Một site: gửi request, chờ response, lặp lại tới stop_at (closed loop)."""
+    reader, writer = await _open(connect)
+    try:
+        i = 0
+        while time.perf_counter() < stop_at:
+            obs = observations[i % len(observations)]
+            start = time.perf_counter()
+            writer.write((json.dumps({"id": i, "obs": obs.tolist()}) + "\n").encode())
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - start)
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            i += 1
+    finally:
+        writer.close()
+
+
+async def run_load(connect, concurrency, duration, seed=0):
+    """
+    Chạy `concurrency` client đồng thời trong `duration` giây.
+
+    Returns:
+        {"requests", "throughput" (req/s), "p50_ms", "p99_ms"}
+    """
+    rng = np.random.default_rng(seed)
+    observations = random_observations(rng, 1024)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _client(connect, observations[rng.permutation(len(observations))], start + duration, latencies)
+        for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies_ms = 1000 * np.asarray(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+async def loadtest(args):
+    concurrencies = [int(c) for c in args.concurrency.split(",")]
+    print(f"📊 Load test: {args.duration:.0f}s per run, closed-loop clients")
+    if args.connect:
+        print(f"   Target: {args.connect}")
+        for concurrency in concurrencies:
+            result = await run_load(args.connect, concurrency, args.duration)
+            print(f"   {'concurrency=' + str(concurrency):<26}: {result['throughput']:>8.0f} req/s, "
+                  f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
+        return
+
+    # Server chạy trong cùng process (cổng ngẫu nhiên); client và server chia sẻ CPU,
+    # dùng `serve` + `loadtest --connect` để đo riêng server
+    policy, metadata = load_policy(args.model)
+    print(f"   Model: {args.model} ({metadata['kind']}, {metadata.get('quantization', '?')})")
+    for max_batch in [int(b) for b in str(args.max_batch).split(",")]:
+        for concurrency in concurrencies:
+            batcher = MicroBatcher(policy, metadata, max_batch, args.max_wait_ms)
+            server, batcher_task = await start_server(batcher, "127.0.0.1", 0)
+            connect = "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            try:
+                result = await run_load(connect, concurrency, args.duration)
+            finally:
+                server.close()
+                await server.wait_closed()
+                batcher_task.cancel()
+                batcher.executor.shutdown()
+            stats = batcher.stats()
+            label = f"batch<={max_batch}, conc={concurrency}"
+            print(f"   {label:<26}: {result['throughput']:>8.0f} req/s, "
+                  f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+                  f"mean batch {stats['mean_batch_size']:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching inference server cho microgrid policy")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = sub.add_parser("serve", help="Chạy server")
+    serve_parser.add_argument("--model", default="policy_export.pt", help="File export_policy (TorchScript)")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--unix", default=None, help="Unix socket path (thay cho TCP)")
+    serve_parser.add_argument("--max-batch", type=int, default=256)
+    serve_parser.add_argument("--max-wait-ms", type=float, default=2.0)
+
+    load_parser = sub.add_parser("loadtest", help="Đo throughput và latency p50/p99")
+    load_parser.add_argument("--model", default="policy_export.pt")
+    load_parser.add_argument("--connect", default=None,
+                             help="HOST:PORT hoặc unix:PATH của server đang chạy (mặc định: server trong process)")
+    load_parser.add_argument("--concurrency", default="1,32,256", help="Số client đồng thời, phân tách bằng dấu phẩy")
+    load_parser.add_argument("--duration", type=float, default=5.0, help="Số giây mỗi lần đo")
+    load_parser.add_argument("--max-batch", default="1,256",
+                             help="max_batch của server trong process, phân tách bằng dấu phẩy (1 = không batching)")
+    load_parser.add_argument("--max-wait-ms", type=float, default=2.0)
+
+    args = parser.parse_args()
+    torch.set_num_threads(1)  # batch nhỏ: một thread intra-op là nhanh nhất, tránh tranh CPU với event loop
+    asyncio.run(serve(args) if args.command == "serve" else loadtest(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Microgrid Policy Runtime - NumPy-only inference (không cần torch)
+Chạy policy DQN/PPO đã train từ một file trọng số phẳng, có version,
+được memory-map khi load. Controller chỉ cần numpy: không import torch.
+
+Định dạng file (.mgw, little-endian):
+    [0:8)    magic b"MGPOLICY"
+    [8:12)   uint32 format version (FORMAT_VERSION)
+    [12:16)  uint32 độ dài header JSON
+    [16:...) header JSON (kind, activation, state_dim, action_dim, arrays)
+    data     các mảng float32, mỗi mảng căn lề ALIGNMENT bytes;
+             weight lưu dạng (in, out) để forward là h @ W + b
+
+Usage:
+    python microgrid_runtime.py convert final_model.pt policy.mgw          # DQNAgent.save
+    python microgrid_runtime.py convert evaluation_results/ppo_actor_critic.pt ppo_policy.mgw
+    python microgrid_runtime.py verify final_model.pt policy.mgw           # action parity vs torch
+    python microgrid_runtime.py verify final_model.pt policy.mgw --states env_obs.npy  # obs ghi từ env
+    python microgrid_runtime.py bench final_model.pt policy.mgw            # cold start + RSS
+"""
+
+import argparse
+import json
+import os
+import re
+import struct
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+
+MAGIC = b"MGPOLICY"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREFIX = struct.Struct("<8sII")
+
+# kind -> (activation giữa các hidden layer, output)
+POLICY_KINDS = {
+    "q_values": "relu",  # QNetwork: Linear -> ReLU (-> Dropout) ... -> Linear (Q-values)
+    "probs": "tanh",     # ActorCritic: shared Linear -> Tanh ... -> actor Linear -> Softmax
+}
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# WEIGHT FILE
+# ═══════════════════════════════════════════════════════════════════════════
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_weights(path, layers, kind, metadata=None):
+    """
+    Ghi file trọng số phẳng (atomic).
+
+    Args:
+        path: File output
+        layers: List (weight (out, in), bias (out,)) theo thứ tự forward, như nn.Linear
+        kind: "q_values" (DQN) hoặc "probs" (PPO actor)
+        metadata: Thông tin thêm ghi vào header (vd. nguồn checkpoint)
+    """
+    if kind not in POLICY_KINDS:
+        raise ValueError(f"kind must be one of {tuple(POLICY_KINDS)}, got {kind!r}")
+    arrays = []
+    for i, (weight, bias) in enumerate(layers):
+        arrays.append((f"layers.{i}.weight", np.ascontiguousarray(np.asarray(weight, dtype="<f4").T)))
+        arrays.append((f"layers.{i}.bias", np.ascontiguousarray(bias, dtype="<f4")))
+    header = {
+        "kind": kind,
+        "activation": POLICY_KINDS[kind],
+        "state_dim": int(arrays[0][1].shape[0]),
+        "action_dim": int(arrays[-1][1].shape[0]),
+        "num_layers": len(layers),
+        "metadata": metadata or {},
+        "arrays": [],
+    }
+    # Offset phụ thuộc độ dài header: tính lặp tới khi cố định
+    data_start = 0
+    while True:
+        offset, entries = data_start, []
+        for name, array in arrays:
+            entries.append({"name": name, "shape": list(array.shape), "offset": offset})
+            offset = _align(offset + array.nbytes)
+        header["arrays"] = entries
+        encoded = json.dumps(header).encode()
+        if _align(_PREFIX.size + len(encoded)) == data_start:
+            break
+        data_start = _align(_PREFIX.size + len(encoded))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+        f.write(encoded)
+        for entry, (_, array) in zip(entries, arrays):
+            f.write(b"\0" * (entry["offset"] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+class PolicyRuntime:
+    """
+    Forward MLP bằng NumPy trên các mảng memory-map từ file trọng số.
+    Tái hiện QNetwork.forward (eval mode) / actor head của ActorCritic.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, header_len = _PREFIX.unpack(bytes(self._mmap[:_PREFIX.size]))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a microgrid policy weight file")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"{path} has format version {version}, this runtime reads {FORMAT_VERSION}")
+        self.header = json.loads(bytes(self._mmap[_PREFIX.size:_PREFIX.size + header_len]))
+        if self.header["kind"] not in POLICY_KINDS:
+            raise ValueError(f"unknown policy kind {self.header['kind']!r} in {path}")
+        arrays = {
+            entry["name"]: np.ndarray(tuple(entry["shape"]), dtype="<f4", buffer=self._mmap, offset=entry["offset"])
+            for entry in self.header["arrays"]
+        }
+        self.weights = [arrays[f"layers.{i}.weight"] for i in range(self.header["num_layers"])]
+        self.biases = [arrays[f"layers.{i}.bias"] for i in range(self.header["num_layers"])]
+        self.kind = self.header["kind"]
+        self.state_dim = self.header["state_dim"]
+        self.action_dim = self.header["action_dim"]
+
+    def __call__(self, states):
+        """
+        Args:
+            states: shape (N, state_dim) hoặc (state_dim,), định dạng MicrogridEnv._get_obs
+
+        Returns:
+            Q-values (DQN) hoặc probs (PPO), shape (N, action_dim) hoặc (action_dim,)
+        """
+        h = np.asarray(states, dtype=np.float32)
+        last = len(self.weights) - 1
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            h = h @ weight + bias
+            if i < last:
+                if self.kind == "q_values":
+                    np.maximum(h, 0.0, out=h)  # ReLU
+                else:
+                    np.tanh(h, out=h)
+        if self.kind == "probs":
+            h -= h.max(axis=-1, keepdims=True)
+            np.exp(h, out=h)
+            h /= h.sum(axis=-1, keepdims=True)
+        return h
+
+    def act(self, states):
+        """Greedy action: int cho một state, mảng int64 cho batch."""
+        actions = self(states).argmax(axis=-1)
+        return int(actions) if actions.ndim == 0 else actions
+
+
+def load_weights(path):
+    """Mở file trọng số (memory-map, không chép vào RAM cho tới khi dùng)."""
+    return PolicyRuntime(path)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# CONVERT / VERIFY (cần torch)
+# ═══════════════════════════════════════════════════════════════════════════
+def _linear_layers(state_dict, prefixes):
+    """(weight, bias) của các Linear có key "<prefix>.<i>.weight", theo thứ tự prefix rồi i."""
+    layers = []
+    for prefix in prefixes:
+        pattern = re.compile(re.escape(prefix) + r"\.(\d+)\.weight$")
+        indices = sorted(int(m.group(1)) for m in map(pattern.match, state_dict) if m)
+        layers += [(state_dict[f"{prefix}.{i}.weight"], state_dict[f"{prefix}.{i}.bias"]) for i in indices]
+    return layers
+
+
+def read_checkpoint(path):
+    """
+    Đọc checkpoint torch thành (layers numpy, kind).
+    Hỗ trợ DQNAgent.save (key "q_network") và state_dict của ActorCritic (PPO).
+    """
+    import torch
+    checkpoint = torch.load(path, map_location="cpu")
+    if "q_network" in checkpoint:
+        layers, kind = _linear_layers(checkpoint["q_network"], ["network"]), "q_values"
+    elif "actor.0.weight" in checkpoint:
+        layers, kind = _linear_layers(checkpoint, ["shared", "actor"]), "probs"
+    else:
+        raise ValueError(f"{path}: expected a DQNAgent.save checkpoint or an ActorCritic state_dict")
+    return [(w.float().numpy(), b.float().numpy()) for w, b in layers], kind
+
+
+def torch_reference(layers, kind):
+    """nn.Sequential cùng cấu trúc với QNetwork (eval, bỏ Dropout) / shared + actor của ActorCritic."""
+    import torch
+    import torch.nn as nn
+    modules = []
+    for i, (weight, bias) in enumerate(layers):
+        linear = nn.Linear(weight.shape[1], weight.shape[0])
+        linear.weight.data.copy_(torch.from_numpy(weight))
+        linear.bias.data.copy_(torch.from_numpy(bias))
+        modules.append(linear)
+        if i < len(layers) - 1:
+            modules.append(nn.ReLU() if kind == "q_values" else nn.Tanh())
+    if kind == "probs":
+        modules.append(nn.Softmax(dim=-1))
+    return nn.Sequential(*modules).eval()
+
+
+def random_observations(rng, n):
+    """Observation ngẫu nhiên đúng định dạng MicrogridEnv._get_obs (8 chiều, đã chuẩn hóa)."""
+    obs = rng.random((n, 8), dtype=np.float32)
+    hour = rng.integers(24, size=n)
+    obs[:, 5] = (np.sin(2 * np.pi * hour / 24) + 1) / 2
+    obs[:, 6] = (np.cos(2 * np.pi * hour / 24) + 1) / 2
+    obs[:, 7] = rng.integers(5, size=n) / 4
+    return obs
+
+
+def verify(checkpoint_path, weights_path, num_states=100_000, seed=0, states=None):
+    """
+    So sánh action (argmax) của runtime NumPy với model torch trên num_states states.
+    states: mảng (N, state_dim) ghi từ env (vd. np.save các obs của MicrogridEnv);
+    mặc định dùng random_observations.
+
+    Returns:
+        {"agreement", "mismatches", "num_states", "max_abs_diff"}
+    """
+    import torch
+    layers, kind = read_checkpoint(checkpoint_path)
+    runtime = load_weights(weights_path)
+    if runtime.kind != kind:
+        raise ValueError(f"{weights_path} holds {runtime.kind!r}, checkpoint is {kind!r}")
+    reference = torch_reference(layers, kind)
+    if states is None:
+        states = random_observations(np.random.default_rng(seed), num_states)
+    states = np.asarray(states, dtype=np.float32)
+    num_states = len(states)
+    with torch.no_grad():
+        expected = reference(torch.from_numpy(states)).numpy()
+    actual = runtime(states)
+    mismatches = int((expected.argmax(axis=1) != actual.argmax(axis=1)).sum())
+    return {
+        "agreement": 1.0 - mismatches / num_states,
+        "mismatches": mismatches,
+        "num_states": num_states,
+        "max_abs_diff": float(np.abs(expected - actual).max()),
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# COLD START / RSS
+# ═══════════════════════════════════════════════════════════════════════════
+# Mỗi lần đo chạy trong process mới: thời gian từ import tới action đầu tiên + peak RSS
+_COLD_START_NUMPY = """
+import time; start = time.perf_counter()
+import resource, sys
+sys.path.insert(0, {here!r})
+import numpy as np
+from microgrid_runtime import load_weights
+runtime = load_weights({weights!r})
+action = runtime.act(np.full(runtime.state_dim, 0.5, dtype=np.float32))
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+_COLD_START_TORCH = """
+import time; start = time.perf_counter()
+import resource, sys
+sys.path.insert(0, {here!r})
+import torch
+from microgrid_runtime import read_checkpoint, torch_reference
+model = torch_reference(*read_checkpoint({checkpoint!r}))
+with torch.no_grad():
+    action = int(model(torch.full((1, model[0].in_features), 0.5)).argmax())
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def measure_cold_start(code, repeats=5):
+    """Median (giây, peak RSS MB) của `code` chạy trong process Python mới."""
+    results = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        seconds, rss_kb = out.stdout.split()[-2:]
+        results.append((float(seconds), int(rss_kb) / 1024))  # ru_maxrss: KB trên Linux
+    return tuple(float(np.median(column)) for column in zip(*results))
+
+
+def bench(checkpoint_path, weights_path, repeats=5):
+    here = os.path.dirname(os.path.abspath(__file__))
+    runtime = load_weights(weights_path)
+    states = random_observations(np.random.default_rng(0), 1)
+    per_call = min(timeit.repeat(lambda: runtime.act(states[0]), number=2000, repeat=5)) / 2000
+
+    print(f"📊 Cold start (median of {repeats} fresh processes, import -> first action)")
+    numpy_s, numpy_mb = measure_cold_start(
+        _COLD_START_NUMPY.format(here=here, weights=os.path.abspath(weights_path)), repeats)
+    torch_s, torch_mb = measure_cold_start(
+        _COLD_START_TORCH.format(here=here, checkpoint=os.path.abspath(checkpoint_path)), repeats)
+    print(f"   {'numpy runtime':<26}: {numpy_s * 1000:7.0f} ms, peak RSS {numpy_mb:6.0f} MB")
+    print(f"   {'torch':<26}: {torch_s * 1000:7.0f} ms, peak RSS {torch_mb:6.0f} MB")
+    print(f"   {'weight file':<26}: {os.path.getsize(weights_path) / 1024:7.0f} KB")
+    print(f"   {'numpy act() per state':<26}: {per_call * 1e6:7.1f} µs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NumPy-only runtime cho microgrid policy")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    convert_parser = sub.add_parser("convert", help="Checkpoint torch -> file trọng số phẳng")
+    convert_parser.add_argument("checkpoint", help="DQNAgent.save checkpoint hoặc ActorCritic state_dict")
+    convert_parser.add_argument("weights", help="File output (.mgw)")
+
+    verify_parser = sub.add_parser("verify", help="Kiểm tra action parity với model torch")
+    verify_parser.add_argument("checkpoint")
+    verify_parser.add_argument("weights")
+    verify_parser.add_argument("--num-states", type=int, default=100_000)
+    verify_parser.add_argument("--states", help="File .npy chứa observation ghi từ env (thay cho states ngẫu nhiên)")
+
+    bench_parser = sub.add_parser("bench", help="Đo cold start và RSS: runtime NumPy vs torch")
+    bench_parser.add_argument("checkpoint")
+    bench_parser.add_argument("weights")
+    bench_parser.add_argument("--repeats", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == "convert":
+        layers, kind = read_checkpoint(args.checkpoint)
+        write_weights(args.weights, layers, kind, metadata={"source": os.path.basename(args.checkpoint)})
+        runtime = load_weights(args.weights)
+        print(f"✅ {args.checkpoint} → {args.weights} ({kind}, "
+              f"{' → '.join(str(w.shape[0]) for w in runtime.weights)} → {runtime.action_dim}, "
+              f"{os.path.getsize(args.weights) / 1024:.0f} KB)")
+    elif args.command == "verify":
+        states = np.load(args.states) if args.states else None
+        result = verify(args.checkpoint, args.weights, args.num_states, states=states)
+        print(f"   {'action agreement':<26}: {result['agreement']:.4%} "
+              f"({result['mismatches']} mismatches / {result['num_states']:,} states)")
+        print(f"   {'max abs output diff':<26}: {result['max_abs_diff']:.2e}")
+        if result["mismatches"]:
+            sys.exit(1)
+        print("✅ NumPy runtime matches torch")
+    else:
+        bench(args.checkpoint, args.weights, args.repeats)
+
+
+if __name__ == "__main__":
+    main()